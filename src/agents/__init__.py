@@ -1,21 +1,35 @@
+# 注册不同的Agent，各Agent模块在第一次通过registry取用时才导入
+from utils.register import register_lazy_modules, lazy_getattr
 from .base_agent import Agent
-from .doctor import (
-    Doctor, 
-    GPTDoctor, 
-    ChatGLMDoctor, 
-    MinimaxDoctor, 
-    WenXinDoctor, 
-    QwenDoctor, 
-    HuatuoGPTDoctor,
-    HFDoctor
-)
-from .patient import Patient
-from .reporter import Reporter, ReporterV2
-from .host import Host
+from .exam_index import ExaminationIndex, ExamTermExtractor, exam_lookups
+from .icd_agreement import ICDAgreement, agreement_prechecks
+
+
+_class_to_module = register_lazy_modules(__name__, {
+    ".doctor": {
+        "Doctor": "Agent.Doctor.Base",
+        "GPTDoctor": "Agent.Doctor.GPT",
+        "ChatGLMDoctor": "Agent.Doctor.ChatGLM",
+        "MinimaxDoctor": "Agent.Doctor.Minimax",
+        "WenXinDoctor": "Agent.Doctor.WenXin",
+        "QwenDoctor": "Agent.Doctor.Qwen",
+        "HuatuoGPTDoctor": "Agent.Doctor.HuatuoGPT",
+        "HFDoctor": "Agent.Doctor.HF",
+    },
+    ".patient": {"Patient": "Agent.Patient.GPT"},
+    ".reporter": {"Reporter": "Agent.Reporter.GPT", "ReporterV2": "Agent.Reporter.GPTV2"},
+    ".host": {"Host": "Agent.Host.GPT"},
+})
+__getattr__ = lazy_getattr(__name__, _class_to_module)
 
 
 __all__ = [
     "Agent",
+    "ExaminationIndex",
+    "ExamTermExtractor",
+    "exam_lookups",
+    "ICDAgreement",
+    "agreement_prechecks",
     "Doctor",
     "GPTDoctor",
     "ChatGLMDoctor",
@@ -1,31 +1,91 @@
+import asyncio
 from abc import abstractmethod
 from utils.register import register_class
+from utils.call_context import call_context
+
+
+class AgentEngine:
+    """
+    Agent持有的Engine：每次调用都在调用上下文中标明Agent的角色，其他属性直接取自共享的Engine。
+    """
+    def __init__(self, engine, role):
+        self.engine = engine
+        self.role = role
+
+    def get_response(self, *args, **kwargs):
+        with call_context(role=self.role):
+            return self.engine.get_response(*args, **kwargs)
+
+    async def aget_response(self, *args, **kwargs):
+        with call_context(role=self.role):
+            return await self.engine.aget_response(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
 
 
 @register_class(alias="Agent.Base")
 class Agent(object):
+    """
+    Agent本身不保存病人相关的可变状态：对话记忆等放在每个病人的session(见hospital.session)中，由调用方显式传入，
+    同一个Agent可以被任意多个线程、asyncio task同时使用。
+    """
+    role = None
+
     def __init__(self, engine):
         self.engine = engine
-        self.memories = [("system", self.system_message)]
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        self._engine = AgentEngine(engine, self.role) if engine is not None else None
     
     @staticmethod
     def add_parser_args(parser):
         pass
 
-    def memorize(self, message):
-        self.memories.append(message)
+    # providers whose dialog has to start with the user skip what the agent said before hearing anything
+    drop_leading_assistant = False
+
+    def initial_memories(self):
+        # the memories a session starts with for this agent
+        return [("system", self.system_message)]
 
-    def forget(self):
-        self.memories = [("system", self.system_message)]
+    def recall(self, utterance, key):
+        # the (role, content) memory this agent has of an utterance of the transcript, None if it did not hear it
+        if utterance.speaker == key:
+            return ("assistant", utterance.content)
+        if key in utterance.audience:
+            return ("user", utterance.content)
+        return None
+
+    @staticmethod
+    def format_message(role, content):
+        # the message of a memory as the agent's provider takes it
+        return {"role": role, "content": content}
+
+    def memorize(self, message, session):
+        role, content = message
+        if role == "assistant":
+            session.say(self, content)
+        else:
+            session.hear(self, None, content)
     
-    def show_memories(self):
+    def show_memories(self, session):
         print ("--------------- Memory ---------------")
-        for memory in self.memories:
+        for message in session.view(self).messages():
             print ("--------------------------------------")
-            print (memory[0])
-            print (memory[1])
+            for value in message.values():
+                print (value)
         print ()
 
     @abstractmethod
-    def speak(self, message, save_to_memory=True):
-        pass
\ No newline at end of file
+    def speak(self, message, session=None, save_to_memory=True):
+        pass
+
+    async def aspeak(self, *args, **kwargs):
+        # agents without a native async speak run the blocking one in a worker thread
+        return await asyncio.to_thread(self.speak, *args, **kwargs)
@@ -1,6 +1,9 @@
 from .base_agent import Agent
-from utils.register import register_class, registry
+from utils.register import register_class
+from engine import build_engine, StopAfterSection
+from utils.call_context import call_context
 from collections import defaultdict
+import asyncio
 import re
 import jsonlines
 from abc import abstractmethod
@@ -8,6 +11,10 @@ from abc import abstractmethod
 
 @register_class(alias="Agent.Doctor.Base")
 class Doctor(Agent):
+    role = "Doctor"
+    # a diagnosis is complete once its #治疗方案# section is
+    diagnosis_stop = StopAfterSection("治疗方案")
+
     def __init__(self, engine=None, doctor_info=None, name="A"):
         if doctor_info is None:
             self.system_message = \
@@ -25,25 +32,41 @@ class Doctor(Agent):
 
         self.doctor_greet = "您好，有哪里不舒服？"
         self.engine = engine
-        def default_value_factory():
-            return [("system", self.system_message)]
-        
-        self.memories = defaultdict(default_value_factory) 
-
+        # diagnoses loaded before the consultation, read only afterwards: revisions go to the session
         def default_diagnosis_factory():
             return {}
         self.diagnosis = defaultdict(default_diagnosis_factory) 
 
-    def get_response(self, messages):
-        response = self.engine.get_response(messages)
+    def get_response(self, messages, stop=None):
+        response = self.engine.get_response(messages, stop=stop)
         return response
 
-    def get_diagnosis_by_patient_id(self, patient_id, key="ALL"):
+    async def aget_response(self, messages, stop=None):
+        response = await self.engine.aget_response(messages, stop=stop)
+        return response
+
+    def engine_session_id(self, session):
+        # the calls of this doctor in one consultation, e.g. for a local model's KV cache
+        return (self.name, session.patient_id)
+
+    def close_session(self, session):
+        self.engine.drop_session(self.engine_session_id(session))
+
+    def initial_diagnosis(self, patient_id):
+        # a session starts from a copy of the loaded diagnosis
+        return dict(self.diagnosis.get(patient_id, {}))
+
+    def get_diagnosis(self, session, key="ALL"):
         if key == "ALL":
-            return self.diagnosis[patient_id]
+            return session.diagnosis(self)
         else:
             assert key in ["症状", "辅助检查", "诊断结果", "诊断依据", "治疗方案"]
-            return self.diagnosis[patient_id].get(key)
+            return session.diagnosis(self).get(key)
+
+    def update_diagnosis(self, session, diagnosis):
+        if not isinstance(diagnosis, dict):
+            diagnosis = self.parse_diagnosis(diagnosis)
+        session.diagnosis(self).update(diagnosis)
     
     def load_diagnosis(
             self, 
@@ -97,42 +120,44 @@ class Doctor(Agent):
     def add_parser_args(parser):
         pass
 
-    def memorize(self, message, patient_id):
-        self.memories[patient_id].append(message)
-
-    def forget(self, patient_id=None):
-        def default_value_factory():
-            return [("system", self.system_message)]
-        if patient_id is None:
-            self.memories.pop(patient_id)
-        else:
-            self.memories = defaultdict(default_value_factory) 
 
-    def speak(self, content, patient_id, save_to_memory=True):
-        memories = self.memories[patient_id]
+    def build_messages(self, content, session):
+        # what the doctor is told joins the transcript, the doctor's view of it is extended and not rebuilt
+        session.hear(self, None, content)
+        return session.view(self).messages()
 
-        messages = [{"role": memory[0], "content": memory[1]} for memory in memories]
-        messages.append({"role": "user", "content": content})
+    def speak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
 
-        responese = self.get_response(messages)
+        responese = self.get_response(messages, stop=self.diagnosis_stop)
 
-        self.memorize(("user", content), patient_id)
-        self.memorize(("assistant", responese), patient_id)
+        session.say(self, responese)
 
         return responese
 
-    def revise_diagnosis_by_symptom_and_examination(self, patient, symptom_and_examination):
+    @call_context(stage="revise")
+    def revise_diagnosis_by_symptom_and_examination(self, session, symptom_and_examination):
+        messages = self.build_revise_by_symptom_and_examination_messages(session, symptom_and_examination)
+        # get the revised diagnosis from the doctor
+        diagnosis = self.get_response(messages, stop=self.diagnosis_stop)
+        # update the diagnosis of doctor in the patient's session
+        self.update_diagnosis(session, diagnosis)
+
+    @call_context(stage="revise")
+    async def arevise_diagnosis_by_symptom_and_examination(self, session, symptom_and_examination):
+        messages = self.build_revise_by_symptom_and_examination_messages(session, symptom_and_examination)
+        diagnosis = await self.aget_response(messages, stop=self.diagnosis_stop)
+        self.update_diagnosis(session, diagnosis)
+
+    def build_revise_by_symptom_and_examination_messages(self, session, symptom_and_examination):
         # load the symptom and examination from the host
-        self.load_diagnosis(
-            diagnosis=symptom_and_examination, 
-            patient_id=patient.id
-        )
+        self.update_diagnosis(session, symptom_and_examination)
         # revise the diagnosis
         # build the system message
         system_message = "你是一个专业的医生。\n" + \
             "你正在为患者做诊断，患者的症状和辅助检查如下：\n" + \
-            "#症状#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="症状")) + \
-            "#辅助检查#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="辅助检查")) + \
+            "#症状#\n{}\n\n".format(self.get_diagnosis(session, key="症状")) + \
+            "#辅助检查#\n{}\n\n".format(self.get_diagnosis(session, key="辅助检查")) + \
             "下面你将收到一份初步的医疗意见，其中包含诊断结果、诊断依据和治疗方案。\n" + \
             "(1) 这份医疗意见中可能是正确的，也可能存在谬误，仅供参考。\n" + \
             "(2) 你需要根据患者的症状和辅助检查的结果，来给出更正确合理的诊断结果、诊断依据和治疗方案。\n" + \
@@ -142,41 +167,57 @@ class Doctor(Agent):
             "#治疗方案#\n(1) xxx\n(2) xxx\n"
         # build the content
         content = "#诊断结果#\n{}\n\n#诊断依据#\n{}\n\n#治疗方案#\n{}".format(
-            self.get_diagnosis_by_patient_id(patient.id, key="诊断结果"), 
-            self.get_diagnosis_by_patient_id(patient.id, key="诊断依据"), 
-            self.get_diagnosis_by_patient_id(patient.id, key="治疗方案")
+            self.get_diagnosis(session, key="诊断结果"), 
+            self.get_diagnosis(session, key="诊断依据"), 
+            self.get_diagnosis(session, key="治疗方案")
         )
-        # get the revised diagnosis from the doctor
-        diagnosis = self.get_response([
+        messages = [
             {"role": "system", "content": system_message}, 
             {"role": "user", "content": content}
-        ])
-        # update the diagnosis of doctor for patient with "patient_id"
-        self.load_diagnosis(
-            diagnosis=diagnosis,
-            patient_id=patient.id
-        )
-
-    def revise_diagnosis_by_others(self, patient, doctors, host_critique=None, discussion_mode="Parallel"):
+        ]
+        return messages
+
+    @call_context(stage="revise")
+    def revise_diagnosis_by_others(self, session, doctors, host_critique=None, discussion_mode="Parallel"):
+        messages = self.build_revise_by_others_messages(session, doctors, host_critique, discussion_mode)
+        responese = self.get_response(messages, stop=self.diagnosis_stop)
+        self.update_diagnosis(session, responese)
+
+    @call_context(stage="revise")
+    async def arevise_diagnosis_by_others(self, session, doctors, host_critique=None, discussion_mode="Parallel"):
+        messages = self.build_revise_by_others_messages(session, doctors, host_critique, discussion_mode)
+        responese = await self.aget_response(messages, stop=self.diagnosis_stop)
+        self.update_diagnosis(session, responese)
+
+    @call_context(stage="revise")
+    def revise_diagnosis(self, messages):
+        # the revised diagnosis for messages built before the round, the caller updates the session
+        return self.get_response(messages, stop=self.diagnosis_stop)
+
+    @call_context(stage="revise")
+    async def arevise_diagnosis(self, messages):
+        return await self.aget_response(messages, stop=self.diagnosis_stop)
+
+    def build_revise_by_others_messages(self, session, doctors, host_critique=None, discussion_mode="Parallel"):
         # revise_mode in ["Parallel", "Parallel_with_Critique"]
         if discussion_mode == "Parallel":
-            self.revise_diagnosis_by_others_in_parallel(patient, doctors)
+            return self.build_revise_by_others_in_parallel_messages(session, doctors)
         elif discussion_mode == "Parallel_with_Critique":
-            self.revise_diagnosis_by_others_in_parallel_with_critique(patient, doctors, host_critique)
+            return self.build_revise_by_others_in_parallel_with_critique_messages(session, doctors, host_critique)
         else:
             raise Exception("Wrong discussion_mode: {}".format(discussion_mode))
 
-    def revise_diagnosis_by_others_in_parallel(self, patient, doctors):
+    def build_revise_by_others_in_parallel_messages(self, session, doctors):
         int_to_char = {0: "A", 1: "B", 2: "C", 3: "D"}
         # load the symptom and examination from the host
         system_message = "你是一个专业的医生。\n" + \
             "你正在为患者做诊断，患者的症状和辅助检查如下：\n" + \
-            "#症状#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="症状")) + \
-            "#辅助检查#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="辅助检查")) + \
+            "#症状#\n{}\n\n".format(self.get_diagnosis(session, key="症状")) + \
+            "#辅助检查#\n{}\n\n".format(self.get_diagnosis(session, key="辅助检查")) + \
             "针对患者的病情，你给出了初步的诊断意见：\n" + \
-            "#诊断结果#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="诊断结果")) + \
-            "#诊断依据#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="诊断依据")) + \
-            "#治疗方案#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="治疗方案")) + \
+            "#诊断结果#\n{}\n\n".format(self.get_diagnosis(session, key="诊断结果")) + \
+            "#诊断依据#\n{}\n\n".format(self.get_diagnosis(session, key="诊断依据")) + \
+            "#治疗方案#\n{}\n\n".format(self.get_diagnosis(session, key="治疗方案")) + \
             "(1) 下面你将收到来自其他医生的诊断意见，其中也包含诊断结果、诊断依据和治疗方案。你需要批判性地梳理并分析其他医生的诊断意见。\n" + \
             "(2) 如果你发现其他医生给出的诊断意见有比你的更合理的部分，请吸纳进你的诊断意见中进行改进。\n" + \
             "(3) 如果你认为你的诊断意见相对于其他医生的更科学合理，请坚持自己的意见保持不变。\n" + \
@@ -189,30 +230,27 @@ class Doctor(Agent):
         for i, doctor in enumerate(doctors):
             content += "##医生{}##\n\n#诊断结果#\n{}\n\n#诊断依据#\n{}\n\n#治疗方案#\n{}\n\n".format(
                 doctor.name,
-                doctor.get_diagnosis_by_patient_id(patient.id, key="诊断结果"), 
-                doctor.get_diagnosis_by_patient_id(patient.id, key="诊断依据"), 
-                doctor.get_diagnosis_by_patient_id(patient.id, key="治疗方案")
+                doctor.get_diagnosis(session, key="诊断结果"), 
+                doctor.get_diagnosis(session, key="诊断依据"), 
+                doctor.get_diagnosis(session, key="治疗方案")
             )
-        responese = self.get_response([
+        messages = [
             {"role": "system", "content": system_message}, 
             {"role": "user", "content": content}
-        ])
-        self.load_diagnosis(
-            diagnosis=responese,
-            patient_id=patient.id
-        )
+        ]
+        return messages
 
-    def revise_diagnosis_by_others_in_parallel_with_critique(self, patient, doctors, host_critique=None):
+    def build_revise_by_others_in_parallel_with_critique_messages(self, session, doctors, host_critique=None):
         # int_to_char = {0: "A", 1: "B", 2: "C", 3: "D"}
         # load the symptom and examination from the host
         system_message = "你是一个专业的医生{}。\n".format(self.name) + \
             "你正在为患者做诊断，患者的症状和辅助检查如下：\n" + \
-            "#症状#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="症状")) + \
-            "#辅助检查#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="辅助检查")) + \
+            "#症状#\n{}\n\n".format(self.get_diagnosis(session, key="症状")) + \
+            "#辅助检查#\n{}\n\n".format(self.get_diagnosis(session, key="辅助检查")) + \
             "针对患者的病情，你给出了初步的诊断意见：\n" + \
-            "#诊断结果#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="诊断结果")) + \
-            "#诊断依据#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="诊断依据")) + \
-            "#治疗方案#\n{}\n\n".format(self.get_diagnosis_by_patient_id(patient.id, key="治疗方案")) + \
+            "#诊断结果#\n{}\n\n".format(self.get_diagnosis(session, key="诊断结果")) + \
+            "#诊断依据#\n{}\n\n".format(self.get_diagnosis(session, key="诊断依据")) + \
+            "#治疗方案#\n{}\n\n".format(self.get_diagnosis(session, key="治疗方案")) + \
             "(1) 下面你将收到来自其他医生的诊断意见，其中也包含诊断结果、诊断依据和治疗方案。你需要批判性地梳理并分析其他医生的诊断意见。\n" + \
             "(2) 在这个过程中，请你注意主治医生给出的争议点。\n" + \
             "(3) 如果你发现其他医生给出的诊断意见有比你的更合理的部分，请吸纳进你的诊断意见中进行改进。\n" + \
@@ -226,29 +264,27 @@ class Doctor(Agent):
         for i, doctor in enumerate(doctors):
             content += "##医生{}##\n\n#诊断结果#\n{}\n\n#诊断依据#\n{}\n\n#治疗方案#\n{}\n\n".format(
                 doctor.name,
-                doctor.get_diagnosis_by_patient_id(patient.id, key="诊断结果"), 
-                doctor.get_diagnosis_by_patient_id(patient.id, key="诊断依据"), 
-                doctor.get_diagnosis_by_patient_id(patient.id, key="治疗方案")
+                doctor.get_diagnosis(session, key="诊断结果"), 
+                doctor.get_diagnosis(session, key="诊断依据"), 
+                doctor.get_diagnosis(session, key="治疗方案")
             )
         content += "##主任医生##\n{}".format(host_critique)
 
         # print("doctor: {}".format(self.name))
         # print(content)
         # print("-"*100)
-        responese = self.get_response([
+        messages = [
             {"role": "system", "content": system_message}, 
             {"role": "user", "content": content}
-        ])
-        self.load_diagnosis(
-            diagnosis=responese,
-            patient_id=patient.id
-        )
+        ]
+        return messages
 
 
 @register_class(alias="Agent.Doctor.GPT")
 class GPTDoctor(Doctor):
     def __init__(self, args=None, doctor_info=None, name="A"):
-        engine = registry.get_class("Engine.GPT")(
+        engine = build_engine(
+            "Engine.GPT",
             openai_api_key=args.doctor_openai_api_key, 
             openai_api_base=args.doctor_openai_api_base,
             openai_model_name=args.doctor_openai_model_name, 
@@ -273,20 +309,29 @@ class GPTDoctor(Doctor):
         parser.add_argument('--doctor_frequency_penalty', type=float, default=0, help='frequency penalty')
         parser.add_argument('--doctor_presence_penalty', type=float, default=0, help='presence penalty')                
 
-    def get_response(self, messages):
-        response = self.engine.get_response(messages)
+    def get_response(self, messages, stop=None):
+        response = self.engine.get_response(messages, stop=stop)
         return response
 
-    def speak(self, content, patient_id, save_to_memory=True):
-        memories = self.memories[patient_id]
+    async def aget_response(self, messages, stop=None):
+        response = await self.engine.aget_response(messages, stop=stop)
+        return response
 
-        messages = [{"role": memory[0], "content": memory[1]} for memory in memories]
-        messages.append({"role": "user", "content": content})
+    def speak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
 
-        response = self.get_response(messages)
+        response = self.get_response(messages, stop=self.diagnosis_stop)
 
-        self.memorize(("user", content), patient_id)
-        self.memorize(("assistant", response), patient_id)
+        session.say(self, response)
+
+        return response
+
+    async def aspeak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
+
+        response = await self.aget_response(messages, stop=self.diagnosis_stop)
+
+        session.say(self, response)
 
         return response
 
@@ -294,7 +339,8 @@ class GPTDoctor(Doctor):
 @register_class(alias="Agent.Doctor.ChatGLM")
 class ChatGLMDoctor(Doctor):
     def __init__(self, args=None, doctor_info=None, name="A"):
-        engine = registry.get_class("Engine.ChatGLM")(
+        engine = build_engine(
+            "Engine.ChatGLM",
             chatglm_api_key=args.doctor_chatglm_api_key, 
             model_name=args.doctor_chatglm_model_name, 
             temperature=args.doctor_temperature, 
@@ -303,9 +349,8 @@ class ChatGLMDoctor(Doctor):
         )
         super(ChatGLMDoctor, self).__init__(engine, doctor_info, name=name)
 
-        def default_value_factory():
-            return [("assistant", self.system_message)]
-        self.memories = defaultdict(default_value_factory) 
+    def initial_memories(self):
+        return [("assistant", self.system_message)]
 
     @staticmethod
     def add_parser_args(parser):
@@ -315,19 +360,12 @@ class ChatGLMDoctor(Doctor):
         parser.add_argument("--doctor_top_p", type=float, default=0.9)
         parser.add_argument("--doctor_incremental", type=bool, default=True)
 
-    def forget(self, patient_id=None):
-        def default_value_factory():
-            return [("assistant", self.system_message)]
-        if patient_id is None:
-            self.memories.pop(patient_id)
-        else:
-            self.memories = defaultdict(default_value_factory) 
-
 
 @register_class(alias="Agent.Doctor.Minimax")
 class MinimaxDoctor(Doctor):
     def __init__(self, args=None, doctor_info=None, name="A"):
-        engine = registry.get_class("Engine.MiniMax")(
+        engine = build_engine(
+            "Engine.MiniMax",
             minimax_api_key=args.doctor_minimax_api_key, 
             minimax_group_id=args.doctor_minimax_group_id, 
             minimax_model_name=args.doctor_minimax_model_name, 
@@ -339,15 +377,15 @@ class MinimaxDoctor(Doctor):
 
         super(MinimaxDoctor, self).__init__(engine, doctor_info, name=name)
 
-        def default_value_factory():
-            return []
-        self.memories = defaultdict(default_value_factory) 
-
         self.bot_setting = [{
             "bot_name": "医生",
             "content": self.system_message
         }]
 
+    def initial_memories(self):
+        # the system message goes in bot_setting
+        return []
+
     @staticmethod
     def add_parser_args(parser):
         parser.add_argument("--doctor_minimax_group_id", type=str)
@@ -358,14 +396,6 @@ class MinimaxDoctor(Doctor):
         parser.add_argument("--doctor_top_p", type=float, default=1.0)
         parser.add_argument("--doctor_stream", type=bool, default=False)
 
-    def forget(self, patient_id=None):
-        def default_value_factory():
-            return []
-        if patient_id is None:
-            self.memories.pop(patient_id)
-        else:
-            self.memories = defaultdict(default_value_factory) 
-
     @staticmethod
     def translate_role_to_sender_type(role):
         if role == "user":
@@ -384,39 +414,40 @@ class MinimaxDoctor(Doctor):
         else:
             raise Exception("Unknown role: {}".format(role))
         
-    def speak(self, content, patient_id, save_to_memory=True):
-        memories = self.memories[patient_id]
-        messages = []
-        for memory in memories:
-            sender_type = self.translate_role_to_sender_type(memory[0])
-            sender_name = self.translate_role_to_sender_name(memory[0])
-            messages.append({"sender_type": sender_type, "sender_name": sender_name, "text": memory[1]})
-        messages.append({"sender_type": "USER", "sender_name": "患者",  "text": content})
+    def format_message(self, role, content):
+        return {
+            "sender_type": self.translate_role_to_sender_type(role),
+            "sender_name": self.translate_role_to_sender_name(role),
+            "text": content}
+
+    def speak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
 
-        responese = self.engine.get_response(messages, self.bot_setting)
+        responese = self.engine.get_response(messages, self.bot_setting, stop=self.diagnosis_stop)
 
-        self.memorize(("user", content), patient_id)
-        self.memorize(("assistant", responese), patient_id)
+        session.say(self, responese)
 
         return responese
 
 
 @register_class(alias="Agent.Doctor.WenXin")
 class WenXinDoctor(Doctor):
+    # the system message is sent apart and the dialog has to start with the user
+    drop_leading_assistant = True
+
     def __init__(self, args=None, doctor_info=None, name="A"):
-        engine = registry.get_class("Engine.WenXin")(
-            wenxin_api_key=args.doctor_wenxin_api_key, 
-            wenxin_sercet_key=args.doctor_wenxin_sercet_key,
+        engine = build_engine(
+            "Engine.WenXin",
+            api_key=args.doctor_wenxin_api_key, 
+            sercet_key=args.doctor_wenxin_sercet_key,
             temperature=args.doctor_temperature, 
             top_p=args.doctor_top_p,
             penalty_score=args.doctor_penalty_score,
         )
         super(WenXinDoctor, self).__init__(engine, doctor_info, name=name)
 
-        def default_value_factory():
-            return []
-        self.memories = defaultdict(default_value_factory) 
-        # self.memories = []
+    def initial_memories(self):
+        return []
 
     @staticmethod
     def add_parser_args(parser):
@@ -426,40 +457,34 @@ class WenXinDoctor(Doctor):
         parser.add_argument("--doctor_top_p", type=float, default=0.8)
         parser.add_argument("--doctor_penalty_score", type=float, default=1.0)
 
-    def forget(self, patient_id=None):
-        def default_value_factory():
-            return []
-        if patient_id is None:
-            self.memories = defaultdict(default_value_factory) 
-        else:
-            self.memories.pop(patient_id)
-        
-    def get_response(self, messages):
+    def get_response(self, messages, stop=None):
         if messages[0]["role"] == "system":
             system_message = messages.pop(0)["content"]
         else: system_message = self.system_message
         if messages[0]["role"] == "assistant":
             messages.pop(0)
-        response = self.engine.get_response(messages, system=system_message)
+        response = self.engine.get_response(messages, system=system_message, stop=stop)
         return response
 
-    def speak(self, content, patient_id, save_to_memory=True):
-        memories = self.memories[patient_id]
-        # if memories[0][0] == "assistant":
-        #     memories.pop(0)
-        messages = [{"role": memory[0], "content": memory[1]} for memory in memories]
-        messages.append({"role": "user", "content": content})
+    async def aget_response(self, messages, stop=None):
+        return await asyncio.to_thread(self.get_response, messages, stop)
+
+    def speak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
         responese = self.engine.get_response(messages, system=self.system_message)
 
-        self.memorize(("user", content), patient_id)
-        self.memorize(("assistant", responese), patient_id)
+        session.say(self, responese)
         return responese
 
 
 @register_class(alias="Agent.Doctor.Qwen")
 class QwenDoctor(Doctor):
+    # the greeting is left out, the dialog goes system, user, assistant, ...
+    drop_leading_assistant = True
+
     def __init__(self, args=None, doctor_info=None, name="A"):
-        engine = registry.get_class("Engine.Qwen")(
+        engine = build_engine(
+            "Engine.Qwen",
             api_key=args.doctor_qwen_api_key, 
             model_name=args.doctor_qwen_model_name, 
             seed=1,
@@ -474,24 +499,19 @@ class QwenDoctor(Doctor):
             choices=["qwen-max", "qwen-max-1201", "qwen-plus-gamma", "qwen-plus", "qwen-turbo", "baichuan2-7b-chat-v1", "baichuan2-13b-chat-v1"], default="qwen-max")
         parser.add_argument("--doctor_seed", type=int, default=1)
     
-    def speak(self, content, patient_id, save_to_memory=True):
-        memories = self.memories[patient_id]
-
-        messages = [{"role": memory[0], "content": memory[1]} for memory in memories]
-        messages.append({"role": "user", "content": content})
-        if messages[1].get("role") == "assistant":
-            messages.pop(1)
+    def speak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
         responese = self.engine.get_response(messages)
         
-        self.memorize(("user", content), patient_id)
-        self.memorize(("assistant", responese), patient_id)
+        session.say(self, responese)
         return responese
 
 
 @register_class(alias="Agent.Doctor.HuatuoGPT")
 class HuatuoGPTDoctor(Doctor):
     def __init__(self, args=None, doctor_info=None):
-        engine = registry.get_class("Engine.HuatuoGPT")(
+        engine = build_engine(
+            "Engine.HuatuoGPT",
             model_name_or_path=args.doctor_huatuogpt_model_name_or_path, 
         )
         super(HuatuoGPTDoctor, self).__init__(engine, doctor_info)
@@ -500,24 +520,21 @@ class HuatuoGPTDoctor(Doctor):
     def add_parser_args(parser):
         parser.add_argument("--doctor_huatuogpt_model_name_or_path", type=str)
     
-    def speak(self, content, patient_id, save_to_memory=True):
-        memories = self.memories[patient_id]
-
-        messages = [{"role": memory[0], "content": memory[1]} for memory in memories]
-        messages.append({"role": "user", "content": content})
+    def speak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
         # if messages[1].get("role") == "assistant":
         #     messages.pop(1)
-        responese = self.engine.get_response(messages)
+        responese = self.engine.get_response(messages, session_id=self.engine_session_id(session))
         
-        self.memorize(("user", content), patient_id)
-        self.memorize(("assistant", responese), patient_id)
+        session.say(self, responese)
         return responese
 
 
 @register_class(alias="Agent.Doctor.HF")
 class HFDoctor(Doctor):
     def __init__(self, args=None, doctor_info=None):
-        engine = registry.get_class("Engine.HF")(
+        engine = build_engine(
+            "Engine.HF",
             model_name_or_path=args.doctor_hf_model_name_or_path, 
         )
         super(HFDoctor, self).__init__(engine, doctor_info)
@@ -526,15 +543,11 @@ class HFDoctor(Doctor):
     def add_parser_args(parser):
         parser.add_argument("--doctor_hf_model_name_or_path", type=str)
     
-    def speak(self, content, patient_id, save_to_memory=True):
-        memories = self.memories[patient_id]
-
-        messages = [{"role": memory[0], "content": memory[1]} for memory in memories]
-        messages.append({"role": "user", "content": content})
+    def speak(self, content, session, save_to_memory=True):
+        messages = self.build_messages(content, session)
         # if messages[1].get("role") == "assistant":
         #     messages.pop(1)
-        responese = self.engine.get_response(messages)
+        responese = self.engine.get_response(messages, session_id=self.engine_session_id(session))
         
-        self.memorize(("user", content), patient_id)
-        self.memorize(("assistant", responese), patient_id)
+        session.say(self, responese)
         return responese
\ No newline at end of file
@@ -0,0 +1,378 @@
+import re
+import threading
+import unicodedata
+from collections import deque
+
+
+class ExaminationEntry:
+    __slots__ = ("item", "result", "key", "parent")
+
+    def __init__(self, item, result, key, parent=None):
+        self.item = item
+        self.result = result
+        self.key = key
+        self.parent = parent
+
+    def line(self):
+        return "- {}: {}".format(self.item, self.result)
+
+
+class ExaminationIndex:
+    """
+    一个病人的检查结果索引：载入病人时把病历中的#查体#、#辅助检查#解析成 项目 -> 结果，
+    Reporter先在本地按归一化的项目名(模糊)匹配查询，只有置信度低于阈值时才交给LLM。
+    回复的格式与LLM相同：#检查项目#\\n- xxx: xxx
+    """
+    sections = ("查体", "辅助检查")
+    # written the same way after normalization
+    aliases = [
+        ("胸片", "胸部x光"), ("x线", "x光"), ("彩超", "超声"), ("b超", "超声"), ("核磁共振", "mri"), ("核磁", "mri"),
+        ("磁共振", "mri"), ("心电", "心电图"), ("心电图图", "心电图"), ("血象", "血常规"),
+    ]
+    # the usual abbreviations of vital signs in 查体
+    abbreviations = {"t": "体温", "p": "脉搏", "r": "呼吸", "bp": "血压", "hr": "心率", "spo2": "血氧饱和度"}
+    # said around the exam names of a query
+    fillers = re.compile(
+        "您好|你好|医生|谢谢|请问|麻烦|能否|可以|告诉我|帮我|查询|查一下|一下|我需要|我想|需要|建议我|让我|要求我|"
+        "进行|做了|做过|做|了|的|这些|那些|具体|项目|结果|是什么|怎么样|如何|情况|检查|检测|化验|测定|吗|呢")
+    # a segment of a query that has one of these asks for an exam
+    exam_words = re.compile(
+        "检查|检测|化验|测定|ct|mri|x光|超声|镜|造影|心电图|常规|功能|试验|培养|活检|病理|穿刺|测序|扫描|"
+        "血糖|血压|抗体|抗原|指标|水平|听诊|触诊|体温|脉搏|心率|呼吸|血气|电解质|酶|蛋白|激素")
+    splitter = re.compile(r"[，,、。；;？?！!\n]|以及|还有|和|及|与|或")
+
+    def __init__(self, medical_records):
+        self.entries = []
+        for section in self.sections:
+            self.parse_section(section, medical_records.get(section) or "")
+
+    @classmethod
+    def normalize(cls, text):
+        text = re.sub(r"[\W_]+", "", text.lower())
+        for alias, name in cls.aliases:
+            text = text.replace(alias, name)
+        return text
+
+    @classmethod
+    def strip_fillers(cls, text):
+        return cls.fillers.sub("", text)
+
+    def add(self, item, result, parent=None, key=None):
+        key = self.strip_fillers(self.normalize(key or item))
+        if key in self.abbreviations:
+            key = item = self.abbreviations[key]
+        if len(key) >= 2 and result:
+            self.entries.append(ExaminationEntry(item, result, key, parent))
+
+    def parse_clause(self, section, clause, parent=None):
+        # "体温38.5℃" -> 体温: 38.5℃, a finding without a value is a result of the section
+        match = re.match(r"^([^\d<>＜＞≤≥]+?)\s*([\d<>＜＞≤≥].*)$", clause)
+        if match:
+            self.add(match.group(1).strip(), match.group(2).strip(), parent)
+        elif parent is None:
+            # e.g. 咽部充血, found by its own words
+            self.add(section, clause, key=clause)
+
+    def parse_section(self, section, text):
+        for line in re.split(r"[\n；;。]+", text):
+            line = re.sub(r"^\s*(\d+[\.、)）]|[\(（]\d+[\)）]|[-•])\s*", "", line).strip()
+            if not line:
+                continue
+            if re.search(r"[:：]", line):
+                item, result = [part.strip() for part in re.split(r"[:：]", line, maxsplit=1)]
+                count = len(self.entries)
+                self.add(item, result)
+                parent = self.entries[-1] if len(self.entries) > count else None
+                # the values inside, e.g. 白细胞 of 血常规
+                for clause in re.split(r"[，,、]", result):
+                    if clause.strip() and parent is not None:
+                        self.parse_clause(section, clause.strip(), parent=parent)
+            else:
+                for clause in re.split(r"[，,]", line):
+                    if clause.strip():
+                        self.parse_clause(section, clause.strip())
+
+    @staticmethod
+    def common_substring(a, b):
+        # length of the longest common substring
+        best = 0
+        previous = [0] * (len(b) + 1)
+        for i in range(1, len(a) + 1):
+            current = [0] * (len(b) + 1)
+            for j in range(1, len(b) + 1):
+                if a[i - 1] == b[j - 1]:
+                    current[j] = previous[j - 1] + 1
+                    best = max(best, current[j])
+            previous = current
+        return best
+
+    def score(self, term, entry):
+        if term in entry.key:
+            return 1.0
+        return self.common_substring(term, entry.key) / min(len(term), len(entry.key))
+
+    def lookup(self, term):
+        """
+        :return: (匹配的条目, 分数)
+        """
+        contained = [entry for entry in self.entries if entry.key in term]
+        if contained:
+            # e.g. 血常规 in 血常规胸部ct, whatever else the term asks for is not answered
+            rest = term
+            for entry in contained:
+                rest = rest.replace(entry.key, "")
+            return contained, 0.5 if self.exam_words.search(rest) else 1.0
+        scores = [(self.score(term, entry), entry) for entry in self.entries]
+        best = max((score for score, _ in scores), default=0.0)
+        return [entry for score, entry in scores if score == best and best > 0], best
+
+    def terms(self, query):
+        # the normalized names of what a query asks for, and whether each of them looks like an exam
+        terms = []
+        for segment in self.splitter.split(query.lower()):
+            segment = self.normalize(segment)
+            is_exam = bool(self.exam_words.search(segment))
+            term = self.strip_fillers(segment)
+            if len(term) >= 2:
+                terms.append((term, is_exam))
+        return terms
+
+    def answer(self, query):
+        """
+        :return: (按LLM格式的回复, 置信度)，没有找到任何检查项目时为(None, 0.0)
+        """
+        matched, confidence = [], 1.0
+        for term, is_exam in self.terms(query):
+            entries, score = self.lookup(term)
+            if score < 1.0 and not is_exam:
+                # small talk around the exams
+                continue
+            confidence = min(confidence, score)
+            matched += [entry for entry in entries if entry not in matched]
+        if not matched:
+            return None, 0.0
+        # an item and the values inside it: the item says it all
+        matched = [entry for entry in matched if entry.parent not in matched]
+        return "\n".join(["#检查项目#"] + [entry.line() for entry in matched]), confidence
+
+
+class AhoCorasick:
+    """
+    多模式串匹配：一次扫描找出文本中出现的所有词典词。
+    """
+    def __init__(self, words):
+        # node: (children, fail, words ending here)
+        self.children = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for word in words:
+            self.add(word)
+        self.build()
+
+    def add(self, word):
+        node = 0
+        for char in word:
+            if char not in self.children[node]:
+                self.children.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.children[node][char] = len(self.children) - 1
+            node = self.children[node][char]
+        self.outputs[node].append(word)
+
+    def build(self):
+        queue = deque(self.children[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.children[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.children[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.children[fail].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def find(self, text):
+        """
+        :return: [(start, end, word)]，所有出现的位置
+        """
+        matches = []
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self.children[node]:
+                node = self.fail[node]
+            node = self.children[node].get(char, 0)
+            for word in self.outputs[node]:
+                matches.append((i + 1 - len(word), i + 1, word))
+        return matches
+
+
+class ExamTermExtractor:
+    """
+    从病人的检查申请中抽取检查项目，代替ReporterV2中20条消息的few-shot LLM调用：
+    词典(检查名及其同义词、身体部位)由few-shot示例和常见检查整理而来，可用--reporter_exam_terms补充
+    (每行一个检查名，或"写法\t标准名"，见scripts/build_exam_terms.py从历史对话中整理)。
+    文本按NFKC和小写归一化后用Aho-Corasick一次扫描，取最左最长的不重叠匹配，
+    检查名前面同一小句中的身体部位(如 腹部、脖子)和后面的"检查"等后缀一起保留，输出病人原文中的写法。
+    """
+    # spelling -> canonical name, a name without a spelling maps to itself
+    exam_terms = {
+        "血常规": "血常规", "血象": "血常规", "血液检查": "血液检查", "血液测试": "血液检查", "验血": "血液检查",
+        "尿常规": "尿常规", "便常规": "便常规", "大便常规": "便常规", "粪便常规": "便常规", "潜血": "潜血", "隐血": "潜血",
+        "血红蛋白": "血红蛋白", "白细胞": "白细胞", "红细胞": "红细胞", "血小板": "血小板",
+        "凝血功能": "凝血功能", "凝血": "凝血功能", "炎症指标": "炎症指标", "c反应蛋白": "c反应蛋白", "crp": "c反应蛋白",
+        "降钙素原": "降钙素原", "血沉": "血沉", "肝功能": "肝功能", "肾功能": "肾功能", "血脂": "血脂", "血糖": "血糖",
+        "糖化血红蛋白": "糖化血红蛋白", "电解质": "电解质", "血气分析": "血气分析", "心肌酶": "心肌酶", "肌钙蛋白": "肌钙蛋白",
+        "甲状腺功能": "甲状腺功能", "甲功": "甲状腺功能", "肿瘤标志物": "肿瘤标志物", "癌胚抗原": "癌胚抗原", "甲胎蛋白": "甲胎蛋白",
+        "hcg": "hcg", "妊娠试验": "妊娠试验", "尿妊娠试验": "尿妊娠试验", "病毒检测": "病毒检测", "核酸检测": "核酸检测",
+        "细菌培养": "细菌培养", "血培养": "血培养", "痰培养": "痰培养", "药敏试验": "药敏试验", "基因检测": "基因检测",
+        "基因组测序": "基因组测序", "免疫组化": "免疫组化", "乙肝五项": "乙肝五项", "乙肝两对半": "乙肝五项",
+        "超声": "超声", "超声波": "超声", "b超": "超声", "彩超": "超声", "多普勒": "超声", "内窥镜超声": "内镜超声",
+        "超声内镜": "内镜超声", "eus": "内镜超声", "ct": "ct", "ct扫描": "ct", "增强ct": "增强ct", "pet-ct": "pet-ct",
+        "petct": "pet-ct", "mri": "mri", "核磁": "mri", "核磁共振": "mri", "磁共振": "mri", "x光": "x光", "x线": "x光",
+        "胸片": "胸片", "钼靶": "钼靶", "造影": "造影", "血管造影": "血管造影", "骨扫描": "骨扫描", "骨密度": "骨密度",
+        "心电图": "心电图", "动态心电图": "动态心电图", "holter": "动态心电图", "心脏彩超": "心脏彩超", "超声心动图": "心脏彩超",
+        "脑电图": "脑电图", "肌电图": "肌电图", "肺功能": "肺功能", "胃镜": "胃镜", "肠镜": "肠镜", "结肠镜": "肠镜",
+        "支气管镜": "支气管镜", "喉镜": "喉镜", "膀胱镜": "膀胱镜", "宫腔镜": "宫腔镜", "腹腔镜": "腹腔镜", "内镜": "内镜",
+        "活检": "活检", "病理": "病理", "穿刺": "穿刺", "腰椎穿刺": "腰椎穿刺", "骨髓穿刺": "骨髓穿刺",
+        "触诊": "触诊", "听诊": "听诊", "叩诊": "叩诊", "体格检查": "体格检查", "查体": "体格检查", "视力": "视力",
+        "眼底": "眼底", "测听": "听力", "听力": "听力", "体温": "体温", "血压": "血压", "脉搏": "脉搏", "心率": "心率",
+        "血氧": "血氧",
+    }
+    body_parts = [
+        "头部", "头颅", "颅脑", "脑部", "颈部", "脖子", "甲状腺", "乳腺", "乳房", "胸部", "肺部", "双肺", "心脏", "腹部",
+        "上腹部", "下腹部", "肝脏", "肝胆", "胆囊", "胰腺", "脾脏", "肾脏", "双肾", "输尿管", "膀胱", "前列腺", "子宫", "卵巢",
+        "附件", "阴道", "盆腔", "泌尿系", "肠道", "胃部", "腰椎", "颈椎", "胸椎", "脊柱", "关节", "膝关节", "髋关节", "肩关节",
+        "四肢", "下肢", "上肢", "血管", "淋巴结", "皮肤", "眼部", "耳部", "鼻部", "咽喉", "口腔", "肺", "肝", "肾", "胃",
+    ]
+    suffixes = ["检查", "检测", "扫描", "试验", "测试", "水平", "指标", "化验", "测定"]
+    # what may stand between a body part and its exam
+    max_gap = 4
+    part_exam = re.compile("的?(检查|触诊|扫描)")
+    # asking about exams without naming one, e.g. "告诉我检查结果"
+    generic = re.compile("(医学|相关|哪些|这些|具体的?|以下)检查|检查(结果|项目)")
+    separators = re.compile(r"[，,、。；;？?！!\n()（）：:]|和|及|或|与|还有")
+
+    def __init__(self, extra_terms=()):
+        self.terms = dict(self.exam_terms)
+        for spelling, canonical in extra_terms:
+            self.terms[self.normalize(spelling)] = self.normalize(canonical)
+        self.parts = [self.normalize(part) for part in self.body_parts]
+        self.matcher = AhoCorasick(list(self.terms) + self.parts)
+
+    @classmethod
+    def from_files(cls, paths):
+        extra_terms = []
+        for path in paths or []:
+            with open(path, "r") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if fields[0].strip():
+                        extra_terms.append((fields[0].strip(), (fields[1] if len(fields) > 1 else fields[0]).strip()))
+        return cls(extra_terms)
+
+    @staticmethod
+    def normalize(text):
+        # one character in, one out, positions stay those of the original text
+        return "".join(unicodedata.normalize("NFKC", char).lower()[:1] or " " for char in text)
+
+    def select(self, matches):
+        # leftmost-longest, not overlapping
+        selected, end = [], 0
+        for start, stop, word in sorted(matches, key=lambda match: (match[0], -(match[1] - match[0]))):
+            if start >= end:
+                selected.append((start, stop, word))
+                end = stop
+        return selected
+
+    def extract(self, query):
+        """
+        :return: 病人原文中的检查项目，按出现的顺序
+        """
+        text = self.normalize(query)
+        matches = self.select(self.matcher.find(text))
+        exams, seen, part = [], set(), None
+        for start, stop, word in matches:
+            if word in self.parts and word not in self.terms:
+                # "淋巴结的检查", a body part examined as a whole
+                suffix = self.part_exam.match(text, stop)
+                if suffix is None:
+                    part = (start, word)
+                    continue
+                stop = suffix.end()
+                key = (word, "检查")
+                if key not in seen:
+                    seen.add(key)
+                    exams.append(query[start:stop].strip())
+                part = None
+                continue
+            begin = start
+            if part is not None and start - part[0] - len(part[1]) <= self.max_gap \
+                    and not self.separators.search(text[part[0]:start]):
+                begin = part[0]
+            part = None
+            for suffix in self.suffixes:
+                if text.startswith(suffix, stop):
+                    stop += len(suffix)
+                    break
+            key = (text[begin:start], self.terms[word])
+            if key not in seen:
+                seen.add(key)
+                exams.append(query[begin:stop].strip())
+        return exams
+
+    def asks_for_exam(self, query):
+        # the query talks about exams, though none of the dictionary
+        return bool(ExaminationIndex.exam_words.search(self.generic.sub("", self.normalize(query))))
+
+    @staticmethod
+    def format(exams):
+        return "\n- ".join(["#检查项目#"] + exams)
+
+
+class ExaminationLookups:
+    """
+    Reporter本地查询的命中统计，见report()。
+    """
+    def __init__(self):
+        self.hits = 0
+        self.fallbacks = 0
+        self.misses = 0
+        # ReporterV2: exam names extracted locally / by the LLM / none asked for
+        self.extracted = 0
+        self.extraction_fallbacks = 0
+        self.no_exam = 0
+        self._lock = threading.Lock()
+
+    def record(self, answered, found):
+        # found: the index matched something, but not confidently enough
+        with self._lock:
+            if answered:
+                self.hits += 1
+            elif found:
+                self.fallbacks += 1
+            else:
+                self.misses += 1
+
+    def record_extraction(self, exams, fallback):
+        with self._lock:
+            if exams:
+                self.extracted += 1
+            elif fallback:
+                self.extraction_fallbacks += 1
+            else:
+                self.no_exam += 1
+
+    def report(self):
+        with self._lock:
+            total = self.hits + self.fallbacks + self.misses
+            lines = ["Examination index: {} lookups, {} answered locally ({:.1%}), {} below the threshold and {} not found sent to the LLM".format(
+                total, self.hits, self.hits / total, self.fallbacks, self.misses) if total else "Examination index: no lookup"]
+            extractions = self.extracted + self.extraction_fallbacks + self.no_exam
+            if extractions:
+                lines.append("  exam names: {} requests, {} extracted locally, {} without exams, {} sent to the LLM ({:.1%})".format(
+                    extractions, self.extracted, self.no_exam, self.extraction_fallbacks, self.extraction_fallbacks / extractions))
+        return "\n".join(lines)
+
+
+exam_lookups = ExaminationLookups()
@@ -1,12 +1,23 @@
+import asyncio
+import functools
 import re
 from .base_agent import Agent
-from utils.register import register_class, registry
+from .icd_agreement import ICDAgreement, DEFAULT_ICD_TABLE, agreement_prechecks
+from utils.register import register_class
+from engine import build_engine, StopAfterSection
+from utils.call_context import call_context
+from utils.fan_out import fan_out
 
 
 @register_class(alias="Agent.Host.GPT")
 class Host(Agent):
+    role = "Host"
+    # the summarized diagnosis is complete once its #治疗方案# section is
+    diagnosis_stop = StopAfterSection("治疗方案")
+
     def __init__(self, args, host_info=None):
-        engine = registry.get_class("Engine.GPT")(
+        engine = build_engine(
+            "Engine.GPT",
             openai_api_key=args.host_openai_api_key, 
             openai_api_base=args.host_openai_api_base,
             openai_model_name=args.host_openai_model_name, 
@@ -21,6 +32,8 @@ class Host(Agent):
             self.system_message = \
                 "你是医院的数据库管理员，负责收集、汇总和整理病人的病史和检查数据。\n"
         else: self.system_message = host_info
+        # doctors whose diagnoses have the same ICD-10 codes agree without asking the LLM
+        self.icd_agreement = ICDAgreement(args.host_icd_table, args.host_icd_prefix) if args.host_icd_table else None
 
         super(Host, self).__init__(engine)
 
@@ -34,12 +47,8 @@ class Host(Agent):
         parser.add_argument('--host_top_p', type=float, default=1, help='top p')
         parser.add_argument('--host_frequency_penalty', type=float, default=0, help='frequency penalty')
         parser.add_argument('--host_presence_penalty', type=float, default=0, help='presence penalty')
-
-    def memorize(self, message):
-        self.memories.append(message)
-
-    def forget(self):
-        self.memories = [("system", self.system_message)]
+        parser.add_argument('--host_icd_table', type=str, nargs='?', default=None, const=DEFAULT_ICD_TABLE, help='turn on the local ICD-10 agreement pre-check with this table (.xls, or code<TAB>name per line), the bundled evaluate/ table without a value; off by default, the host LLM decides every round')
+        parser.add_argument('--host_icd_prefix', type=int, default=0, help='compare the ICD-10 codes on this many leading characters, 0 compares the full code; a short prefix such as 3 (the category) lets different diagnoses agree')
 
     def speak(self, content):
         system_message = self.system_message
@@ -51,16 +60,28 @@ class Host(Agent):
         responese = self.engine.get_response(messages)
         return responese
     
-    def summarize_diagnosis(self, doctors, patient):
+    @call_context(stage="summarize_diagnosis")
+    def summarize_diagnosis(self, doctors, session):
+        messages = self.build_summarize_diagnosis_messages(doctors, session)
+        diagnosis = self.engine.get_response(messages, stop=self.diagnosis_stop)
+        return diagnosis
+
+    @call_context(stage="summarize_diagnosis")
+    async def asummarize_diagnosis(self, doctors, session):
+        messages = self.build_summarize_diagnosis_messages(doctors, session)
+        diagnosis = await self.engine.aget_response(messages, stop=self.diagnosis_stop)
+        return diagnosis
+
+    def build_summarize_diagnosis_messages(self, doctors, session):
         # build query message
         int_to_char = {0: "A", 1: "B", 2: "C", 3: "D", 4: "E", 5: "F"}
         diagnosis_by_different_doctors = ""
         for i, doctor in enumerate(doctors):
             diagnosis_by_different_doctors += \
                 "##医生{}##\n\n".format(int_to_char[i]) + \
-                "#诊断结果#\n{}\n\n".format(doctor.get_diagnosis_by_patient_id(patient.id, key="诊断结果")) + \
-                "#诊断依据#\n{}\n\n".format(doctor.get_diagnosis_by_patient_id(patient.id, key="诊断依据")) + \
-                "#治疗方案#\n{}\n\n".format(doctor.get_diagnosis_by_patient_id(patient.id, key="治疗方案")) 
+                "#诊断结果#\n{}\n\n".format(doctor.get_diagnosis(session, key="诊断结果")) + \
+                "#诊断依据#\n{}\n\n".format(doctor.get_diagnosis(session, key="诊断依据")) + \
+                "#治疗方案#\n{}\n\n".format(doctor.get_diagnosis(session, key="治疗方案")) 
         # build system message
         doctor_names = ["##医生{}##".format(int_to_char.get(i)) for i, _ in enumerate(doctors)]
         if len(doctor_names) > 2:
@@ -69,8 +90,8 @@ class Host(Agent):
         system_message = "你是一个资深的#主任医生#。\n" + \
             "你正在主持一场医生针对患者病情的会诊，参与的医生有{}。\n".format(doctor_names) + \
             "病人的基本情况如下：\n#症状#\n{}\n\n#辅助检查#\n{}\n\n".format(
-                doctors[0].get_diagnosis_by_patient_id(patient.id, key="症状"),
-                doctors[0].get_diagnosis_by_patient_id(patient.id, key="辅助检查")
+                doctors[0].get_diagnosis(session, key="症状"),
+                doctors[0].get_diagnosis(session, key="辅助检查")
             ) + \
             "(1) 你需要听取每个医生的诊断报告，其中包含对病人的#诊断结果#、#诊断依据#和#治疗方案#。\n" + \
             "(2) 你需要汇总每个医生的信息，给出对病人的最终诊断。\n\n" + \
@@ -78,34 +99,85 @@ class Host(Agent):
             "#诊断结果#\n(1) xxx\n(2) xxx\n\n" + \
             "#诊断依据#\n(1) xxx\n(2) xxx\n\n" + \
             "#治疗方案#\n(1) xxx\n(2) xxx\n"
-        # run engine
         messages = [{"role": "system", "content": system_message},
             {"role": "user", "content": diagnosis_by_different_doctors}]
-        diagnosis = self.engine.get_response(messages)
-        return diagnosis
+        return messages
 
-    def measure_agreement(self, doctors, patient, discussion_mode="Parallel"):
+    def precheck_agreement(self, doctors, session):
+        # True if the doctors' diagnoses clearly agree by their ICD-10 codes
+        if self.icd_agreement is None:
+            return False
+        outcome = self.icd_agreement.check(doctors, session)
+        agreement_prechecks.record(outcome)
+        return outcome == "agreed"
+
+    @call_context(stage="agreement")
+    def measure_agreement(self, doctors, session, discussion_mode="Parallel"):
         # revise_mode in ["Parallel_with_Critique", "Parallel"]
+        if self.precheck_agreement(doctors, session):
+            return "#结束#"
+        messages = self.build_agreement_messages(doctors, session)
+        judgement = self.engine.get_response(messages)
+        # parse response
+        judgement = self.parse_agreement(judgement, discussion_mode)
+        if judgement is None:
+            messages = self.build_critique_messages(doctors, session)
+            with call_context(stage="critique"):
+                judgement = self.engine.get_response(messages)
+            judgement = re.sub('.*\(a\)', '(a)', judgement, flags=re.DOTALL)
+        return judgement
+
+    @call_context(stage="agreement")
+    async def ameasure_agreement(self, doctors, session, discussion_mode="Parallel"):
+        if self.precheck_agreement(doctors, session):
+            return "#结束#"
+        messages = self.build_agreement_messages(doctors, session)
+        judgement = await self.engine.aget_response(messages)
+        judgement = self.parse_agreement(judgement, discussion_mode)
+        if judgement is None:
+            messages = self.build_critique_messages(doctors, session)
+            with call_context(stage="critique"):
+                judgement = await self.engine.aget_response(messages)
+            judgement = re.sub('.*\(a\)', '(a)', judgement, flags=re.DOTALL)
+        return judgement
+
+    @staticmethod
+    def parse_agreement(judgement, discussion_mode="Parallel"):
+        # return None when the host needs to list the points of contention
+        if "#结束#" in judgement:
+            return "#结束#"
+        elif "#继续#" in judgement:
+            if discussion_mode == "Parallel":
+                return "#继续#"
+            elif discussion_mode == "Parallel_with_Critique":
+                return None
+        else: raise Exception("{}".format(judgement))
+
+    @staticmethod
+    def build_diagnosis_by_different_doctors(doctors, session):
         # build query message
         # int_to_char = {0: "A", 1: "B", 2: "C", 3: "D"}
         diagnosis_by_different_doctors = ""
         for i, doctor in enumerate(doctors):
             diagnosis_by_different_doctors += \
                 "##医生{}##\n\n".format(doctor.name) + \
-                "#诊断结果#\n{}\n\n".format(doctor.get_diagnosis_by_patient_id(patient.id, key="诊断结果")) + \
-                "#诊断依据#\n{}\n\n".format(doctor.get_diagnosis_by_patient_id(patient.id, key="诊断依据")) + \
-                "#治疗方案#\n{}\n\n".format(doctor.get_diagnosis_by_patient_id(patient.id, key="治疗方案")) 
+                "#诊断结果#\n{}\n\n".format(doctor.get_diagnosis(session, key="诊断结果")) + \
+                "#诊断依据#\n{}\n\n".format(doctor.get_diagnosis(session, key="诊断依据")) + \
+                "#治疗方案#\n{}\n\n".format(doctor.get_diagnosis(session, key="治疗方案")) 
         # build system message
         doctor_names = ["##医生{}##".format(doctor.name) for i, doctor in enumerate(doctors)]
         if len(doctor_names) > 2:
             doctor_names = "、".join(doctor_names[:-2]) + "、" + doctor_names[-2] + "和" + doctor_names[-1]        
         else: doctor_names = doctor_names[0] + "和" + doctor_names[1] 
+        return diagnosis_by_different_doctors, doctor_names
 
+    def build_agreement_messages(self, doctors, session):
+        diagnosis_by_different_doctors, doctor_names = self.build_diagnosis_by_different_doctors(doctors, session)
         system_message = "你是一个资深的主任医生。\n" + \
             "你正在主持一场医生针对患者病情的会诊，参与的医生有{}。\n".format(doctor_names) + \
             "病人的基本情况如下：\n#症状#\n{}\n\n#辅助检查#\n{}\n\n".format(
-                doctors[0].get_diagnosis_by_patient_id(patient.id, key="症状"),
-                doctors[0].get_diagnosis_by_patient_id(patient.id, key="辅助检查")
+                doctors[0].get_diagnosis(session, key="症状"),
+                doctors[0].get_diagnosis(session, key="辅助检查")
             )
         system_message += "你需要听取每个医生的诊断报告，其中包含对病人的#诊断结果#、#诊断依据#和#治疗方案#。\n\n" + \
             "请你按照下面的格式来进行输出。\n" + \
@@ -113,45 +185,80 @@ class Host(Agent):
             "#结束#\n\n" + \
             "(2) 如果医生之间没有达成一致，请你输出：\n" + \
             "#继续#"
-        # run engine
         messages = [{"role": "system", "content": system_message},
             {"role": "user", "content": diagnosis_by_different_doctors}]
-        judgement = self.engine.get_response(messages)
-        # parse response
-        if "#结束#" in judgement:
-            judgement = "#结束#"
-            return judgement
-        elif "#继续#" in judgement:
-            if discussion_mode == "Parallel":
-                judgement = "#继续#"
-                return judgement
-            elif discussion_mode == "Parallel_with_Critique":
-                system_message = "你是一个资深的主任医生。\n" + \
-                    "你正在主持一场医生针对患者病情的会诊，参与的医生有{}。\n".format(doctor_names) + \
-                    "病人的基本情况如下：\n#症状#\n{}\n\n#辅助检查#\n{}\n\n".format(
-                        doctors[0].get_diagnosis_by_patient_id(patient.id, key="症状"),
-                        doctors[0].get_diagnosis_by_patient_id(patient.id, key="辅助检查")
-                    )
-                system_message += "(1) 你需要听取每个医生的诊断报告，其中包含对病人的#诊断结果#、#诊断依据#和#治疗方案#。\n" + \
-                    "(2) 请你按照重要性列出最多3个需要讨论的争议点，按照下面的格式输出：\n" + \
-                    "(a) xxx\n" + \
-                    "(b) xxx\n"
-                messages = [{"role": "system", "content": system_message},
-                    {"role": "user", "content": diagnosis_by_different_doctors}]
-                judgement = self.engine.get_response(messages)
-                judgement = re.sub('.*\(a\)', '(a)', judgement, flags=re.DOTALL)
-                return judgement
-        else: raise Exception("{}".format(judgement))
+        return messages
+
+    def build_critique_messages(self, doctors, session):
+        diagnosis_by_different_doctors, doctor_names = self.build_diagnosis_by_different_doctors(doctors, session)
+        system_message = "你是一个资深的主任医生。\n" + \
+            "你正在主持一场医生针对患者病情的会诊，参与的医生有{}。\n".format(doctor_names) + \
+            "病人的基本情况如下：\n#症状#\n{}\n\n#辅助检查#\n{}\n\n".format(
+                doctors[0].get_diagnosis(session, key="症状"),
+                doctors[0].get_diagnosis(session, key="辅助检查")
+            )
+        system_message += "(1) 你需要听取每个医生的诊断报告，其中包含对病人的#诊断结果#、#诊断依据#和#治疗方案#。\n" + \
+            "(2) 请你按照重要性列出最多3个需要讨论的争议点，按照下面的格式输出：\n" + \
+            "(a) xxx\n" + \
+            "(b) xxx\n"
+        messages = [{"role": "system", "content": system_message},
+            {"role": "user", "content": diagnosis_by_different_doctors}]
+        return messages
         
-    def summarize_symptom_and_examination(self, doctors, patient, reporter):
+    @call_context(stage="summarize_symptom_and_examination")
+    def summarize_symptom_and_examination(self, doctors, session, reporter):
         ## host summarizes the symptom and examination from different doctors
+        messages = self.build_symptom_and_examination_messages(doctors, session)
+        responese = self.engine.get_response(messages)
+        structure_result = self.parse_symptom_and_examination(responese)
+        if structure_result.get("query_to_patient") is None and \
+                structure_result.get("query_to_reporter") is None:
+            return structure_result.get("symptom_and_examination")
+        ## host asks patient and reporter to edit the symptom and examination 
+        # if some misalignments exist among different doctos
+        # the two queries are independent and asked at the same time
+        queries = {}
+        if structure_result.get("query_to_patient") is not None:
+            # role, content, save_to_memory=True
+            queries["patient_response"] = functools.partial(
+                session.patient.speak, role="医生", content=structure_result.get("query_to_patient"), session=session, save_to_memory=False)
+        if structure_result.get("query_to_reporter") is not None:
+            queries["reporter_response"] = functools.partial(
+                reporter.speak, session.patient.medical_records, structure_result.get("query_to_reporter"), save_to_memory=False,
+                exam_index=session.patient.exam_index)
+        structure_result.update(zip(queries, fan_out(queries.values())))
+        # edit the symptom and examination accoring to the response from patient and reporter
+        symptom_and_examination = self.edit_symptom_and_examination(structure_result)
+        return symptom_and_examination
+
+    @call_context(stage="summarize_symptom_and_examination")
+    async def asummarize_symptom_and_examination(self, doctors, session, reporter):
+        messages = self.build_symptom_and_examination_messages(doctors, session)
+        responese = await self.engine.aget_response(messages)
+        structure_result = self.parse_symptom_and_examination(responese)
+        if structure_result.get("query_to_patient") is None and \
+                structure_result.get("query_to_reporter") is None:
+            return structure_result.get("symptom_and_examination")
+        queries = {}
+        if structure_result.get("query_to_patient") is not None:
+            queries["patient_response"] = session.patient.aspeak(
+                role="医生", content=structure_result.get("query_to_patient"), session=session, save_to_memory=False)
+        if structure_result.get("query_to_reporter") is not None:
+            queries["reporter_response"] = reporter.aspeak(
+                session.patient.medical_records, structure_result.get("query_to_reporter"), save_to_memory=False,
+                exam_index=session.patient.exam_index)
+        structure_result.update(zip(queries, await asyncio.gather(*queries.values())))
+        symptom_and_examination = await self.aedit_symptom_and_examination(structure_result)
+        return symptom_and_examination
+
+    def build_symptom_and_examination_messages(self, doctors, session):
         # build query message
         int_to_char = {0: "A", 1: "B", 2: "C", 3: "D"}
         symptom_and_examination_by_diff_doctors = ""
         for i, doctor in enumerate(doctors):
             symptom_and_examination_by_diff_doctors += "##医生{}##\n".format(int_to_char[i])
             for key in ["症状", "辅助检查"]:
-                value = doctor.get_diagnosis_by_patient_id(patient.id, key=key)
+                value = doctor.get_diagnosis(session, key=key)
                 if value is not None:
                     symptom_and_examination_by_diff_doctors += "#{}#\n{}\n\n".format(key, value)
 
@@ -187,23 +294,7 @@ class Host(Agent):
             # },
             {"role": "user", "content": "{}".format(symptom_and_examination_by_diff_doctors)},
         ]
-        responese = self.engine.get_response(messages)
-        structure_result = self.parse_symptom_and_examination(responese)
-        if structure_result.get("query_to_patient") is None and \
-                structure_result.get("query_to_reporter") is None:
-            return structure_result.get("symptom_and_examination")
-        ## host asks patient and reporter to edit the symptom and examination 
-        # if some misalignments exist among different doctos
-        if structure_result.get("query_to_patient") is not None:
-            # role, content, save_to_memory=True
-            structure_result["patient_response"] = patient.speak(
-                role="医生", content=structure_result.get("query_to_patient"), save_to_memory=False)
-        if structure_result.get("query_to_reporter") is not None:
-            structure_result["reporter_response"] = reporter.speak(
-                patient.medical_records, structure_result.get("query_to_reporter"), save_to_memory=False)
-        # edit the symptom and examination accoring to the response from patient and reporter
-        symptom_and_examination = self.edit_symptom_and_examination(structure_result)
-        return symptom_and_examination
+        return messages
     
     def parse_symptom_and_examination(self, response):
         values = {}
@@ -240,7 +331,19 @@ class Host(Agent):
         }
         return structure_result
 
+    @call_context(stage="edit_symptom_and_examination")
     def edit_symptom_and_examination(self, structure_result):
+        messages = self.build_edit_symptom_and_examination_messages(structure_result)
+        symptom_and_examination = self.engine.get_response(messages)
+        return symptom_and_examination
+
+    @call_context(stage="edit_symptom_and_examination")
+    async def aedit_symptom_and_examination(self, structure_result):
+        messages = self.build_edit_symptom_and_examination_messages(structure_result)
+        symptom_and_examination = await self.engine.aget_response(messages)
+        return symptom_and_examination
+
+    def build_edit_symptom_and_examination_messages(self, structure_result):
         # build system message for different situations
         if structure_result.get("query_to_patient") is not None and structure_result.get("query_to_doctor") is not None:
             system_message = "你是一个资深的主任医生。\n" + \
@@ -263,8 +366,6 @@ class Host(Agent):
         if structure_result.get("query_to_reporter") is not None:
             content += "##询问检查员##\n#问题#\n{}\n#回答#\n{}".format(
                 structure_result.get("query_to_repoter"), structure_result["reporter_response"])
-        # run engine
         messages = [{"role": "system", "content": system_message},
             {"role": "user", "content": content}]
-        symptom_and_examination = self.engine.get_response(messages)
-        return symptom_and_examination
+        return messages
@@ -0,0 +1,177 @@
+import os
+import re
+import threading
+import unicodedata
+
+
+DEFAULT_ICD_TABLE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "evaluate", "国际疾病分类ICD-10北京临床版v601.xls")
+
+
+class ICDTable:
+    """
+    ICD-10疾病名 -> 编码，从evaluate/下的ICD-10北京临床版(.xls，第一列编码、第二列名称)载入，
+    也可以是导出的"编码\\t名称"文本文件。同一个名称取表中第一次出现的编码(类目在亚目之前)。
+    """
+    _tables = {}
+    _lock = threading.Lock()
+
+    def __init__(self, rows):
+        self.codes = {}
+        for code, name in rows:
+            code, name = str(code).strip(), str(name).strip()
+            if not code or not name:
+                continue
+            for variant in (name, re.sub(r"\(.*?\)", "", name)):
+                variant = self.normalize(variant)
+                if len(variant) >= 2:
+                    self.codes.setdefault(variant, code)
+        self.max_length = max((len(name) for name in self.codes), default=0)
+
+    @staticmethod
+    def normalize(text):
+        text = unicodedata.normalize("NFKC", text).lower()
+        return re.sub(r"\s+", "", text)
+
+    @staticmethod
+    def read_rows(path):
+        if path.endswith(".xls") or path.endswith(".xlsx"):
+            import xlrd
+            sheet = xlrd.open_workbook(path).sheet_by_index(0)
+            return zip(sheet.col_values(colx=0, start_rowx=1), sheet.col_values(colx=1, start_rowx=1))
+        with open(path, "r") as f:
+            return [line.rstrip("\n").split("\t")[:2] for line in f if "\t" in line]
+
+    @classmethod
+    def load(cls, path):
+        # one table per path for the whole process, None for the bundled table without xlrd
+        with cls._lock:
+            if path not in cls._tables:
+                try:
+                    cls._tables[path] = cls(cls.read_rows(path))
+                except ImportError as e:
+                    # a table given on the command line has to be read, otherwise the run stops here
+                    if path != DEFAULT_ICD_TABLE:
+                        raise
+                    print("WARNING: the bundled ICD table needs xlrd, the agreement pre-check is off: {!r}".format(e))
+                    cls._tables[path] = None
+            return cls._tables[path]
+
+    def match(self, text):
+        """
+        :return: (codes, covered)，最左最长匹配到的编码，以及被疾病名覆盖的字符数
+        """
+        codes, covered, i = [], 0, 0
+        while i < len(text):
+            for j in range(min(len(text), i + self.max_length), i + 1, -1):
+                code = self.codes.get(text[i:j])
+                if code is not None:
+                    codes.append(code)
+                    covered += j - i
+                    i = j
+                    break
+            else:
+                i += 1
+        return codes, covered
+
+
+class ICDAgreement:
+    """
+    Host判断医生是否达成一致之前的本地预检：把每个医生#诊断结果#中的每一条诊断映射到ICD-10编码，
+    所有诊断都能被疾病名覆盖(coverage)，各医生的编码集合(默认比较完整编码，prefix>0时只比较前prefix位)以及各诊断的侧别(左/右/双)都完全相同时，
+    直接判定#结束#；编码或侧别不同、有诊断无法编码时，仍由Host的LLM判断。
+    """
+    splitter = re.compile(r"\n|[；;，,、。]|\(\d+\)|\d+[\.、)）]|合并|伴有|伴")
+    # said around a diagnosis, the same for every doctor
+    fillers = re.compile(r"初步诊断|诊断为|诊断|考虑为|考虑|可能性大|可能是|可能|疑似|[?？:：\-\s]")
+    # e.g. "(极高危)", but not the numbering "(1)"
+    remarks = re.compile(r"\((?!\d+\))[^)]*\)")
+    # written differently from the table
+    aliases = [("综合症", "综合征"), ("冠心病", "冠状动脉粥样硬化性心脏病"), ("慢阻肺", "慢性阻塞性肺疾病"), ("高血压病", "高血压")]
+    # not part of the table names, compared on its own
+    side = re.compile("^(左|右|双)侧?")
+    # a diagnosis that is ruled in or out later is not clear
+    uncertain = re.compile("待排|待查|除外|排除|不详|未明|不明确|无法")
+    coverage = 0.8
+
+    def __init__(self, table_path, prefix=0):
+        self.table_path = table_path
+        self.prefix = prefix
+        # read when the host is built, a bad table fails the run before the first patient
+        ICDTable.load(table_path)
+
+    @property
+    def table(self):
+        return ICDTable.load(self.table_path)
+
+    def items(self, diagnosis):
+        # split before the whitespace is dropped, one diagnosis per line
+        text = self.remarks.sub("", unicodedata.normalize("NFKC", diagnosis or "").lower())
+        items = []
+        for part in self.splitter.split(text):
+            item = self.fillers.sub("", ICDTable.normalize(part))
+            for alias, name in self.aliases:
+                item = item.replace(alias, name)
+            if item:
+                items.append(item)
+        return items
+
+    def code(self, diagnosis):
+        """
+        :return: (codes, sides)，所有诊断的编码，以及有侧别的诊断的 (编码, 侧别)；有诊断无法明确编码时返回None
+        """
+        table = self.table
+        items = self.items(diagnosis)
+        if table is None or not items:
+            return None
+        codes, sides = set(), set()
+        for item in items:
+            if self.uncertain.search(item):
+                return None
+            side = self.side.match(item)
+            if side is not None:
+                item = item[side.end():]
+            item_codes, covered = table.match(item)
+            if not item_codes or covered < self.coverage * len(item):
+                return None
+            item_codes = [code[:self.prefix] if self.prefix else code for code in item_codes]
+            codes.update(item_codes)
+            if side is not None:
+                sides.update((code, side.group(1)) for code in item_codes)
+        return frozenset(codes), frozenset(sides)
+
+    def check(self, doctors, session):
+        """
+        :return: "agreed"、"different"或"not_coded"，只有"agreed"时跳过LLM
+        """
+        code_sets = []
+        for doctor in doctors:
+            coded = self.code(doctor.get_diagnosis(session, key="诊断结果"))
+            if coded is None:
+                return "not_coded"
+            code_sets.append(coded)
+        return "agreed" if all(codes == code_sets[0] for codes in code_sets) else "different"
+
+
+class AgreementPrechecks:
+    """
+    ICD预检的统计：多少轮讨论在本地判定结束、省掉了Host的LLM调用，由run.py在运行结束时打印。
+    """
+    def __init__(self):
+        self.outcomes = {"agreed": 0, "different": 0, "not_coded": 0}
+        self._lock = threading.Lock()
+
+    def record(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def report(self):
+        with self._lock:
+            total = sum(self.outcomes.values())
+            if not total:
+                return "Agreement pre-check: no round"
+            return "Agreement pre-check: {} rounds, {} agreed by ICD-10 codes and skipped the host LLM ({:.1%}), {} with different codes and {} not coded sent to the LLM".format(
+                total, self.outcomes["agreed"], self.outcomes["agreed"] / total, self.outcomes["different"], self.outcomes["not_coded"])
+
+
+agreement_prechecks = AgreementPrechecks()
@@ -1,11 +1,18 @@
 from .base_agent import Agent
-from utils.register import register_class, registry
+from .exam_index import ExaminationIndex
+from utils.register import register_class
+from engine import build_engine, StopOnMarker
 
 
 @register_class(alias="Agent.Patient.GPT")
 class Patient(Agent):
+    role = "Patient"
+    # the patient ends the dialog with <结束>, nothing after it is used
+    stop = StopOnMarker("<结束>")
+
     def __init__(self, args, patient_profile, medical_records, patient_id=0):
-        engine = registry.get_class("Engine.GPT")(
+        engine = build_engine(
+            "Engine.GPT",
             openai_api_key=args.patient_openai_api_key, 
             openai_api_base=args.patient_openai_api_base,
             openai_model_name=args.patient_openai_model_name, 
@@ -40,6 +47,8 @@ class Patient(Agent):
         super(Patient, self).__init__(engine)
         self.id = patient_id
         self.medical_records = medical_records
+        # the Reporter looks exam results up here before asking its LLM
+        self.exam_index = ExaminationIndex(medical_records)
 
     @staticmethod
     def add_parser_args(parser):
@@ -53,17 +62,41 @@ class Patient(Agent):
         parser.add_argument('--patient_frequency_penalty', type=float, default=0, help='frequency penalty')
         parser.add_argument('--patient_presence_penalty', type=float, default=0, help='presence penalty')
 
-    def speak(self, role, content, save_to_memory=True):
-        messages = [{"role": memory[0], "content": memory[1]} for memory in self.memories]
-        messages.append({"role": "user", "content": f"<{role}> {content}"})
+    def recall(self, utterance, key):
+        memory = super(Patient, self).recall(utterance, key)
+        if memory is not None and memory[0] == "user":
+            # the patient is told who is talking
+            return ("user", f"<{utterance.role}> {utterance.content}")
+        return memory
+
+    def speak(self, role, content, session, save_to_memory=True):
+        messages = self.build_messages(role, content, session, save_to_memory)
 
-        responese = self.engine.get_response(messages)
+        responese = self.engine.get_response(messages, stop=self.stop)
         
         if save_to_memory:
-            self.memorize(("user", f"<{role}> {content}"))
-            self.memorize(("assistant", responese))
+            session.say(self, responese)
+
+        return responese
+
+    async def aspeak(self, role, content, session, save_to_memory=True):
+        messages = self.build_messages(role, content, session, save_to_memory)
+
+        responese = await self.engine.aget_response(messages, stop=self.stop)
+
+        if save_to_memory:
+            session.say(self, responese)
 
         return responese
+
+    def build_messages(self, role, content, session, save_to_memory=True):
+        if save_to_memory:
+            # usually the doctor's latest utterance, which the patient now hears too
+            session.hear(self, role, content)
+            return session.view(self).messages()
+        messages = session.view(self).messages()
+        messages.append(self.format_message("user", f"<{role}> {content}"))
+        return messages
     
     @staticmethod
     def parse_role_content(responese):
@@ -1,12 +1,17 @@
 import re
 from .base_agent import Agent
-from utils.register import register_class, registry
+from .exam_index import ExaminationIndex, ExamTermExtractor, exam_lookups
+from utils.register import register_class
+from engine import build_engine
 
 
 @register_class(alias="Agent.Reporter.GPT")
 class Reporter(Agent):
+    role = "Reporter"
+
     def __init__(self, args, reporter_info=None):
-        engine = registry.get_class("Engine.GPT")(
+        engine = build_engine(
+            "Engine.GPT",
             openai_api_key=args.reporter_openai_api_key, 
             openai_api_base=args.reporter_openai_api_base,
             openai_model_name=args.reporter_openai_model_name, 
@@ -22,6 +27,7 @@ class Reporter(Agent):
             self.system_message = \
                 "你是医院的数据库管理员，负责收集、汇总和整理病人的病史和检查数据。\n"
         else: self.system_message = reporter_info
+        self.index_threshold = args.reporter_index_threshold
         
         super(Reporter, self).__init__(engine)
 
@@ -36,8 +42,36 @@ class Reporter(Agent):
         parser.add_argument('--reporter_top_p', type=float, default=1, help='top p')
         parser.add_argument('--reporter_frequency_penalty', type=float, default=0, help='frequency penalty')
         parser.add_argument('--reporter_presence_penalty', type=float, default=0, help='presence penalty')
+        parser.add_argument('--reporter_index_threshold', type=float, default=0.8, help='answer from the local examination index at or above this confidence, above 1 always asks the LLM')
+
+    def lookup(self, medical_records, content, exam_index=None):
+        # the answer of the local examination index, None if the LLM has to answer
+        if self.index_threshold > 1:
+            return None
+        if exam_index is None:
+            exam_index = ExaminationIndex(medical_records)
+        response, confidence = exam_index.answer(content)
+        answered = response is not None and confidence >= self.index_threshold
+        exam_lookups.record(answered, response is not None)
+        return response if answered else None
+
+    def speak(self, medical_records, content, save_to_memory=False, exam_index=None):
+        responese = self.lookup(medical_records, content, exam_index)
+        if responese is not None:
+            return responese
+        messages = self.build_messages(medical_records, content)
+        responese = self.engine.get_response(messages)
+        return responese
+
+    async def aspeak(self, medical_records, content, save_to_memory=False, exam_index=None):
+        responese = self.lookup(medical_records, content, exam_index)
+        if responese is not None:
+            return responese
+        messages = self.build_messages(medical_records, content)
+        responese = await self.engine.aget_response(messages)
+        return responese
 
-    def speak(self, medical_records, content, save_to_memory=False):
+    def build_messages(self, medical_records, content):
         system_message = self.system_message + '\n\n' + \
             "这是你收到的病人的检查结果。\n" + \
             f"#查体#\n{medical_records['查体'].strip()}\n" + \
@@ -46,16 +80,14 @@ class Reporter(Agent):
             "#检查项目#\n- xxx: xxx\n- xxx: xxx\n#xx检查#\n- xxx: xxx\n- xxx: xxx\n\n" + \
             "如果无法查询到对应的检查项目则回复：\n" + \
             "- xxx: 无异常"
-        
+
         messages = [
             {"role": "system", "content": system_message},
             {"role": "user", "content": "您好，我需要做基因组测序，能否告诉我这些检查结果？"},
             {"role": "assistant", "content": "#检查项目#\n- 基因组测序"},
             {"role": "user", "content": content}
         ]
-        
-        responese = self.engine.get_response(messages)
-        return responese
+        return messages
     
     @staticmethod
     def parse_content(response):
@@ -66,43 +98,41 @@ class Reporter(Agent):
 
 
 @register_class(alias="Agent.Reporter.GPTV2")
-class ReporterV2(Agent):
-    def __init__(self, args, reporter_info=None):
-        engine = registry.get_class("Engine.GPTV2")(
-            openai_api_key=args.reporter_openai_api_key, 
-            openai_api_base=args.reporter_openai_api_base,
-            openai_model_name=args.reporter_openai_model_name, 
-            temperature=args.reporter_temperature, 
-            max_tokens=args.reporter_max_tokens,
-            top_p=args.reporter_top_p,
-            frequency_penalty=args.reporter_frequency_penalty,
-            presence_penalty=args.reporter_presence_penalty
-        )
+class ReporterV2(Reporter):
+    role = "Reporter"
 
-        self.edit_query = True
-        if reporter_info is None:
-            self.system_message = \
-                "你是医院的数据库管理员，负责收集、汇总和整理病人的病史和检查数据。\n"
-        else: self.system_message = reporter_info
-        
-        super(Reporter, self).__init__(engine)
+    def __init__(self, args, reporter_info=None):
+        super(ReporterV2, self).__init__(args, reporter_info)
+        self.exam_extractor = ExamTermExtractor.from_files(args.reporter_exam_terms)
 
     @staticmethod
     def add_parser_args(parser):
-        # group = parser.add_argument_group('Agent.Reporter.GPT Arguments')
-        parser.add_argument('--reporter_openai_api_key', type=str, help='API key for OpenAI')
-        parser.add_argument('--reporter_openai_api_base', type=str, help='API base for OpenAI')
-        parser.add_argument('--reporter_openai_model_name', type=str, help='API model name for OpenAI')
-        parser.add_argument('--reporter_temperature', type=float, default=0.0, help='temperature')
-        parser.add_argument('--reporter_max_tokens', type=int, default=2048, help='max tokens')
-        parser.add_argument('--reporter_top_p', type=float, default=1, help='top p')
-        parser.add_argument('--reporter_frequency_penalty', type=float, default=0, help='frequency penalty')
-        parser.add_argument('--reporter_presence_penalty', type=float, default=0, help='presence penalty')
+        Reporter.add_parser_args(parser)
+        parser.add_argument('--reporter_exam_terms', type=str, nargs="*", default=[], help='extra exam term files for the local extractor, one "term" or "term<TAB>canonical name" per line')
 
-    def speak(self, medical_records, content, save_to_memory=False):
-        
+    def speak(self, medical_records, content, save_to_memory=False, exam_index=None):
         examination_query = self.parse_examination_queries(content)
+        if examination_query is None:
+            examination_query = content
+        responese = self.lookup(medical_records, examination_query, exam_index)
+        if responese is not None:
+            return responese
+        messages = self.build_messages(medical_records, examination_query)
+        responese = self.engine.get_response(messages)
+        return responese
+
+    async def aspeak(self, medical_records, content, save_to_memory=False, exam_index=None):
+        examination_query = await self.aparse_examination_queries(content)
+        if examination_query is None:
+            examination_query = content
+        responese = self.lookup(medical_records, examination_query, exam_index)
+        if responese is not None:
+            return responese
+        messages = self.build_messages(medical_records, examination_query)
+        responese = await self.engine.aget_response(messages)
+        return responese
 
+    def build_messages(self, medical_records, content):
         system_message = self.system_message + '\n\n' + \
             "这是你收到的病人的检查结果。\n" + \
             f"#查体#\n{medical_records['查体'].strip()}\n" + \
@@ -111,15 +141,45 @@ class ReporterV2(Agent):
             "#检查项目#\n- xxx: xxx\n- xxx: xxx\n#xx检查#\n- xxx: xxx\n- xxx: xxx\n\n" + \
             "如果无法查询到对应的检查项目则回复：\n" + \
             "- xxx: 无异常"
-        
+
         messages = [{"role": "system", "content": system_message},
                     {"role": "user", "content": "#检查项目#\n- 基因组测序"},
                     {"role": "assistant", "content": "#检查项目#\n-基因组测序: 无异常"},
-                    {"role": "user", "content": examination_query}]
-        responese = self.engine.get_response(messages)
-        return responese
-    
+                    {"role": "user", "content": content}]
+        return messages
+
+    def local_parse_examination_queries(self, query):
+        """
+        :return: (examination_query, fallback)，本地词典提取到的检查项目，以及是否需要交给LLM解析
+        """
+        # the exams named in the query from the local dictionary, the LLM only for queries about exams it does not know
+        exams = self.exam_extractor.extract(query)
+        fallback = not exams and self.exam_extractor.asks_for_exam(query)
+        exam_lookups.record_extraction(exams, fallback)
+        return (self.exam_extractor.format(exams) if exams else None), fallback
+
     def parse_examination_queries(self, query):
+        examination_query, fallback = self.local_parse_examination_queries(query)
+        if fallback:
+            return self.llm_parse_examination_queries(query)
+        return examination_query
+
+    async def aparse_examination_queries(self, query):
+        examination_query, fallback = self.local_parse_examination_queries(query)
+        if fallback:
+            return await self.allm_parse_examination_queries(query)
+        return examination_query
+
+    def llm_parse_examination_queries(self, query):
+        response = self.engine.get_response(self.build_examination_query_messages(query))
+        return self.parse_examination_query_response(response)
+
+    async def allm_parse_examination_queries(self, query):
+        response = await self.engine.aget_response(self.build_examination_query_messages(query))
+        return self.parse_examination_query_response(response)
+
+    @staticmethod
+    def build_examination_query_messages(query):
         system_message = "你是医院负责检查的自动化接待员。请你利用掌握的医学检查的命名实体的知识，从病人的检查申请当中解析出指向明确的专业医学检查项目，方便后面的检查科室进行检查。\n\n请按照下面的格式的输出：\n#检查项目#\n- xxx\n- xxx\n\n如果没有找到具体的医学检查项目，请输出：\n#检查项目#\n- 无"
         messages=[
             {"role": "system", "content": system_message},
@@ -145,8 +205,10 @@ class ReporterV2(Agent):
             {"role": "assistant", "content": "#检查项目#\n- 尿妊娠试验\n- 血常规检查\n- 阴道超声检查"}, # 
             {"role": "user", "content": query},
         ]
-        
-        response = self.get_response(messages)
+        return messages
+
+    @staticmethod
+    def parse_examination_query_response(response):
         if "#检查项目#" not in response:
             return None
         for message in response.split("\n"):
@@ -1,21 +1,67 @@
-# 注册不同的Engine
+# 注册不同的Engine，各Engine模块在第一次通过registry取用时才导入
+from utils.register import register_lazy_modules, lazy_getattr
 from .base_engine import Engine
-from .gpt import GPTEngine
-from .chatglm import ChatGLMEngine
-from .minimax import MiniMaxEngine
-from .wenxin import WenXinEngine
-from .qwen import QwenEngine
-from .huatuogpt import HuatuoGPTEngine
-from .hf import HFEngine
+from .cache import ResponseCache, response_cache
+from .pool import EnginePool, engine_pool, build_engine
+from .rate_limit import EngineError, ProviderError, RateLimiter, rate_limiters
+from .streaming import StopCondition, StopOnMarker, StopAfterSection
+from .usage import UsageTracker, usage_tracker
+from .hedging import Hedging, RequestTimeout, hedging
+from .single_flight import SingleFlight, single_flight
+from .concurrency import ConcurrencyGovernor, concurrency_governor
+from .context_window import ContextWindows, context_windows
+from .batch import BatchBackend, OpenAIBatchBackend, LocalBatchBackend, BatchJob, build_batch_backend
+
+
+_class_to_module = register_lazy_modules(__name__, {
+    ".gpt": {"GPTEngine": "Engine.GPT"},
+    ".chatglm": {"ChatGLMEngine": "Engine.ChatGLM"},
+    ".minimax": {"MiniMaxEngine": "Engine.MiniMax"},
+    ".wenxin": {"WenXinEngine": "Engine.WenXin"},
+    ".qwen": {"QwenEngine": "Engine.Qwen"},
+    ".huatuogpt": {"HuatuoGPTEngine": "Engine.HuatuoGPT"},
+    ".hf": {"HFEngine": "Engine.HF"},
+    ".replay": {"ReplayEngine": "Engine.Replay"},
+})
+__getattr__ = lazy_getattr(__name__, _class_to_module)
 
 
 __all__ = [
     "Engine",
+    "ResponseCache",
+    "response_cache",
+    "EnginePool",
+    "engine_pool",
+    "build_engine",
+    "EngineError",
+    "ProviderError",
+    "RateLimiter",
+    "rate_limiters",
+    "StopCondition",
+    "StopOnMarker",
+    "StopAfterSection",
+    "UsageTracker",
+    "usage_tracker",
+    "Hedging",
+    "RequestTimeout",
+    "hedging",
+    "SingleFlight",
+    "single_flight",
+    "ConcurrencyGovernor",
+    "concurrency_governor",
+    "ContextWindows",
+    "context_windows",
+    "BatchBackend",
+    "OpenAIBatchBackend",
+    "LocalBatchBackend",
+    "BatchJob",
+    "build_batch_backend",
     "GPTEngine",
     "ChatGLMEngine",
     "MiniMaxEngine",
     "WenXinEngine",
     "QwenEngine",
     "HuatuoGPTEngine",
-    "HFEngine"
+    "HFEngine",
+    "ReplayEngine"
 ]
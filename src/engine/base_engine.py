@@ -1,16 +1,453 @@
+import asyncio
+import contextlib
+import time
 from abc import abstractmethod
 from utils.register import register_class
+from .cache import response_cache
+from .rate_limit import rate_limiters, parse_retry_after, EngineError, ProviderError
+from .http_session import http_sessions
+from .pool import engine_pool
+from .usage import usage_tracker, report_retry
+from .hedging import hedging
+from .single_flight import single_flight
+from .concurrency import concurrency_governor
+from .context_window import context_windows
 
 
 @register_class(alias="Engine.Base")
 class Engine:
+    # attributes that decide the response together with the messages, they are part of the cache key
+    cache_params = ("model_name",)
+    # engines of the same provider share one rate limiter
+    provider = "base"
+    # engines implementing generate_stream / a native agenerate_stream
+    supports_streaming = False
+    supports_async_streaming = False
+    # --stream_responses: stream the calls that carry a stop condition and cancel them once it fires
+    stream_responses = False
+    # dynamic batching in front of local models, a batch size of 1 disables it
+    local_batch_size = 8
+    local_batch_wait_ms = 10.0
+    # per-session KV cache of local models, disabled if None
+    local_kv_cache_mb = None
+    # --hedge_api_base
+    hedge_api_base = None
+    # whether a call can be abandoned on a timeout, and duplicated by a hedged request
+    supports_timeouts = True
+    supports_hedging = True
+
     def __init__(self):
         pass
 
     @staticmethod
     def add_parser_args(parser):
+        # process-wide options shared by every engine
+        parser.add_argument("--engine_override", default=None, type=str, help="registry name of an engine that serves every agent, e.g. Engine.Replay")
+        parser.add_argument("--llm_cache_path", default=None, type=str, help="sqlite file of the response cache, disabled if not given")
+        parser.add_argument("--llm_cache_ttl", default=None, type=float, help="seconds before a cached response expires")
+        parser.add_argument("--llm_cache_max_entries", default=None, type=int, help="max cached responses, least recently used are evicted")
+        parser.add_argument("--llm_cache_max_mb", default=None, type=float, help="max size of cached responses in MB")
+        parser.add_argument("--llm_cache_bypass", default=False, action="store_true", help="skip cache lookups but still refresh the cache")
+        parser.add_argument("--context_policy", default="none", type=str, choices=["none", "drop_middle", "summarize"], help="how a prompt over the model's context window is compacted: drop the middle turns or summarize them, keeping the system prompt and the recent turns; none only picks a model with a large enough window")
+        parser.add_argument("--context_budget", default=None, type=int, help="max prompt + completion tokens before a prompt is compacted, the model's context window if not given")
+        parser.add_argument("--context_windows", default=[], type=str, nargs="*", help="context windows of models not known yet as model:tokens, e.g. qwen-plus-gamma:32000")
+        parser.add_argument("--context_log_path", default=None, type=str, help="jsonl log of every compacted prompt with its patient, role and token counts")
+        parser.add_argument("--max_in_flight", default=[], type=str, nargs="*", help="process-wide limits of in-flight requests shared by all agents, as provider:N or provider/model:N, e.g. openai:32 openai/gpt-4:8")
+        parser.add_argument("--disable_coalescing", default=False, action="store_true", help="send identical concurrent deterministic requests separately instead of sharing the first response")
+        parser.add_argument("--stream_responses", default=False, action="store_true", help="stream responses and stop generating once the agent's stop condition fires")
+        parser.add_argument("--local_batch_size", default=8, type=int, help="max concurrent requests a local model generates in one batch, 1 disables batching")
+        parser.add_argument("--local_batch_wait_ms", default=10.0, type=float, help="how long a local model waits for more requests before generating a batch")
+        parser.add_argument("--local_kv_cache_mb", default=None, type=float, help="memory for reusing a local model's KV cache across dialog turns, disabled if not given")
+        parser.add_argument("--http_pool_size", default=32, type=int, help="keep-alive connections per provider of the REST engines")
+        parser.add_argument("--http_connect_timeout", default=10.0, type=float, help="connect timeout of the REST engines in seconds")
+        parser.add_argument("--http_read_timeout", default=300.0, type=float, help="read timeout of the REST engines in seconds")
+        parser.add_argument("--usage_ledger_path", default=None, type=str, help="per role and per patient token/latency/cost ledger, defaults to <save_path>.usage.json, \"\" disables it")
+        parser.add_argument("--usage_prometheus_path", default=None, type=str, help="write the usage metrics as a prometheus textfile, e.g. for the node exporter")
+        parser.add_argument("--llm_prices", default=[], type=str, nargs="*", help="prices as model:prompt:completion in USD per 1k tokens, e.g. gpt-4:0.03:0.06")
+        parser.add_argument("--request_timeout", default=None, type=float, help="hard timeout of a request in seconds, a timed out request is retried")
+        parser.add_argument("--role_timeouts", default=[], type=str, nargs="*", help="per role timeouts as role:seconds, e.g. Patient:60 Doctor:180")
+        parser.add_argument("--hedge_percentile", default=None, type=float, help="send a duplicate request once a call takes longer than this latency percentile of the engine, e.g. 95, disabled if not given")
+        parser.add_argument("--hedge_min_samples", default=20, type=int, help="latencies to observe before hedging")
+        parser.add_argument("--hedge_min_delay", default=0.5, type=float, help="never hedge before this many seconds")
+        parser.add_argument("--hedge_api_base", default=None, type=str, help="secondary OpenAI compatible endpoint for the hedged GPT requests, the same endpoint if not given")
+        parser.add_argument("--rate_limit", default=[], type=str, nargs="*", help="per provider limits as provider:rpm[:tpm], e.g. openai:3500:90000")
+        parser.add_argument("--max_retries", default=5, type=int, help="retries of a failed request before giving up")
+        parser.add_argument("--retry_base_delay", default=1.0, type=float, help="first backoff delay in seconds, doubled on every retry")
+        parser.add_argument("--retry_max_delay", default=60.0, type=float, help="cap of the backoff delay in seconds")
+
+    @staticmethod
+    def setup(args):
+        response_cache.configure(
+            path=args.llm_cache_path,
+            ttl=args.llm_cache_ttl,
+            max_entries=args.llm_cache_max_entries,
+            max_bytes=int(args.llm_cache_max_mb * 1024 * 1024) if args.llm_cache_max_mb is not None else None,
+            bypass=args.llm_cache_bypass,
+        )
+        rate_limiters.configure(
+            rate_limits=args.rate_limit,
+            max_retries=args.max_retries,
+            base_delay=args.retry_base_delay,
+            max_delay=args.retry_max_delay,
+        )
+        http_sessions.configure(
+            pool_size=args.http_pool_size,
+            connect_timeout=args.http_connect_timeout,
+            read_timeout=args.http_read_timeout,
+        )
+        single_flight.configure(enabled=not args.disable_coalescing)
+        concurrency_governor.configure(limits=args.max_in_flight)
+        context_windows.configure(
+            policy=args.context_policy,
+            budget=args.context_budget,
+            windows=args.context_windows,
+            log_path=args.context_log_path,
+        )
+        usage_tracker.configure(
+            save_path=getattr(args, "save_path", None),
+            ledger_path=args.usage_ledger_path,
+            prometheus_path=args.usage_prometheus_path,
+            prices=args.llm_prices,
+        )
+        hedging.configure(
+            timeout=args.request_timeout,
+            role_timeouts=args.role_timeouts,
+            percentile=args.hedge_percentile,
+            min_samples=args.hedge_min_samples,
+            min_delay=args.hedge_min_delay,
+        )
+        Engine.hedge_api_base = args.hedge_api_base
+        engine_pool.set_override(args.engine_override, args)
+        Engine.stream_responses = args.stream_responses
+        Engine.local_batch_size = args.local_batch_size
+        Engine.local_batch_wait_ms = args.local_batch_wait_ms
+        Engine.local_kv_cache_mb = args.local_kv_cache_mb
+
+    def is_deterministic(self):
+        return getattr(self, "temperature", None) == 0
+
+    def report(self):
+        # engine specific line for the engine pool report
+        return None
+
+    def drop_session(self, session_id):
+        # state kept across the calls with this session_id, released once its consultation is closed
         pass
 
+    def request_key(self, messages, *args, stop=None, **kwargs):
+        # identifies a deterministic request for the response cache and for coalescing identical in-flight calls
+        if not self.is_deterministic() or not (response_cache.enabled or single_flight.enabled):
+            return None
+        if stop is not None:
+            # a reply cut by a stop condition differs from the full one
+            kwargs = dict(kwargs, stop=repr(stop))
+        params = {name: getattr(self, name, None) for name in self.cache_params}
+        return response_cache.make_key(type(self).__name__, params, messages, args, kwargs)
+
+    def batch_request_body(self, messages):
+        # the chat completion request of a batch job, see engine.batch
+        return {"model": getattr(self, "model_name", None), "messages": messages}
+
+    def streams(self, stop):
+        return stop is not None and Engine.stream_responses and self.supports_streaming
+
+    def get_response(self, messages, *args, stop=None, **kwargs):
+        # stop: a StopCondition, only used when responses are streamed
+        stop = stop if self.streams(stop) else None
+        # a prompt over the model's window is compacted before it is sent
+        messages = context_windows.fit(self, messages)
+        # every call is accounted to the role, patient and stage of the call context
+        record, token = usage_tracker.start(self)
+        response = None
+        try:
+            key = self.request_key(messages, *args, stop=stop, **kwargs)
+            if key is not None and response_cache.enabled:
+                hit, cached = response_cache.get(key)
+                if hit:
+                    record.cached = True
+                    response = cached
+                    return response
+            record.streamed = stop is not None
+            if key is not None and single_flight.enabled:
+                # an identical request in flight: wait for its response instead of sending a duplicate
+                response, record.coalesced = single_flight.do(
+                    key, lambda: self._generate_response(messages, *args, stop=stop, **kwargs))
+            else:
+                response = self._generate_response(messages, *args, stop=stop, **kwargs)
+            if key is not None and response_cache.enabled and not record.coalesced:
+                response_cache.set(key, response)
+            return response
+        finally:
+            usage_tracker.finish(record, token, self.count_prompt_tokens(messages), response)
+
+    async def aget_response(self, messages, *args, stop=None, **kwargs):
+        stop = stop if self.streams(stop) else None
+        messages = await context_windows.afit(self, messages)
+        record, token = usage_tracker.start(self)
+        response = None
+        try:
+            key = self.request_key(messages, *args, stop=stop, **kwargs)
+            if key is not None and response_cache.enabled:
+                hit, cached = response_cache.get(key)
+                if hit:
+                    record.cached = True
+                    response = cached
+                    return response
+            record.streamed = stop is not None
+            if key is not None and single_flight.enabled:
+                response, record.coalesced = await single_flight.ado(
+                    key, lambda: self._agenerate_response(messages, *args, stop=stop, **kwargs))
+            else:
+                response = await self._agenerate_response(messages, *args, stop=stop, **kwargs)
+            if key is not None and response_cache.enabled and not record.coalesced:
+                response_cache.set(key, response)
+            return response
+        finally:
+            usage_tracker.finish(record, token, self.count_prompt_tokens(messages), response)
+
+    def _generate_response(self, messages, *args, stop=None, **kwargs):
+        if stop is not None:
+            return "".join(self.stream(messages, *args, stop=stop, **kwargs))
+        return self.generate_with_retries(messages, *args, **kwargs)
+
+    async def _agenerate_response(self, messages, *args, stop=None, **kwargs):
+        if stop is not None:
+            return "".join([chunk async for chunk in self.astream(messages, *args, stop=stop, **kwargs)])
+        return await self.agenerate_with_retries(messages, *args, **kwargs)
+
+    def stream(self, messages, *args, stop=None, **kwargs):
+        """
+        逐段yield回复，stop条件满足时截断并关闭流，服务端随之停止生成。
+        不支持流式的Engine一次性yield整个回复。
+        """
+        chunks = self.open_stream_with_retries(messages, *args, **kwargs)
+        text = ""
+        try:
+            for chunk in chunks:
+                emitted, text = len(text), text + chunk
+                end = stop.match(text) if stop is not None else None
+                if end is not None:
+                    if end > emitted:
+                        yield text[emitted:end]
+                    return
+                yield chunk
+        finally:
+            chunks.close()
+
+    async def astream(self, messages, *args, stop=None, **kwargs):
+        if self.supports_streaming and not self.supports_async_streaming:
+            # only a blocking stream: run it in a worker thread, the stop condition still cancels it early
+            yield await asyncio.to_thread(lambda: "".join(self.stream(messages, *args, stop=stop, **kwargs)))
+            return
+        chunks = await self.aopen_stream_with_retries(messages, *args, **kwargs)
+        text = ""
+        try:
+            async for chunk in chunks:
+                emitted, text = len(text), text + chunk
+                end = stop.match(text) if stop is not None else None
+                if end is not None:
+                    if end > emitted:
+                        yield text[emitted:end]
+                    return
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    def count_prompt_tokens(self, messages):
+        # rough count: about one token per chinese character
+        text = messages if isinstance(messages, str) else "".join(
+            str(message.get("content", message.get("text", ""))) if isinstance(message, dict) else str(message)
+            for message in messages)
+        return len(text)
+
+    def estimate_tokens(self, messages):
+        # for the tokens-per-minute bucket: the prompt plus the completion budget that providers charge against the limit
+        return self.count_prompt_tokens(messages) + (getattr(self, "max_tokens", None) or getattr(self, "tokens_to_generate", None) or 0)
+
+    def is_retryable(self, error):
+        status_code = getattr(error, "status_code", None)
+        if status_code is None:
+            status_code = getattr(getattr(error, "response", None), "status_code", None)
+        if status_code is None:
+            # connection errors and timeouts
+            return True
+        return status_code in (408, 409, 429) or status_code >= 500
+
+    def retry_after(self, error):
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            return retry_after
+        return parse_retry_after(getattr(getattr(error, "response", None), "headers", None))
+
+    def _on_error(self, error, attempt):
+        # returns how long to wait before the next attempt, raises once the request is given up
+        policy = rate_limiters.retry_policy
+        if not self.is_retryable(error) or attempt >= policy.max_retries:
+            rate_limiters.record(retried=False)
+            raise EngineError("{} ({}) failed after {} attempt(s): {!r}".format(
+                type(self).__name__, getattr(self, "model_name", None), attempt + 1, error)) from error
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            rate_limiters.get(self.provider).pause(retry_after)
+        rate_limiters.record(retried=True)
+        report_retry()
+        delay = policy.delay(attempt, retry_after)
+        print("{} error: {!r}, retry in {:.1f}s".format(type(self).__name__, error, delay))
+        return delay
+
+    def hedge_engine(self):
+        # the engine receiving the duplicate of a slow request
+        return self
+
+    def hedge_generate(self, tokens):
+        if not self.supports_hedging or hedging.percentile is None:
+            return None
+        engine = self.hedge_engine()
+        limiter = rate_limiters.get(engine.provider)
+
+        def generate(*args, **kwargs):
+            # the duplicate request counts against the rate limit as well
+            limiter.acquire(tokens)
+            with engine.hedge_slot():
+                return engine.generate(*args, **kwargs)
+        return generate
+
+    def ahedge_generate(self, tokens):
+        if not self.supports_hedging or hedging.percentile is None:
+            return None
+        engine = self.hedge_engine()
+        limiter = rate_limiters.get(engine.provider)
+
+        async def agenerate(*args, **kwargs):
+            await limiter.aacquire(tokens)
+            with engine.hedge_slot():
+                return await engine.agenerate(*args, **kwargs)
+        return agenerate
+
+    def acquire_slot(self):
+        return concurrency_governor.acquire(self.provider, getattr(self, "model_name", None))
+
+    async def aacquire_slot(self):
+        return await concurrency_governor.aacquire(self.provider, getattr(self, "model_name", None))
+
+    @contextlib.contextmanager
+    def hedge_slot(self):
+        # a duplicate only makes sense with a free slot, it never queues behind the requests it should overtake
+        gates = concurrency_governor.try_acquire(self.provider, getattr(self, "model_name", None))
+        if gates is None:
+            raise ProviderError("no free slot for the hedged request", status_code=429)
+        try:
+            yield
+        finally:
+            concurrency_governor.release(gates)
+
+    def generate_with_retries(self, messages, *args, **kwargs):
+        limiter = rate_limiters.get(self.provider)
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            limiter.acquire(tokens)
+            try:
+                # the slot is held for one attempt, not during the backoff, and released by hedging
+                # when the request really ends, also if it was abandoned on a timeout
+                gates = self.acquire_slot()
+                return hedging.run(self, self.generate, self.hedge_generate(tokens), messages, *args,
+                                   on_done=lambda: concurrency_governor.release(gates), **kwargs)
+            except Exception as e:
+                time.sleep(self._on_error(e, attempt))
+            attempt += 1
+
+    async def agenerate_with_retries(self, messages, *args, **kwargs):
+        limiter = rate_limiters.get(self.provider)
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            await limiter.aacquire(tokens)
+            try:
+                gates = await self.aacquire_slot()
+                return await hedging.arun(self, self.agenerate, self.ahedge_generate(tokens), messages, *args,
+                                          on_done=lambda: concurrency_governor.release(gates), **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self._on_error(e, attempt))
+            attempt += 1
+
+    def open_stream_with_retries(self, messages, *args, **kwargs):
+        # a stream is only retried until its first chunk arrives
+        limiter = rate_limiters.get(self.provider)
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            limiter.acquire(tokens)
+            # an open stream keeps its slot until it is closed
+            gates = concurrency_governor.acquire(self.provider, getattr(self, "model_name", None))
+            chunks = self.generate_stream(messages, *args, **kwargs)
+            try:
+                first = next(chunks, None)
+            except BaseException as e:
+                concurrency_governor.release(gates)
+                if not isinstance(e, Exception):
+                    raise
+                time.sleep(self._on_error(e, attempt))
+                attempt += 1
+                continue
+            return self._prepend(first, chunks, gates)
+
+    async def aopen_stream_with_retries(self, messages, *args, **kwargs):
+        limiter = rate_limiters.get(self.provider)
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            await limiter.aacquire(tokens)
+            gates = await concurrency_governor.aacquire(self.provider, getattr(self, "model_name", None))
+            chunks = self.agenerate_stream(messages, *args, **kwargs)
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException as e:
+                concurrency_governor.release(gates)
+                if not isinstance(e, Exception):
+                    raise
+                await asyncio.sleep(self._on_error(e, attempt))
+                attempt += 1
+                continue
+            return self._aprepend(first, chunks, gates)
+
+    @staticmethod
+    def _prepend(first, chunks, gates):
+        try:
+            if first is not None:
+                yield first
+            yield from chunks
+        finally:
+            try:
+                chunks.close()
+            finally:
+                concurrency_governor.release(gates)
+
+    @staticmethod
+    async def _aprepend(first, chunks, gates):
+        try:
+            if first is not None:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            try:
+                await chunks.aclose()
+            finally:
+                concurrency_governor.release(gates)
+
     @abstractmethod
-    def get_response(self, messages):
-        pass
\ No newline at end of file
+    def generate(self, messages, *args, **kwargs):
+        pass
+
+    def generate_stream(self, messages, *args, **kwargs):
+        yield self.generate(messages, *args, **kwargs)
+
+    async def agenerate_stream(self, messages, *args, **kwargs):
+        yield await self.agenerate(messages, *args, **kwargs)
+
+    async def agenerate(self, messages, *args, **kwargs):
+        # engines without a native async client run the blocking call in a worker thread
+        return await asyncio.to_thread(self.generate, messages, *args, **kwargs)
@@ -0,0 +1,262 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+import jsonlines
+from utils.register import register_class, registry
+from utils.call_context import call_context
+from .rate_limit import EngineError
+from .usage import usage_tracker
+
+
+class BatchBackend(ABC):
+    """
+    离线批处理任务的后端：提交OpenAI batch格式的请求文件，轮询状态，取回结果。
+    请求文件每行为 {"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {...}}，
+    结果为 {custom_id: 回复文本或None(该请求失败)}。
+    """
+    provider = "batch"
+    # cost of a batched token relative to an interactive one
+    price_ratio = 1.0
+
+    def __init__(self, directory, engine=None, client=None):
+        self.directory = directory
+        self.engine = engine
+        self.client = client
+
+    @abstractmethod
+    def submit(self, input_path, contexts=None):
+        # contexts: custom_id -> call context of the request, returns a job id
+        pass
+
+    @abstractmethod
+    def status(self, job_id):
+        # "in_progress", "completed" or "failed"
+        pass
+
+    @abstractmethod
+    def results(self, job_id):
+        # custom_id -> (response text or None, usage dict or None)
+        pass
+
+    @staticmethod
+    def parse_output_line(line):
+        response = line.get("response") or {}
+        body = response.get("body") or {}
+        if line.get("error") or response.get("status_code") != 200 or not body.get("choices"):
+            return None, None
+        return body["choices"][0]["message"]["content"], body.get("usage")
+
+
+@register_class(alias="Batch.OpenAI")
+class OpenAIBatchBackend(BatchBackend):
+    provider = "openai-batch"
+    # the batch API is billed at half the price
+    price_ratio = 0.5
+    completion_window = "24h"
+
+    def __init__(self, directory, engine=None, client=None):
+        super(OpenAIBatchBackend, self).__init__(directory, engine, client)
+        if self.client is None:
+            if engine is not None and hasattr(engine, "client"):
+                self.client = engine.client
+            else:
+                from openai import OpenAI
+                self.client = OpenAI()
+
+    def submit(self, input_path, contexts=None):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window=self.completion_window)
+        return batch.id
+
+    def status(self, job_id):
+        batch = self.client.batches.retrieve(job_id)
+        if batch.status == "completed":
+            return "completed"
+        if batch.status in ("failed", "expired", "cancelled"):
+            # an expired batch still returns the requests that finished
+            return "completed" if batch.output_file_id is not None else "failed"
+        return "in_progress"
+
+    def results(self, job_id):
+        batch = self.client.batches.retrieve(job_id)
+        results = {}
+        if batch.output_file_id is not None:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if line.strip():
+                    line = json.loads(line)
+                    results[line["custom_id"]] = self.parse_output_line(line)
+        return results
+
+
+@register_class(alias="Batch.Local")
+class LocalBatchBackend(BatchBackend):
+    """
+    本地的文件批处理后端，用于测试或没有batch API的endpoint：
+    在后台线程中用给定的Engine逐条处理请求文件，结果按OpenAI batch的输出格式写入任务目录。
+    """
+    max_workers = 8
+
+    def __init__(self, directory, engine=None, client=None):
+        super(LocalBatchBackend, self).__init__(directory, engine, client)
+        assert engine is not None, "the local batch backend answers the requests with an engine"
+        self._workers = {}
+
+    def job_dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def submit(self, input_path, contexts=None):
+        job_id = "local_batch_{}".format(uuid.uuid4().hex[:12])
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        # the job keeps its own copy of the requests, like an uploaded file
+        with jsonlines.open(input_path, "r") as fr:
+            requests = list(fr)
+        with jsonlines.open(os.path.join(self.job_dir(job_id), "input.jsonl"), "w") as fw:
+            fw.write_all(requests)
+        with open(os.path.join(self.job_dir(job_id), "contexts.json"), "w") as f:
+            json.dump(contexts or {}, f, ensure_ascii=False)
+        self.write_status(job_id, "in_progress")
+        self.start(job_id)
+        return job_id
+
+    def start(self, job_id):
+        with jsonlines.open(os.path.join(self.job_dir(job_id), "input.jsonl"), "r") as fr:
+            requests = list(fr)
+        with open(os.path.join(self.job_dir(job_id), "contexts.json"), "r") as f:
+            contexts = json.load(f)
+        worker = threading.Thread(target=self.process, args=(job_id, requests, contexts), daemon=True)
+        self._workers[job_id] = worker
+        worker.start()
+
+    def write_status(self, job_id, status):
+        with open(os.path.join(self.job_dir(job_id), "status.json"), "w") as f:
+            json.dump({"status": status}, f)
+
+    def answer(self, request, context):
+        with call_context(**context):
+            try:
+                content = self.engine.get_response(request["body"]["messages"])
+            except Exception as e:
+                return {"custom_id": request["custom_id"], "response": None, "error": {"message": repr(e)}}
+        return {
+            "custom_id": request["custom_id"],
+            "response": {"status_code": 200, "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}},
+            "error": None,
+        }
+
+    def process(self, job_id, requests, contexts):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.answer, request, contexts.get(request["custom_id"], {})) for request in requests]
+            outputs = [future.result() for future in futures]
+        with jsonlines.open(os.path.join(self.job_dir(job_id), "output.jsonl"), "w") as fw:
+            fw.write_all(outputs)
+        self.write_status(job_id, "completed")
+
+    def status(self, job_id):
+        with open(os.path.join(self.job_dir(job_id), "status.json"), "r") as f:
+            status = json.load(f)["status"]
+        if status == "in_progress" and job_id not in self._workers:
+            # the process working on the job was interrupted, start it over
+            self.start(job_id)
+        return status
+
+    def results(self, job_id):
+        results = {}
+        with jsonlines.open(os.path.join(self.job_dir(job_id), "output.jsonl"), "r") as fr:
+            for line in fr:
+                content, _ = self.parse_output_line(line)
+                # the local engine already accounted the usage of its calls
+                results[line["custom_id"]] = (content, None)
+        return results
+
+
+class BatchJob:
+    """
+    把一组互不依赖的请求写成批处理文件，提交给后端并轮询，直到拿回结果。
+    提交后任务id记录在work_dir中，中断后重新运行会继续等待同一个任务，而不是重复提交。
+    """
+    def __init__(self, backend, work_dir, name, poll_interval=30.0):
+        self.backend = backend
+        self.work_dir = work_dir
+        self.name = name
+        self.poll_interval = poll_interval
+        os.makedirs(work_dir, exist_ok=True)
+
+    @property
+    def input_path(self):
+        return os.path.join(self.work_dir, "{}.input.jsonl".format(self.name))
+
+    @property
+    def state_path(self):
+        return os.path.join(self.work_dir, "{}.state.json".format(self.name))
+
+    @staticmethod
+    def request(custom_id, body):
+        return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+    def load_job_id(self, custom_ids):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, "r") as f:
+            state = json.load(f)
+        # only resume a job of the same requests
+        if state.get("backend") != type(self.backend).__name__ or sorted(state.get("custom_ids", [])) != sorted(custom_ids):
+            return None
+        return state["job_id"]
+
+    def run(self, requests, contexts=None):
+        """
+        :param requests: [(custom_id, body)]，body为chat completion的请求参数
+        :param contexts: custom_id -> 调用上下文(role, patient_id, stage)，用于用量统计和本地后端
+        :return: custom_id -> 回复文本，失败的请求为None
+        """
+        if not requests:
+            return {}
+        contexts = contexts or {}
+        custom_ids = [custom_id for custom_id, _ in requests]
+        job_id = self.load_job_id(custom_ids)
+        if job_id is None:
+            with jsonlines.open(self.input_path, "w") as fw:
+                fw.write_all([self.request(custom_id, body) for custom_id, body in requests])
+            job_id = self.backend.submit(self.input_path, contexts)
+            with open(self.state_path, "w") as f:
+                json.dump({"backend": type(self.backend).__name__, "job_id": job_id, "custom_ids": custom_ids}, f)
+            print("Batch job {} submitted: {} requests".format(job_id, len(requests)))
+        else:
+            print("Batch job {} resumed: {} requests".format(job_id, len(requests)))
+
+        while True:
+            status = self.backend.status(job_id)
+            if status == "completed":
+                break
+            if status == "failed":
+                os.remove(self.state_path)
+                raise EngineError("batch job {} failed".format(job_id))
+            time.sleep(self.poll_interval)
+
+        results = self.backend.results(job_id)
+        bodies = dict(requests)
+        responses = {}
+        for custom_id in custom_ids:
+            content, usage = results.get(custom_id, (None, None))
+            responses[custom_id] = content
+            if usage is not None:
+                usage_tracker.add_external(
+                    contexts.get(custom_id, {}), bodies[custom_id].get("model"), self.backend.provider,
+                    usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), price_ratio=self.backend.price_ratio)
+        failed = sum(content is None for content in responses.values())
+        print("Batch job {} completed: {} responses, {} failed".format(job_id, len(responses) - failed, failed))
+        os.remove(self.state_path)
+        return responses
+
+
+def build_batch_backend(alias, directory, engine=None, client=None):
+    backend_class = registry.get_class(alias)
+    if backend_class is None:
+        raise KeyError("Unknown batch backend: {}".format(alias))
+    return backend_class(directory, engine=engine, client=client)
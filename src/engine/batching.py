@@ -0,0 +1,111 @@
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+import torch
+
+
+def build_chat_input_ids(model, tokenizer, messages):
+    """
+    把messages编码成prompt的token ids，编码方式与model.chat一致。
+    tokenizer自带chat template时用它；Baichuan2/HuatuoGPT2这类remote code模型在建模代码里自带build_chat_input。
+    都没有时返回None，调用方退回逐条model.chat。
+    """
+    if getattr(tokenizer, "chat_template", None):
+        return list(tokenizer.apply_chat_template(messages, add_generation_prompt=True))
+    build_chat_input = getattr(sys.modules.get(type(model).__module__), "build_chat_input", None)
+    if build_chat_input is not None:
+        return list(build_chat_input(model, tokenizer, messages))
+    return None
+
+
+class BatchScheduler:
+    """
+    本地模型前的动态batching：收集max_wait_ms内到达的并发请求（最多max_batch_size条），
+    左padding后一次model.generate，再把结果分别交还给等待的调用方。
+    """
+    def __init__(self, model, tokenizer, max_batch_size=8, max_wait_ms=10, **generation_kwargs):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.generation_kwargs = generation_kwargs
+        self.batches = 0
+        self.requests = 0
+        self.largest_batch = 0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    @property
+    def pad_token_id(self):
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        generation_config = getattr(self.model, "generation_config", None)
+        if getattr(generation_config, "pad_token_id", None) is not None:
+            return generation_config.pad_token_id
+        return self.tokenizer.eos_token_id
+
+    def submit(self, input_ids):
+        # blocks the calling thread until its batch is done
+        future = Future()
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+                self._worker.start()
+        self._queue.put((input_ids, future))
+        return future.result()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch):
+        self.batches += 1
+        self.requests += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            outputs = self.generate_batch([input_ids for input_ids, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), output in zip(batch, outputs):
+            future.set_result(output)
+
+    def generate_batch(self, batch_input_ids):
+        max_length = max(len(input_ids) for input_ids in batch_input_ids)
+        pad_token_id = self.pad_token_id
+        # decoder-only models need left padding so that every prompt ends right before the generated tokens
+        input_ids = torch.tensor(
+            [[pad_token_id] * (max_length - len(ids)) + ids for ids in batch_input_ids], device=self.model.device)
+        attention_mask = torch.tensor(
+            [[0] * (max_length - len(ids)) + [1] * len(ids) for ids in batch_input_ids], device=self.model.device)
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids, attention_mask=attention_mask, pad_token_id=pad_token_id, **self.generation_kwargs)
+        return [self.tokenizer.decode(output[max_length:], skip_special_tokens=True) for output in outputs]
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches > 0 else 0.0,
+            "largest_batch": self.largest_batch,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return "batching: {} requests in {} batches (mean {:.2f}, largest {})".format(
+            stats["requests"], stats["batches"], stats["mean_batch_size"], stats["largest_batch"])
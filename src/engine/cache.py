@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    按内容寻址的LLM回复缓存，SQLite存储，跨进程、跨scenario共享。
+    key是(engine类名, 模型与采样参数, messages, 其他参数)的sha256。
+    """
+    # eviction scans the table, so it only runs every few writes
+    evict_every = 64
+
+    def __init__(self):
+        self.path = None
+        self.ttl = None
+        self.max_entries = None
+        self.max_bytes = None
+        self.bypass = False
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.writes = 0
+        self.expired = 0
+        self.evictions = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._connection is not None
+
+    def configure(self, path=None, ttl=None, max_entries=None, max_bytes=None, bypass=False):
+        self.close()
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        if path is None:
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL lets several runs read and write the same cache file at once
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, size INTEGER, created_at REAL, accessed_at REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._connection.commit()
+        with self._lock:
+            self._evict()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def make_key(*parts):
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=repr)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        # returns (hit, response)
+        now = time.time()
+        with self._lock:
+            if self.bypass:
+                self.bypassed += 1
+                return False, None
+            row = self._connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                self.expired += 1
+                self.misses += 1
+                return False, None
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+        return True, json.loads(row[0])
+
+    def set(self, key, response):
+        if response is None:
+            return
+        value = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now))
+            self._connection.commit()
+            self.writes += 1
+            if self.writes % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        # drop expired entries first, then the least recently used ones until the limits hold
+        if self.ttl is not None:
+            cursor = self._connection.execute(
+                "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            self.expired += cursor.rowcount
+        if self.max_entries is not None:
+            count = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                cursor = self._connection.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)", (count - self.max_entries,))
+                self.evictions += cursor.rowcount
+        if self.max_bytes is not None:
+            total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            rows = self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+            stale_keys = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                stale_keys.append((key,))
+                total -= size
+            self._connection.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+            self.evictions += len(stale_keys)
+        self._connection.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "bypassed": self.bypassed,
+            "writes": self.writes,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
+
+    def report(self):
+        if not self.enabled:
+            return "Response cache: disabled"
+        stats = self.stats()
+        return "Response cache ({}): {} hits, {} misses ({:.1%} hit rate), {} bypassed, {} writes, {} expired, {} evicted".format(
+            stats["path"], stats["hits"], stats["misses"], stats["hit_rate"], stats["bypassed"],
+            stats["writes"], stats["expired"], stats["evictions"])
+
+
+response_cache = ResponseCache()
@@ -1,10 +1,17 @@
+import json
 import zhipuai
 from .base_engine import Engine
+from .rate_limit import ProviderError
+from .usage import report_usage
 from utils.register import register_class
 
 
 @register_class(alias="Engine.ChatGLM")
 class ChatGLMEngine(Engine):
+    provider = "zhipuai"
+    supports_streaming = True
+    cache_params = ("model_name", "temperature", "top_p")
+
     def __init__(self, chatglm_api_key, model_name="chatglm_pro", temperature=0.0, top_p=0.7, incremental=True, *args, **kwargs):
         zhipuai.api_key = chatglm_api_key
         self.model_name = model_name
@@ -12,7 +19,16 @@ class ChatGLMEngine(Engine):
         self.top_p = top_p
         self.incremental = incremental
 
-    def get_response(self, messages):
+    @staticmethod
+    def record_usage(meta):
+        # the finish event carries the token usage as json
+        try:
+            usage = json.loads(meta).get("usage") or {}
+        except (TypeError, ValueError):
+            return
+        report_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+
+    def generate(self, messages):
         response = zhipuai.model_api.sse_invoke(
             model=self.model_name,
             prompt=messages,
@@ -23,8 +39,29 @@ class ChatGLMEngine(Engine):
         
         data = ""
         for event in response.events():
+            if event.event in ("error", "interrupted"):
+                raise ProviderError(event.data)
             data += event.data
             if event.event == "finish":
-                meta = event.meta
+                self.record_usage(event.meta)
                 break
-        return data
\ No newline at end of file
+        return data
+
+    def generate_stream(self, messages):
+        response = zhipuai.model_api.sse_invoke(
+            model=self.model_name,
+            prompt=messages,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            incremental=True
+        )
+        try:
+            for event in response.events():
+                if event.event in ("error", "interrupted"):
+                    raise ProviderError(event.data)
+                yield event.data
+                if event.event == "finish":
+                    self.record_usage(event.meta)
+                    break
+        finally:
+            response.close()
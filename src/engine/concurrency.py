@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import threading
+import time
+from collections import deque
+
+
+class Gate:
+    """
+    线程和asyncio共用的计数信号量：同一个provider的请求可能来自线程池，也可能来自事件循环(以及asyncio.to_thread)，
+    它们占用同一组名额。释放时名额直接交给排队最久的等待者(FIFO)，不会被后来者抢走。
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.waits = 0
+        self.waited_seconds = 0.0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return True
+        return False
+
+    def try_acquire(self):
+        with self._lock:
+            return self._try_acquire()
+
+    def acquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+            self.waits += 1
+        start = time.perf_counter()
+        event.wait()
+        self._record_wait(start)
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._try_acquire():
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+            self.waits += 1
+        start = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            if future.done() and not future.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release()
+            # otherwise _wake sees the cancelled future and passes the slot on
+            raise
+        self._record_wait(start)
+
+    def _record_wait(self, start):
+        with self._lock:
+            self.waited_seconds += time.perf_counter() - start
+
+    def _wake(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.in_flight -= 1
+                return
+            # hand the slot over, in_flight stays the same
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(self._wake, future)
+
+
+class ConcurrencyGovernor:
+    """
+    进程内按provider和模型限制在途请求数，与--max_workers(并发的病人数)无关。
+    --max_in_flight openai:32 openai/gpt-4:8 dashscope:4：
+    请求同时占用其provider和provider/模型的名额(若有配置)，没有配置的不受限制。
+    """
+    def __init__(self):
+        self._limits = {}
+        self._gates = {}
+        self._lock = threading.Lock()
+
+    def configure(self, limits=None):
+        # limits: ["openai:32", "openai/gpt-4:8"]
+        with self._lock:
+            self._limits = {}
+            self._gates = {}
+            for limit in limits or []:
+                key, value = limit.rsplit(":", 1)
+                self._limits[key] = int(value)
+
+    def gates(self, provider, model=None):
+        # provider before model, every request takes them in the same order
+        gates = []
+        with self._lock:
+            if not self._limits:
+                return gates
+            for key in (provider, "{}/{}".format(provider, model)):
+                if key in self._limits:
+                    if key not in self._gates:
+                        self._gates[key] = Gate(self._limits[key])
+                    gates.append(self._gates[key])
+        return gates
+
+    def acquire(self, provider, model=None):
+        gates = self.gates(provider, model)
+        acquired = []
+        try:
+            for gate in gates:
+                gate.acquire()
+                acquired.append(gate)
+        except BaseException:
+            self.release(acquired)
+            raise
+        return gates
+
+    def try_acquire(self, provider, model=None):
+        # None if some slot is taken, without waiting
+        gates = self.gates(provider, model)
+        acquired = []
+        for gate in gates:
+            if not gate.try_acquire():
+                self.release(acquired)
+                return None
+            acquired.append(gate)
+        return gates
+
+    async def aacquire(self, provider, model=None):
+        gates = self.gates(provider, model)
+        acquired = []
+        try:
+            for gate in gates:
+                await gate.aacquire()
+                acquired.append(gate)
+        except BaseException:
+            self.release(acquired)
+            raise
+        return gates
+
+    @staticmethod
+    def release(gates):
+        for gate in reversed(gates):
+            gate.release()
+
+    @contextlib.contextmanager
+    def slot(self, provider, model=None):
+        gates = self.acquire(provider, model)
+        try:
+            yield
+        finally:
+            self.release(gates)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, provider, model=None):
+        gates = await self.aacquire(provider, model)
+        try:
+            yield
+        finally:
+            self.release(gates)
+
+    def report(self):
+        with self._lock:
+            gates = sorted(self._gates.items())
+        if not gates:
+            return "Concurrency governor: unlimited"
+        lines = ["Concurrency governor:"]
+        for key, gate in gates:
+            lines.append("  {}: limit {}, peak {} in flight, {} waits, {:.1f}s waited".format(
+                key, gate.limit, gate.peak, gate.waits, gate.waited_seconds))
+        return "\n".join(lines)
+
+
+concurrency_governor = ConcurrencyGovernor()
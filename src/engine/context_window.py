@@ -0,0 +1,273 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict, defaultdict
+from utils.call_context import call_context, get_call_context
+
+
+class CompactionStats:
+    def __init__(self):
+        self.compactions = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.dropped_messages = 0
+        self.summaries = 0
+
+    def to_dict(self):
+        return {
+            "compactions": self.compactions, "tokens_before": self.tokens_before, "tokens_after": self.tokens_after,
+            "dropped_messages": self.dropped_messages, "summaries": self.summaries}
+
+
+class ContextWindows:
+    """
+    发送前的上下文窗口检查：本地估算prompt的token数，按模型的窗口选择模型(如gpt-3.5-turbo -> gpt-3.5-turbo-16k)，
+    超出预算时按策略压缩对话，只影响发送的messages，不改动Agent的记忆：
+    - none: 原样发送
+    - drop_middle: 保留开头的system prompt和最近的若干轮，丢弃中间的对话
+    - summarize: 同drop_middle，但被丢弃的对话由同一Engine总结为摘要，附在system prompt之后
+    每次压缩按病人记录，见report()和--context_log_path。
+    """
+    policies = ("none", "drop_middle", "summarize")
+    # prompt + completion tokens, matched by the longest model name prefix
+    default_windows = {
+        "gpt-3.5-turbo": 4096,
+        "gpt-3.5-turbo-16k": 16385,
+        "gpt-3.5-turbo-1106": 16385,
+        "gpt-3.5-turbo-0125": 16385,
+        "gpt-4": 8192,
+        "gpt-4-32k": 32768,
+        "gpt-4-1106-preview": 128000,
+        "gpt-4-turbo": 128000,
+        "gpt-4o": 128000,
+        "qwen-turbo": 8000,
+        "qwen-plus": 32000,
+        "qwen-max": 8000,
+        "ERNIE-Bot4": 5000,
+        "ERNIE-Bot": 5000,
+        "chatglm_pro": 32000,
+        "chatglm_std": 8000,
+        "abab5.5-chat": 16384,
+    }
+    # a model whose window is too small is replaced by the larger variant, before sending instead of after an error
+    default_upgrades = {
+        "gpt-3.5-turbo": "gpt-3.5-turbo-16k",
+    }
+    # the dropped prefix grows in steps of this many messages, so a summary serves several turns
+    step = 8
+    summary_prompt = "请简要总结下面这段对话中已经确认的信息，包括患者的症状、病史、检查结果以及医生已经给出的判断，不要添加对话中没有的内容。\n\n{}"
+    summary_header = "此前对话的摘要：\n{}"
+
+    def __init__(self):
+        self.windows = dict(self.default_windows)
+        self.upgrades = dict(self.default_upgrades)
+        self.policy = "none"
+        self.budget = None
+        self.log_path = None
+        self._encoders = {}
+        self._summaries = OrderedDict()
+        self.max_summaries = 1024
+        self._stats = defaultdict(CompactionStats)
+        self._lock = threading.Lock()
+
+    def configure(self, policy="none", budget=None, windows=None, log_path=None):
+        # windows: ["my-model:32000"], budget: max prompt + completion tokens, the model's window if not given
+        assert policy in self.policies, "unknown context policy: {}".format(policy)
+        self.policy = policy
+        self.budget = budget
+        self.windows = dict(self.default_windows)
+        for window in windows or []:
+            model, tokens = window.rsplit(":", 1)
+            self.windows[model] = int(tokens)
+        # appended to, a resumed run keeps the log of the runs before
+        self.log_path = log_path
+        try:
+            import tiktoken
+        except ImportError:
+            print("WARNING: tiktoken is not installed, prompt tokens are estimated from characters "
+                  "for the model upgrade{}".format(" and the {} compaction".format(policy) if policy != "none" else ""))
+        with self._lock:
+            self._summaries.clear()
+            self._stats.clear()
+
+    def window(self, model):
+        model = model or ""
+        matches = [name for name in self.windows if model.startswith(name)]
+        if not matches:
+            return None
+        return self.windows[max(matches, key=len)]
+
+    def largest_window(self, model):
+        # the window of the model or of the variant it is upgraded to
+        windows = [self.window(model), self.window(self.upgrades.get(model))]
+        windows = [window for window in windows if window is not None]
+        return max(windows) if windows else None
+
+    def select_model(self, model, prompt_tokens, completion_tokens=0):
+        window = self.window(model)
+        upgrade = self.upgrades.get(model)
+        if window is None or upgrade is None or prompt_tokens + completion_tokens <= window:
+            return model
+        return upgrade
+
+    def encoder(self, model):
+        if model not in self._encoders:
+            try:
+                import tiktoken
+                self._encoders[model] = tiktoken.encoding_for_model(model)
+            except Exception:
+                # tiktoken is optional, and it cannot load its vocabulary offline or for other providers' models
+                self._encoders[model] = None
+        return self._encoders[model]
+
+    def count_tokens(self, messages, model):
+        # the chat format overhead as counted by OpenAI, None without a tokenizer for the model
+        encoder = self.encoder(model)
+        if encoder is None:
+            return None
+        if isinstance(messages, str):
+            return len(encoder.encode(messages))
+        return 3 + sum(4 + len(encoder.encode(str(message.get("content", "")))) for message in messages)
+
+    def plan(self, messages, budget, count):
+        """
+        :return: (开头的system messages, 被丢弃的messages, 保留的最近messages)，没有超出预算时为None
+        """
+        if count(messages) <= budget:
+            return None
+        start = 0
+        while start < len(messages) and messages[start].get("role") == "system":
+            start += 1
+        head, body = messages[:start], messages[start:]
+        # the latest message is always sent, older ones are kept from the end while they fit
+        available = budget - count(head) - count(body[-1:])
+        cut = len(body) - 1
+        while cut > 0:
+            tokens = count(body[cut - 1:cut])
+            if tokens > available:
+                break
+            available -= tokens
+            cut -= 1
+        if cut == 0:
+            # nothing to drop, the prompt is sent as it is
+            return None
+        cut = min(len(body) - 1, -(-cut // self.step) * self.step)
+        # the kept dialog starts with the same side as the original one
+        while cut < len(body) - 1 and body[cut].get("role") != body[0].get("role"):
+            cut += 1
+        return head, body[:cut], body[cut:]
+
+    def _summary_key(self, messages):
+        return hashlib.sha1(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _summary_request(self, dropped):
+        # the longest dropped prefix summarized before is summarized again together with the rest
+        with self._lock:
+            for end in range(len(dropped), 0, -1):
+                key = self._summary_key(dropped[:end])
+                if key in self._summaries:
+                    self._summaries.move_to_end(key)
+                    previous, rest = self._summaries[key], dropped[end:]
+                    break
+            else:
+                previous, rest = None, dropped
+        if not rest:
+            return previous, None
+        lines = [self.summary_header.format(previous)] if previous is not None else []
+        lines += ["{}: {}".format(message.get("role"), message.get("content")) for message in rest]
+        return None, [{"role": "user", "content": self.summary_prompt.format("\n".join(lines))}]
+
+    def _save_summary(self, dropped, summary):
+        with self._lock:
+            self._summaries[self._summary_key(dropped)] = summary
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+
+    def _compose(self, head, recent, summary):
+        if summary is None:
+            return head + recent
+        note = self.summary_header.format(summary)
+        if head:
+            head = head[:-1] + [dict(head[-1], content="{}\n\n{}".format(head[-1]["content"], note))]
+        else:
+            head = [{"role": "system", "content": note}]
+        return head + recent
+
+    def _prepare(self, engine, messages):
+        if self.policy == "none" or isinstance(messages, str) or not messages:
+            return None
+        window = self.largest_window(getattr(engine, "model_name", None))
+        budget = min(filter(None, [self.budget, window]), default=None)
+        if budget is None:
+            return None
+        completion_tokens = getattr(engine, "max_tokens", None) or getattr(engine, "tokens_to_generate", None) or 0
+        plan = self.plan(messages, budget - completion_tokens, engine.count_prompt_tokens)
+        if plan is None:
+            return None
+        head, dropped, recent = plan
+        # the summary call itself is only ever cut
+        summarize = self.policy == "summarize" and dropped and get_call_context().get("stage") != "context_summary"
+        return head, dropped, recent, summarize
+
+    def fit(self, engine, messages):
+        prepared = self._prepare(engine, messages)
+        if prepared is None:
+            return messages
+        head, dropped, recent, summarize = prepared
+        summary = None
+        if summarize:
+            summary, request = self._summary_request(dropped)
+            if request is not None:
+                with call_context(stage="context_summary"):
+                    summary = engine.get_response(request)
+                self._save_summary(dropped, summary)
+        return self.log(engine, messages, self._compose(head, recent, summary), len(dropped), summarize)
+
+    async def afit(self, engine, messages):
+        prepared = self._prepare(engine, messages)
+        if prepared is None:
+            return messages
+        head, dropped, recent, summarize = prepared
+        summary = None
+        if summarize:
+            summary, request = self._summary_request(dropped)
+            if request is not None:
+                with call_context(stage="context_summary"):
+                    summary = await engine.aget_response(request)
+                self._save_summary(dropped, summary)
+        return self.log(engine, messages, self._compose(head, recent, summary), len(dropped), summarize)
+
+    def log(self, engine, messages, compacted, dropped, summarized):
+        context = get_call_context()
+        before, after = engine.count_prompt_tokens(messages), engine.count_prompt_tokens(compacted)
+        with self._lock:
+            stats = self._stats[context.get("patient_id")]
+            stats.compactions += 1
+            stats.tokens_before += before
+            stats.tokens_after += after
+            stats.dropped_messages += dropped
+            stats.summaries += bool(summarized)
+            if self.log_path:
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps({
+                        "patient_id": context.get("patient_id"), "role": context.get("role"), "stage": context.get("stage"),
+                        "model": getattr(engine, "model_name", None), "policy": "summarize" if summarized else "drop_middle",
+                        "tokens_before": before, "tokens_after": after, "dropped_messages": dropped,
+                    }, ensure_ascii=False) + "\n")
+        return compacted
+
+    def report(self):
+        with self._lock:
+            stats = {patient_id: s.to_dict() for patient_id, s in self._stats.items()}
+        if not stats:
+            return "Context windows: no prompt compacted (policy {})".format(self.policy)
+        lines = ["Context windows: {} prompts of {} patients compacted (policy {}), {} -> {} tokens".format(
+            sum(s["compactions"] for s in stats.values()), len(stats), self.policy,
+            sum(s["tokens_before"] for s in stats.values()), sum(s["tokens_after"] for s in stats.values()))]
+        for patient_id, s in sorted(stats.items(), key=lambda item: -item[1]["compactions"])[:10]:
+            lines.append("  patient {}: {} compactions, {} summaries, {} messages dropped".format(
+                patient_id, s["compactions"], s["summaries"], s["dropped_messages"]))
+        return "\n".join(lines)
+
+
+context_windows = ContextWindows()
@@ -1,13 +1,22 @@
 import os
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from utils.register import register_class
 from .base_engine import Engine
-import time
+from .pool import engine_pool, build_engine
+from .hedging import hedging
+from .http_session import http_sessions
+from .usage import report_usage
+from .context_window import context_windows
 
 
 @register_class(alias="Engine.GPT")
 class GPTEngine(Engine):
+    provider = "openai"
+    supports_streaming = True
+    supports_async_streaming = True
+    cache_params = ("model_name", "openai_api_base", "temperature", "max_tokens", "top_p", "frequency_penalty", "presence_penalty")
+
     def __init__(self, openai_api_key, openai_api_base=None, openai_model_name=None, temperature=0.0, max_tokens=1024, top_p=1, frequency_penalty=0, presence_penalty=0):
         openai_api_key = openai_api_key if openai_api_key is not None else os.environ.get('OPENAI_API_KEY')
         assert openai_api_key is not None
@@ -20,44 +29,105 @@ class GPTEngine(Engine):
         self.frequency_penalty = frequency_penalty
         self.presence_penalty = presence_penalty
 
-        if openai_api_base is not None:
-            self.client = OpenAI(
-                api_key=openai_api_key,
-                base_url=openai_api_base
-            )
-        else:
-            self.client = OpenAI(
-                api_key=openai_api_key,
+        self.openai_api_key = openai_api_key
+        self.openai_api_base = openai_api_base
+        # engines with the same key and base url share one client and its connection pool
+        self.client = engine_pool.get_client(
+            "openai",
+            OpenAI,
+            api_key=openai_api_key,
+            base_url=openai_api_base,
+            # retries go through Engine.get_response and the shared rate limiter
+            max_retries=0
+        )
+        # the async client is only built when an asyncio run asks for it
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = engine_pool.get_client(
+                "openai-async",
+                AsyncOpenAI,
+                api_key=self.openai_api_key,
+                base_url=self.openai_api_base,
+                max_retries=0
             )
+        return self._async_client
+
+    def is_retryable(self, error):
+        if isinstance(error, (openai.BadRequestError, openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError)):
+            return False
+        return super(GPTEngine, self).is_retryable(error)
+
+    def hedge_engine(self):
+        # --hedge_api_base: the duplicate of a slow request goes to a secondary endpoint
+        if Engine.hedge_api_base is None:
+            return self
+        if getattr(self, "_hedge_engine", None) is None:
+            # pooled like every other engine, agents on the same model share it and its client
+            self._hedge_engine = build_engine(
+                "Engine.GPT", openai_api_key=self.openai_api_key, openai_api_base=Engine.hedge_api_base,
+                openai_model_name=self.model_name, temperature=self.temperature, max_tokens=self.max_tokens,
+                top_p=self.top_p, frequency_penalty=self.frequency_penalty, presence_penalty=self.presence_penalty)
+        return self._hedge_engine
+
+    def count_prompt_tokens(self, messages):
+        tokens = context_windows.count_tokens(messages, self.model_name)
+        return tokens if tokens is not None else super(GPTEngine, self).count_prompt_tokens(messages)
+
+    def select_model(self, messages):
+        # a prompt too long for gpt-3.5-turbo goes to the 16k model, decided before sending
+        return context_windows.select_model(self.model_name, self.count_prompt_tokens(messages), self.max_tokens)
 
-    def get_response(self, messages):
-        model_name = self.model_name
-        i = 0
-        while i < 5:
-            try:
-                response = self.client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    temperature=self.temperature,
-                    max_tokens=self.max_tokens,
-                    top_p=self.top_p,
-                    frequency_penalty=self.frequency_penalty,
-                    presence_penalty=self.presence_penalty
-                )
-                break
-            except openai.BadRequestError:
-                if model_name == "gpt-3.5-turbo":
-                    model_name = "gpt-3.5-turbo-16k"
-                i += 1
-            except openai.RateLimitError:
-                time.sleep(10)
-                i += 1
-            except Exception as e:
-                print(e)
-                i += 1
-                time.sleep(5)
-                continue
-            # else:
-            #     i += 1
+    def completion_kwargs(self, messages, model_name):
+        return dict(
+            # the client enforces the role's timeout too, so an abandoned request does not hang on
+            timeout=hedging.current_timeout() or http_sessions.read_timeout,
+            model=model_name,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=self.top_p,
+            frequency_penalty=self.frequency_penalty,
+            presence_penalty=self.presence_penalty
+        )
+
+    @staticmethod
+    def record_usage(response):
+        if getattr(response, "usage", None) is not None:
+            report_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+
+    def batch_request_body(self, messages):
+        body = self.completion_kwargs(messages, self.select_model(messages))
+        body.pop("timeout")
+        return body
+
+    def generate(self, messages):
+        response = self.client.chat.completions.create(**self.completion_kwargs(messages, self.select_model(messages)))
+        self.record_usage(response)
         return response.choices[0].message.content
 
+    async def agenerate(self, messages):
+        response = await self.async_client.chat.completions.create(**self.completion_kwargs(messages, self.select_model(messages)))
+        self.record_usage(response)
+        return response.choices[0].message.content
+
+    def generate_stream(self, messages):
+        response = self.client.chat.completions.create(stream=True, **self.completion_kwargs(messages, self.select_model(messages)))
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # closing the connection stops the generation on the server
+            response.close()
+
+    async def agenerate_stream(self, messages):
+        response = await self.async_client.chat.completions.create(stream=True, **self.completion_kwargs(messages, self.select_model(messages)))
+        try:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await response.close()
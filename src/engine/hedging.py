@@ -0,0 +1,230 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+import time
+from collections import defaultdict, deque
+from utils.call_context import get_call_context
+from .rate_limit import ProviderError
+
+
+class RequestTimeout(ProviderError):
+    def __init__(self, timeout):
+        # 408 is retryable like a connection timeout
+        super(RequestTimeout, self).__init__("no response within {:.1f}s".format(timeout), status_code=408)
+
+
+class LatencyWindow:
+    # latencies of the recent successful calls, for the hedging percentile
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def percentile(self, q):
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q / 100 * len(samples)))]
+
+
+class HedgeStats:
+    def __init__(self):
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def to_dict(self):
+        return {"calls": self.calls, "hedged": self.hedged, "hedge_wins": self.hedge_wins, "timeouts": self.timeouts}
+
+
+class Hedging:
+    """
+    请求的硬超时与对冲(hedged requests)。
+    - 超时按角色设置(见utils.call_context)，超时的请求抛出RequestTimeout(408)，交给Engine的重试
+    - 对冲：请求耗时超过该Engine近期延迟的某个分位数后，再发一个相同的请求(同一或备用endpoint)，先返回的胜出，另一个被取消
+    同步调用在线程池中执行，超时或对冲失败的一方无法中断，只会被丢弃，由客户端自身的超时结束；async调用会被真正取消。
+    on_done在主请求真正结束(返回、出错或被取消)时调用，用于释放它的并发名额，被丢弃的请求在结束前一直占用名额。
+    """
+    def __init__(self):
+        self.timeout = None
+        self.role_timeouts = {}
+        self.percentile = None
+        self.min_samples = 20
+        self.min_delay = 0.5
+        self._windows = defaultdict(LatencyWindow)
+        self._stats = defaultdict(HedgeStats)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def configure(self, timeout=None, role_timeouts=None, percentile=None, min_samples=20, min_delay=0.5):
+        # role_timeouts: ["Patient:60", "Doctor:120"]
+        self.timeout = timeout
+        self.role_timeouts = {}
+        for role_timeout in role_timeouts or []:
+            role, seconds = role_timeout.rsplit(":", 1)
+            self.role_timeouts[role] = float(seconds)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=512, thread_name_prefix="hedging")
+            return self._executor
+
+    def current_timeout(self):
+        return self.role_timeouts.get(get_call_context().get("role"), self.timeout)
+
+    def hedge_delay(self, key):
+        # no hedging until enough latencies of this engine and role are known
+        if self.percentile is None:
+            return None
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or len(window.samples) < self.min_samples:
+                return None
+            return max(self.min_delay, window.percentile(self.percentile))
+
+    def record(self, key, latency=None, hedged=False, hedge_won=False, timed_out=False):
+        with self._lock:
+            if latency is not None:
+                self._windows[key].add(latency)
+            stats = self._stats[key[-1]]
+            stats.calls += 1
+            stats.hedged += hedged
+            stats.hedge_wins += hedge_won
+            stats.timeouts += timed_out
+
+    def _key(self, engine):
+        return (type(engine).__name__, getattr(engine, "model_name", None), str(get_call_context().get("role")))
+
+    def run(self, engine, generate, hedge_generate, *args, on_done=None, **kwargs):
+        """
+        :param generate: engine.generate
+        :param hedge_generate: generate of the engine receiving the duplicate request, None disables hedging
+        :param on_done: called once the primary request has ended
+        """
+        on_done = on_done or (lambda: None)
+        timeout = self.current_timeout() if engine.supports_timeouts else None
+        key = self._key(engine)
+        delay = self.hedge_delay(key) if hedge_generate is not None else None
+        if timeout is None and delay is None:
+            start = time.perf_counter()
+            try:
+                response = generate(*args, **kwargs)
+            finally:
+                on_done()
+            self.record(key, time.perf_counter() - start)
+            return response
+
+        start = time.perf_counter()
+        # every request runs in its own copy of the call context
+        try:
+            primary = self.executor.submit(contextvars.copy_context().run, generate, *args, **kwargs)
+        except BaseException:
+            on_done()
+            raise
+        # after the call returns, or right away if it is cancelled before it starts
+        primary.add_done_callback(lambda _: on_done())
+        futures = {primary: start}
+        deadline = start + timeout if timeout is not None else None
+        if delay is not None:
+            done, _ = concurrent.futures.wait([primary], timeout=delay if timeout is None else min(delay, timeout))
+            if not done and (deadline is None or time.perf_counter() < deadline):
+                futures[self.executor.submit(contextvars.copy_context().run, hedge_generate, *args, **kwargs)] = time.perf_counter()
+        pending, error = set(futures), None
+        while pending:
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            done, pending = concurrent.futures.wait(pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        # a blocking call that already started cannot be interrupted, its result is dropped
+                        loser.cancel()
+                    self.record(key, time.perf_counter() - futures[future], hedged=len(futures) > 1, hedge_won=future is not primary)
+                    return future.result()
+                if error is None or future is primary:
+                    # the error of the primary request is the one reported
+                    error = future.exception()
+        for future in pending:
+            future.cancel()
+        if error is not None:
+            self.record(key, hedged=len(futures) > 1)
+            raise error
+        self.record(key, hedged=len(futures) > 1, timed_out=True)
+        raise RequestTimeout(timeout)
+
+    async def arun(self, engine, agenerate, hedge_agenerate, *args, on_done=None, **kwargs):
+        on_done = on_done or (lambda: None)
+        timeout = self.current_timeout() if engine.supports_timeouts else None
+        key = self._key(engine)
+        delay = self.hedge_delay(key) if hedge_agenerate is not None else None
+        if timeout is None and delay is None:
+            start = time.perf_counter()
+            try:
+                response = await agenerate(*args, **kwargs)
+            finally:
+                on_done()
+            self.record(key, time.perf_counter() - start)
+            return response
+
+        start = time.perf_counter()
+        try:
+            primary = asyncio.ensure_future(agenerate(*args, **kwargs))
+        except BaseException:
+            on_done()
+            raise
+        # a cancelled task is done once it has unwound
+        primary.add_done_callback(lambda _: on_done())
+        tasks = {primary: start}
+        deadline = start + timeout if timeout is not None else None
+        pending, error = {primary}, None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait([primary], timeout=delay if timeout is None else min(delay, timeout))
+                if not done and (deadline is None or time.perf_counter() < deadline):
+                    hedge = asyncio.ensure_future(hedge_agenerate(*args, **kwargs))
+                    tasks[hedge] = time.perf_counter()
+                    pending.add(hedge)
+            while pending:
+                remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        self.record(key, time.perf_counter() - tasks[task], hedged=len(tasks) > 1, hedge_won=task is not primary)
+                        return task.result()
+                    if error is None or task is primary:
+                        error = task.exception()
+        finally:
+            # the loser, or every request on a timeout, is cancelled and closes its connection
+            for task in pending:
+                task.cancel()
+        if error is not None:
+            self.record(key, hedged=len(tasks) > 1)
+            raise error
+        self.record(key, hedged=len(tasks) > 1, timed_out=True)
+        raise RequestTimeout(timeout)
+
+    def report(self):
+        with self._lock:
+            stats = {role: stats.to_dict() for role, stats in self._stats.items()}
+        calls = sum(s["calls"] for s in stats.values())
+        hedged = sum(s["hedged"] for s in stats.values())
+        lines = ["Hedging: {} calls, {} hedged ({:.1%}), {} won by the hedge, {} timeouts".format(
+            calls, hedged, hedged / calls if calls else 0.0,
+            sum(s["hedge_wins"] for s in stats.values()), sum(s["timeouts"] for s in stats.values()))]
+        for role, s in sorted(stats.items()):
+            if s["hedged"] or s["timeouts"]:
+                lines.append("  {}: {} calls, {} hedged, {} won by the hedge, {} timeouts".format(
+                    role, s["calls"], s["hedged"], s["hedge_wins"], s["timeouts"]))
+        return "\n".join(lines)
+
+
+hedging = Hedging()
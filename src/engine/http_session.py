@@ -0,0 +1,39 @@
+import requests
+from requests.adapters import HTTPAdapter
+from .pool import engine_pool
+
+
+class HTTPSessions:
+    """
+    REST接口的Engine(MiniMax、文心)共用的keep-alive HTTP session。
+    同一provider的Engine共用一个requests.Session及其连接池，不必每轮对话都重新建立TCP+TLS连接。
+    """
+    def __init__(self):
+        self.pool_size = 32
+        self.connect_timeout = 10.0
+        self.read_timeout = 300.0
+
+    def configure(self, pool_size=32, connect_timeout=10.0, read_timeout=300.0):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    @property
+    def timeout(self):
+        # requests has no session wide timeout, it is passed with every request
+        return (self.connect_timeout, self.read_timeout)
+
+    @staticmethod
+    def build_session(pool_size):
+        session = requests.Session()
+        # retries go through Engine.get_response and the shared rate limiter
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get(self, provider):
+        return engine_pool.get_client(provider, self.build_session, pool_size=self.pool_size)
+
+
+http_sessions = HTTPSessions()
@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+import torch
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def to_legacy(past_key_values):
+    # newer transformers return a Cache object; the tuple form is immutable, so entries can be shared safely
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def crop(past_key_values, length):
+    # layers of (key, value) shaped (batch, heads, seq, head_dim)
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+
+def cached_length(past_key_values):
+    return past_key_values[0][0].shape[2]
+
+
+def size_in_bytes(past_key_values):
+    return sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer)
+
+
+class SessionKVCache:
+    """
+    本地模型按会话复用past_key_values。
+    每个会话(如一个医生对一个病人)保存上一轮prompt+回复的KV，下一轮只需prefill新增的消息；
+    各会话共同的system prompt前缀单独缓存，新会话的第一轮也不必从头编码。
+    条目以token序列为准：取与新prompt的最长公共前缀并裁剪，所以分词差异不会导致错误复用。
+    所有条目共用一个按显存大小约束的LRU。
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # key -> (tokens, past_key_values, size); key is ("session", session_id) or ("prefix", tokens)
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+        self.evictions = 0
+        # guards the entries and the stats; the cached tensors are never modified in place, so a generation
+        # can go on with an entry that is evicted or replaced meanwhile
+        self._lock = threading.Lock()
+
+    def lookup(self, session_id, input_ids):
+        # returns (number of cached tokens, past_key_values or None); the last prompt token is always left to generate()
+        # called with the lock held
+        best_key, best_length = None, 0
+        candidates = [key for key in self._entries if key[0] == "prefix"] + [("session", session_id)]
+        for key in candidates:
+            if key not in self._entries:
+                continue
+            length = min(common_prefix_length(self._entries[key][0], input_ids), len(input_ids) - 1)
+            if length > best_length:
+                best_key, best_length = key, length
+        self.lookups += 1
+        if best_key is None:
+            return 0, None
+        self.hits += 1
+        self._entries.move_to_end(best_key)
+        past_key_values = self._entries[best_key][1]
+        if cached_length(past_key_values) > best_length:
+            past_key_values = crop(past_key_values, best_length)
+        return best_length, past_key_values
+
+    def store(self, key, tokens, past_key_values):
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[2]
+        size = size_in_bytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (tuple(tokens), past_key_values, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def drop(self, session_id):
+        with self._lock:
+            entry = self._entries.pop(("session", session_id), None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def generate(self, model, input_ids, session_id, prefix_ids=None, **generation_kwargs):
+        """
+        :param prefix_ids: 多个会话共享的前缀(system prompt)，第一次遇到时单独缓存
+        :return: 生成的token ids
+        """
+        # the lock covers the entries only, generations of different sessions run on the model concurrently
+        with self._lock:
+            cached, past_key_values = self.lookup(session_id, input_ids)
+            self.reused_tokens += cached
+            self.prefilled_tokens += len(input_ids) - cached
+        ids = torch.tensor([input_ids], device=model.device)
+        with torch.no_grad():
+            if cached < len(input_ids) - 1:
+                # prefill everything but the last prompt token ourselves: some remote code models only feed
+                # the last token to the model once past_key_values is given
+                outputs = model(input_ids=ids[:, cached:-1], past_key_values=past_key_values, use_cache=True)
+                past_key_values = to_legacy(outputs.past_key_values)
+            if prefix_ids is not None:
+                prefix_length = min(common_prefix_length(prefix_ids, input_ids), len(input_ids) - 1)
+                prefix_key = ("prefix", tuple(input_ids[:prefix_length]))
+                if prefix_length > 0 and past_key_values is not None:
+                    with self._lock:
+                        if prefix_key not in self._entries:
+                            self.store(prefix_key, input_ids[:prefix_length], crop(past_key_values, prefix_length))
+            outputs = model.generate(
+                input_ids=ids, past_key_values=past_key_values, use_cache=True, return_dict_in_generate=True,
+                **generation_kwargs)
+        sequence = outputs.sequences[0].tolist()
+        past_key_values = to_legacy(outputs.past_key_values)
+        with self._lock:
+            self.store(("session", session_id), sequence[:cached_length(past_key_values)], past_key_values)
+        return sequence[len(input_ids):]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "mb": self.bytes / 1024 / 1024,
+            "hit_rate": self.hits / self.lookups if self.lookups > 0 else 0.0,
+            "reused_tokens": self.reused_tokens,
+            "prefilled_tokens": self.prefilled_tokens,
+            "evictions": self.evictions,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return "kv cache: {} entries ({:.1f} MB), {:.1%} hit rate, {} prompt tokens reused, {} prefilled, {} evicted".format(
+            stats["entries"], stats["mb"], stats["hit_rate"], stats["reused_tokens"], stats["prefilled_tokens"], stats["evictions"])
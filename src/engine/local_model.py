@@ -0,0 +1,73 @@
+from abc import abstractmethod
+from .base_engine import Engine
+from .batching import BatchScheduler, build_chat_input_ids
+from .kv_cache import SessionKVCache
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+
+class LocalModelEngine(Engine):
+    """
+    本地GPU上的transformers模型：并发的请求经BatchScheduler合并为一次batched generate，
+    同一会话的对话轮次通过SessionKVCache只prefill新增的消息，两者都不用时调用子类的chat(messages)。
+    """
+    provider = "local"
+    # a generation on the local GPU cannot be abandoned or duplicated
+    supports_timeouts = False
+    supports_hedging = False
+    def __init__(self, model_name_or_path, max_batch_size=None, max_wait_ms=None, kv_cache_mb=None):
+
+        self.model_name = model_name_or_path.split("/")[-1]
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            model_name_or_path,
+            use_fast=True,
+            trust_remote_code=True
+        )
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name_or_path,
+            device_map="auto",
+            torch_dtype=torch.bfloat16,
+            trust_remote_code=True
+        )
+        # concurrent agents share the model through one batched generate instead of taking turns
+        max_batch_size = max_batch_size if max_batch_size is not None else Engine.local_batch_size
+        max_wait_ms = max_wait_ms if max_wait_ms is not None else Engine.local_batch_wait_ms
+        self.batcher = BatchScheduler(self.model, self.tokenizer, max_batch_size, max_wait_ms) if max_batch_size > 1 else None
+        # dialog turns of the same session only prefill the new messages
+        kv_cache_mb = kv_cache_mb if kv_cache_mb is not None else Engine.local_kv_cache_mb
+        self.kv_cache = SessionKVCache(int(kv_cache_mb * 1024 * 1024)) if kv_cache_mb is not None else None
+
+    def is_deterministic(self):
+        # sampling is decided by the model's own generation config
+        return False
+
+    def report(self):
+        reports = [component.report() for component in (self.batcher, self.kv_cache) if component is not None]
+        return ", ".join(reports) if reports else None
+
+    def is_retryable(self, error):
+        # a local model fails the same way again
+        return False
+
+    def drop_session(self, session_id):
+        if self.kv_cache is not None:
+            self.kv_cache.drop(session_id)
+
+    @abstractmethod
+    def chat(self, messages):
+        # the model's own chat method, without batching or the KV cache
+        pass
+
+    def generate(self, messages, session_id=None):
+        # session_id: calls of one dialog, e.g. (doctor, patient_id), reuse the KV cache of the previous turn
+        use_kv_cache = self.kv_cache is not None and session_id is not None
+        input_ids = build_chat_input_ids(self.model, self.tokenizer, messages) if use_kv_cache or self.batcher is not None else None
+        if input_ids is None:
+            response = self.chat(messages)
+        elif use_kv_cache:
+            prefix_ids = build_chat_input_ids(self.model, self.tokenizer, messages[:1]) if messages[0]["role"] == "system" else None
+            output_ids = self.kv_cache.generate(self.model, input_ids, session_id, prefix_ids)
+            response = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        else:
+            response = self.batcher.submit(input_ids)
+        return response
@@ -1,10 +1,15 @@
-import requests
+import json
 from .base_engine import Engine
+from .http_session import http_sessions
+from .rate_limit import ProviderError
 from utils.register import register_class
 
 
 @register_class(alias="Engine.MiniMax")
 class MiniMaxEngine(Engine):
+    provider = "minimax"
+    cache_params = ("model_name", "tokens_to_generate", "temperature", "top_p")
+
     def __init__(self, minimax_api_key, minimax_group_id, minimax_model_name="abab5.5-chat", tokens_to_generate=1024, temperature=0.0, top_p=0.7, stream=True, *args, **kwargs):
         self.model_name = minimax_model_name
         self.url = f"https://api.minimax.chat/v1/text/chatcompletion_pro?GroupId={minimax_group_id}"
@@ -13,19 +18,50 @@ class MiniMaxEngine(Engine):
         self.top_p = top_p
         self.tokens_to_generate = tokens_to_generate
         self.stream = stream
+        self.supports_streaming = stream
+        self.session = http_sessions.get(self.provider)
 
-    def get_response(self, messages, bot_setting):
-        request_body = {
+    def build_request_body(self, messages, bot_setting):
+        return {
             "model": self.model_name,
             "tokens_to_generate": self.tokens_to_generate,
             "temperature": self.temperature,
             "top_p": self.top_p,
-            # "stream": self.stream,
             "reply_constraints": {"sender_type": "BOT", "sender_name": "医生"},
             "messages": messages,
             "bot_setting": bot_setting
         }
 
-        response = requests.post(self.url, headers=self.headers, json=request_body)
-        reply = response.json()["reply"]
+    @staticmethod
+    def check_base_resp(json_data):
+        base_resp = json_data.get("base_resp") or {}
+        if base_resp.get("status_code", 0) != 0:
+            # 1002/1039 are rpm/tpm limits, 1000/1001/1013 are server side errors
+            status_code = 429 if base_resp["status_code"] in (1002, 1039) else 503 if base_resp["status_code"] in (1000, 1001, 1013) else 400
+            raise ProviderError("{}: {}".format(base_resp["status_code"], base_resp.get("status_msg")), status_code=status_code)
+
+    def generate(self, messages, bot_setting):
+        request_body = self.build_request_body(messages, bot_setting)
+        response = self.session.post(self.url, headers=self.headers, json=request_body, timeout=http_sessions.timeout)
+        response.raise_for_status()
+        json_data = response.json()
+        self.check_base_resp(json_data)
+        reply = json_data["reply"]
         return reply
+
+    def generate_stream(self, messages, bot_setting):
+        request_body = dict(self.build_request_body(messages, bot_setting), stream=True)
+        response = self.session.post(self.url, headers=self.headers, json=request_body, stream=True, timeout=http_sessions.timeout)
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                json_data = json.loads(line[len(b"data:"):])
+                self.check_base_resp(json_data)
+                # the last event repeats the whole reply
+                if "reply" in json_data:
+                    break
+                yield json_data["choices"][0]["messages"][0]["text"]
+        finally:
+            response.close()
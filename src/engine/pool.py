@@ -0,0 +1,131 @@
+import threading
+from collections import defaultdict
+from utils.register import registry
+
+
+class EnginePool:
+    """
+    进程内共享的Engine与客户端池。
+    相同配置(provider, base url, key, 采样参数)的Agent共用同一个Engine，
+    相同(provider, base url, key)的Engine共用同一个HTTP客户端及其keep-alive连接池。
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._engines = {}
+        self._clients = {}
+        self.engine_requests = defaultdict(int)
+        self.client_requests = defaultdict(int)
+        self._override = None
+
+    @staticmethod
+    def _freeze(config):
+        return tuple(sorted((key, repr(value)) for key, value in config.items()))
+
+    def set_override(self, alias, args):
+        # every agent gets this engine instead of its own, built once from the command line args (e.g. Engine.Replay)
+        self._override = (alias, args) if alias is not None else None
+
+    def get_engine(self, alias, **kwargs):
+        if self._override is not None:
+            return self._get_override_engine()
+        key = (alias, self._freeze(kwargs))
+        with self._lock:
+            self.engine_requests[key] += 1
+            engine = self._engines.get(key)
+            if engine is None:
+                engine_class = registry.get_class(alias)
+                if engine_class is None:
+                    raise KeyError("Unknown engine: {}".format(alias))
+                engine = engine_class(**kwargs)
+                self._engines[key] = engine
+        return engine
+
+    def _get_override_engine(self):
+        alias, args = self._override
+        key = (alias, ())
+        with self._lock:
+            self.engine_requests[key] += 1
+            engine = self._engines.get(key)
+            if engine is None:
+                engine_class = registry.get_class(alias)
+                if engine_class is None:
+                    raise KeyError("Unknown engine: {}".format(alias))
+                engine = engine_class.from_args(args)
+                self._engines[key] = engine
+        return engine
+
+    def get_client(self, provider, build, **config):
+        key = (provider, self._freeze(config))
+        with self._lock:
+            self.client_requests[key] += 1
+            client = self._clients.get(key)
+            if client is None:
+                client = build(**config)
+                self._clients[key] = client
+        return client
+
+    @staticmethod
+    def live_connections(client):
+        adapters = getattr(client, "adapters", None)
+        if adapters is not None:
+            # requests.Session: urllib3 pools behind the mounted adapters
+            connections = 0
+            for adapter in set(adapters.values()):
+                pools = getattr(getattr(adapter, "poolmanager", None), "pools", None)
+                if pools is not None:
+                    connections += sum(pool.num_connections for pool in pools._container.values())
+            return connections
+        # httpx keeps the connection pool behind the transport, it is not a public api
+        http_client = getattr(client, "_client", None)
+        pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        return len(connections) if connections is not None else None
+
+    def stats(self):
+        with self._lock:
+            engines = [{
+                "alias": key[0],
+                "model_name": getattr(engine, "model_name", None),
+                "requests": self.engine_requests[key],
+                "report": engine.report(),
+            } for key, engine in self._engines.items()]
+            clients = [{
+                "provider": key[0],
+                "base_url": str(getattr(client, "base_url", "")),
+                "requests": self.client_requests[key],
+                "live_connections": self.live_connections(client),
+            } for key, client in self._clients.items()]
+        engine_requests = sum(engine["requests"] for engine in engines)
+        client_requests = sum(client["requests"] for client in clients)
+        return {
+            "engines": len(engines),
+            "engine_requests": engine_requests,
+            "engine_reuses": engine_requests - len(engines),
+            "clients": len(clients),
+            "client_requests": client_requests,
+            "client_reuses": client_requests - len(clients),
+            "engine_details": engines,
+            "client_details": clients,
+        }
+
+    def report(self):
+        stats = self.stats()
+        lines = ["Engine pool: {} engines for {} agents ({} reused), {} clients for {} engines ({} reused)".format(
+            stats["engines"], stats["engine_requests"], stats["engine_reuses"],
+            stats["clients"], stats["client_requests"], stats["client_reuses"])]
+        for engine in stats["engine_details"]:
+            lines.append("  {} [{}]: shared by {} agents".format(
+                engine["alias"], engine["model_name"], engine["requests"]))
+            if engine["report"] is not None:
+                lines.append("    {}".format(engine["report"]))
+        for client in stats["client_details"]:
+            lines.append("  {} client {}: shared by {} engines, live connections: {}".format(
+                client["provider"], client["base_url"], client["requests"], client["live_connections"]))
+        return "\n".join(lines)
+
+
+engine_pool = EnginePool()
+
+
+def build_engine(alias, **kwargs):
+    return engine_pool.get_engine(alias, **kwargs)
@@ -1,35 +1,37 @@
 from http import HTTPStatus
 import dashscope
 import os
-import time
 from .base_engine import Engine
+from .rate_limit import ProviderError
+from .usage import report_usage
 from utils.register import register_class
 
 
 # [qwen-max, qwen-plus-gamma] 分别是200B和70B的模型 
 @register_class(alias="Engine.Qwen")
 class QwenEngine(Engine):
+    provider = "dashscope"
+    cache_params = ("model_name", "seed")
+
     def __init__(self, api_key=None, model_name="qwen-plus-gamma", seed=1, *args, **kwargs):
         self.api_key = api_key if api_key is not None else os.environ.get('DASHSCOPE_API_KEY')
         self.model_name = model_name
         self.seed = seed
 
-    def get_response(self, messages):
-        i = 0
-        while i < 3:
-            try:
-                response = dashscope.Generation.call(
-                    model=self.model_name,
-                    messages=messages,
-                    seed=self.seed,
-                    result_format='message', 
-                )
-                # print(response)
-                answer = response["output"]["choices"][0]["message"]["content"]
-                break
-            except:
-                i += 1
-                time.sleep(10)
-                continue
+    def is_deterministic(self):
+        # dashscope samples reproducibly for a fixed seed
+        return self.seed is not None
 
-        return answer
\ No newline at end of file
+    def generate(self, messages):
+        response = dashscope.Generation.call(
+            model=self.model_name,
+            messages=messages,
+            seed=self.seed,
+            result_format='message', 
+        )
+        if response.status_code != HTTPStatus.OK:
+            # dashscope reports errors in the response instead of raising
+            raise ProviderError("{}: {}".format(response.code, response.message), status_code=response.status_code)
+        if response.usage:
+            report_usage(response.usage.get("input_tokens"), response.usage.get("output_tokens"))
+        return response["output"]["choices"][0]["message"]["content"]
@@ -0,0 +1,155 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+
+class EngineError(Exception):
+    """Raised when an engine gives up on a request."""
+
+
+class ProviderError(Exception):
+    """An error reported in the payload of a provider that does not raise on its own."""
+    def __init__(self, message, status_code=None, retry_after=None):
+        super(ProviderError, self).__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers):
+    # Retry-After is either seconds or an http date, OpenAI also sends retry-after-ms
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        if date is None:
+            return None
+        return max(date.timestamp() - time.time(), 0.0)
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount, now=None):
+        # take the tokens right away, going into debt if needed, and return how long the caller must wait;
+        # later callers queue behind the debt instead of all waking up at once
+        with self._lock:
+            now = time.monotonic() if now is None else now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm is not None else None
+        self.tokens = TokenBucket(tpm) if tpm is not None else None
+        self.blocked_until = 0.0
+        self.waits = 0
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens):
+        now = time.monotonic()
+        wait = max(self.blocked_until - now, 0.0)
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens, now))
+        if wait > 0:
+            with self._lock:
+                self.waits += 1
+                self.waited_seconds += wait
+        return wait
+
+    def acquire(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        # the server asked us to back off: hold every caller of this provider, not only the one that got the 429
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RetryPolicy:
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # exponential backoff with equal jitter
+        delay = min(self.base_delay * 2 ** attempt, self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RateLimiters:
+    def __init__(self):
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.retry_policy = RetryPolicy()
+        self.retries = 0
+        self.failures = 0
+
+    def configure(self, rate_limits=None, max_retries=5, base_delay=1.0, max_delay=60.0):
+        # rate_limits: ["openai:3500:90000", "dashscope:60"], i.e. provider:rpm[:tpm]
+        with self._lock:
+            self._limiters = {}
+            for rate_limit in rate_limits or []:
+                parts = rate_limit.split(":")
+                provider = parts[0]
+                rpm = float(parts[1]) if len(parts) > 1 and parts[1] else None
+                tpm = float(parts[2]) if len(parts) > 2 and parts[2] else None
+                self._limiters[provider] = RateLimiter(rpm=rpm, tpm=tpm)
+        self.retry_policy = RetryPolicy(max_retries=max_retries, base_delay=base_delay, max_delay=max_delay)
+
+    def get(self, provider):
+        with self._lock:
+            limiter = self._limiters.get(provider)
+            if limiter is None:
+                limiter = self._limiters[provider] = RateLimiter()
+            return limiter
+
+    def record(self, retried):
+        with self._lock:
+            if retried:
+                self.retries += 1
+            else:
+                self.failures += 1
+
+    def report(self):
+        lines = ["Rate limiter: {} retries, {} failed requests".format(self.retries, self.failures)]
+        for provider, limiter in sorted(self._limiters.items()):
+            if limiter.waits > 0:
+                lines.append("  {}: {} waits, {:.1f}s waited".format(provider, limiter.waits, limiter.waited_seconds))
+        return "\n".join(lines)
+
+
+rate_limiters = RateLimiters()
@@ -0,0 +1,136 @@
+import asyncio
+import random
+import threading
+import time
+from collections import defaultdict
+import jsonlines
+from utils.register import register_class
+from utils.call_context import get_call_context
+from .base_engine import Engine
+from .rate_limit import ProviderError
+
+
+@register_class(alias="Engine.Replay")
+class ReplayEngine(Engine):
+    """
+    用录制好的对话回放LLM的回复，不访问网络。
+    按调用上下文中的(病人id, 角色, 阶段)匹配录制内容，第k次调用返回该病人该角色第k条录制的回复：
+      - dialog_history: Patient/Doctor/Reporter在问诊中的每一轮
+      - collaboration_history: Host汇总的症状与检查、最终诊断，以及讨论在第几轮达成一致
+    可以注入延迟，用于单独评估编排、I/O和解析的开销。
+    """
+    provider = "replay"
+    # a duplicate request would advance the recording twice
+    supports_hedging = False
+    # the end of a recorded dialog, once the patient's recorded turns run out
+    patient_end = "<对医生讲> 谢谢医生。<结束>"
+    critique = "(a) 各位医生的诊断结果是否一致\n(b) 诊断依据是否充分\n"
+    reporter_query = "请补充病人的辅助检查结果。"
+    reporter_answer = "<回复> 检查结果如上。"
+
+    def __init__(self, dialog_path=None, collaboration_path=None, latency_ms=0.0, latency_per_char_ms=0.0, latency_jitter=0.0, seed=0):
+        self.model_name = "replay"
+        self.latency_ms = latency_ms
+        self.latency_per_char_ms = latency_per_char_ms
+        self.latency_jitter = latency_jitter
+        self.random = random.Random(seed)
+        # (patient_id, role) -> recorded replies in order
+        self.dialogs = defaultdict(list)
+        # patient_id -> collaboration record
+        self.collaborations = {}
+        if dialog_path is not None:
+            with jsonlines.open(dialog_path, "r") as fr:
+                for line in fr:
+                    # turn 0 is the doctor's fixed greeting, not an LLM call
+                    for message in line["dialog_history"]:
+                        if message["turn"] > 0:
+                            self.dialogs[(line["patient_id"], message["role"])].append(message["content"])
+        if collaboration_path is not None:
+            with jsonlines.open(collaboration_path, "r") as fr:
+                for line in fr:
+                    self.collaborations[line["patient_id"]] = line
+        self.cursors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def add_parser_args(parser):
+        parser.add_argument("--replay_dialog_path", default="outputs/dialog_history_iiyi/dialog_history_gpt4.jsonl", type=str, help="recorded consultations to replay")
+        parser.add_argument("--replay_collaboration_path", default=None, type=str, help="recorded collaborative consultations to replay")
+        parser.add_argument("--replay_latency_ms", default=0.0, type=float, help="latency injected into every replayed call")
+        parser.add_argument("--replay_latency_per_char_ms", default=0.0, type=float, help="extra latency per character of the reply, like token generation")
+        parser.add_argument("--replay_latency_jitter", default=0.0, type=float, help="relative random jitter of the injected latency")
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            dialog_path=args.replay_dialog_path,
+            collaboration_path=args.replay_collaboration_path,
+            latency_ms=args.replay_latency_ms,
+            latency_per_char_ms=args.replay_latency_per_char_ms,
+            latency_jitter=args.replay_latency_jitter,
+        )
+
+    def is_deterministic(self):
+        # the replies depend on the call order, never cache them
+        return False
+
+    def next_index(self, patient_id, role, stage):
+        with self._lock:
+            index = self.cursors[(patient_id, role, stage)]
+            self.cursors[(patient_id, role, stage)] += 1
+        return index
+
+    def replay(self):
+        context = get_call_context()
+        patient_id, role, stage = context.get("patient_id"), context.get("role"), context.get("stage")
+        index = self.next_index(patient_id, role, stage)
+        if role == "Host" or stage is not None:
+            return self.replay_collaboration(patient_id, role, stage, index)
+        replies = self.dialogs.get((patient_id, role))
+        if not replies:
+            raise ProviderError("no recorded {} replies for patient {}".format(role, patient_id), status_code=404)
+        if index < len(replies):
+            return replies[index]
+        # the live run goes on longer than the recording
+        return self.patient_end if role == "Patient" else replies[-1]
+
+    def replay_collaboration(self, patient_id, role, stage, index):
+        record = self.collaborations.get(patient_id)
+        if record is None:
+            raise ProviderError("no recorded collaboration for patient {}".format(patient_id), status_code=404)
+        if stage == "summarize_symptom_and_examination":
+            summary = record["symptom_and_examination"]
+            if role != "Host":
+                # the reporter answering the host's query, only needed to reach the edit stage
+                return self.reporter_answer
+            if summary.startswith("##症状##"):
+                # the recording holds the host's parsed summary, turn it back into the reply it was parsed from
+                return summary.replace("##症状##", "#症状#").replace("##辅助检查##", "#辅助检查#")
+            # the recorded summary was written by the edit stage, query the reporter so that the host edits it
+            return "{}\n\n#询问检查员#\n{}".format(summary, self.reporter_query)
+        if stage == "edit_symptom_and_examination":
+            return record["symptom_and_examination"]
+        if stage == "agreement":
+            # the recorded discussion ended after final_turn rounds
+            return "#结束#" if index >= record["final_turn"] else "#继续#"
+        if stage == "critique":
+            return self.critique
+        if stage in ("revise", "summarize_diagnosis"):
+            return record["diagnosis"]
+        raise ProviderError("no recording for {} at stage {}".format(role, stage), status_code=404)
+
+    def latency(self, response):
+        latency = (self.latency_ms + self.latency_per_char_ms * len(response)) / 1000
+        if self.latency_jitter > 0:
+            latency *= max(0.0, 1 + self.random.uniform(-self.latency_jitter, self.latency_jitter))
+        return latency
+
+    def generate(self, messages, *args, **kwargs):
+        response = self.replay()
+        time.sleep(self.latency(response))
+        return response
+
+    async def agenerate(self, messages, *args, **kwargs):
+        response = self.replay()
+        await asyncio.sleep(self.latency(response))
+        return response
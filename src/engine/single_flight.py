@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并同时在途的相同请求(single flight)：相同key的请求在第一个返回前到达时，不再重复发送，而是等待并共用第一个请求的回复。
+    只用于确定性的请求(见Engine.request_key)，否则合并会改变采样的结果。
+    """
+    def __init__(self):
+        self.enabled = True
+        self._flights = {}
+        self._aflights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def configure(self, enabled=True):
+        self.enabled = enabled
+
+    def do(self, key, generate):
+        """
+        :return: (回复, 是否共用了其他请求的回复)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response, True
+        try:
+            flight.response = generate()
+            return flight.response, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(self, key, agenerate):
+        # the asyncio run has its own flights, a thread waiting on an event would block the loop
+        with self._lock:
+            flight = self._aflights.get(key)
+            if flight is None:
+                flight = self._aflights[key] = asyncio.get_running_loop().create_future()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            # shield: a cancelled follower must not cancel the leader's request
+            return await asyncio.shield(flight), True
+        try:
+            response = await agenerate()
+            flight.set_result(response)
+            return response, False
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            # the leader raises it itself, followers are optional
+            flight.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._aflights[key]
+
+    def report(self):
+        total = self.leaders + self.coalesced
+        return "Request coalescing: {} identical in-flight calls joined {} requests ({:.1%} saved)".format(
+            self.coalesced, self.leaders, self.coalesced / total if total else 0.0)
+
+
+single_flight = SingleFlight()
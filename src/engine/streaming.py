@@ -0,0 +1,39 @@
+import re
+
+
+class StopCondition:
+    """
+    流式生成的提前终止条件，由Agent提供。
+    match(text)返回回复应截断到的位置，条件未满足时返回None。
+    repr会进入缓存的key，所以子类的repr需要包含全部参数。
+    """
+    def match(self, text):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(repr(value) for value in vars(self).values()))
+
+
+class StopOnMarker(StopCondition):
+    # e.g. the patient ending the dialog with <结束>, the marker is kept in the reply
+    def __init__(self, marker):
+        self.marker = marker
+
+    def match(self, text):
+        index = text.find(self.marker)
+        return index + len(self.marker) if index >= 0 else None
+
+
+class StopAfterSection(StopCondition):
+    # e.g. a diagnosis whose #治疗方案# section is complete: it has content and is followed by a blank line or another #section#
+    def __init__(self, section):
+        self.section = section
+
+    def match(self, text):
+        header = "#{}#".format(self.section)
+        index = text.find(header)
+        if index < 0:
+            return None
+        start = index + len(header)
+        end = re.search(r"\S.*?(?=\n\s*\n|\n#)", text[start:], re.S)
+        return start + end.end() if end is not None else None
@@ -0,0 +1,59 @@
+import threading
+import time
+
+
+class AccessTokenManager:
+    """
+    进程内共享的OAuth access token缓存，按(鉴权地址, client_id)区分。
+    token在过期前(剩余不足refresh_margin比例的有效期时)主动刷新，所有Engine实例共用同一个token。
+    """
+    refresh_margin = 0.1
+    min_refresh_margin = 60.0
+
+    def __init__(self):
+        # key -> (token, expires_at, lifetime)
+        self._tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.reuses = 0
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _fresh(self, key, now):
+        entry = self._tokens.get(key)
+        if entry is None:
+            return None
+        token, expires_at, lifetime = entry
+        if now >= expires_at - max(lifetime * self.refresh_margin, self.min_refresh_margin):
+            return None
+        return token
+
+    def get(self, key, fetch):
+        """
+        :param fetch: 无参函数，返回(token, 有效期秒数)
+        """
+        # one fetch per key at a time, the other callers wait for its token
+        with self._key_lock(key):
+            token = self._fresh(key, time.time())
+            if token is not None:
+                self.reuses += 1
+                return token
+            token, expires_in = fetch()
+            self._tokens[key] = (token, time.time() + expires_in, expires_in)
+            self.fetches += 1
+            return token
+
+    def invalidate(self, key, token=None):
+        # token: only drop the cached token if it is still the one that was rejected
+        with self._key_lock(key):
+            entry = self._tokens.get(key)
+            if entry is not None and (token is None or entry[0] == token):
+                self._tokens.pop(key)
+
+
+access_tokens = AccessTokenManager()
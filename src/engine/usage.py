@@ -0,0 +1,325 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from utils.call_context import get_call_context
+
+
+# the call being tracked, engines report the provider's token counts into it
+_current_record = contextvars.ContextVar("usage_record", default=None)
+
+
+def report_usage(prompt_tokens=None, completion_tokens=None):
+    # called by engines whose provider returns token counts, otherwise they are estimated
+    record = _current_record.get()
+    if record is None:
+        return
+    if prompt_tokens is not None:
+        record.prompt_tokens = prompt_tokens
+        record.reported = True
+    if completion_tokens is not None:
+        record.completion_tokens = completion_tokens
+        record.reported = True
+
+
+def report_retry():
+    record = _current_record.get()
+    if record is not None:
+        record.retries += 1
+
+
+class UsageRecord:
+    def __init__(self, role, patient_id, stage, engine, model, provider):
+        self.role = role
+        self.patient_id = patient_id
+        self.stage = stage
+        self.engine = engine
+        self.model = model
+        self.provider = provider
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        # whether the token counts come from the provider
+        self.reported = False
+        self.latency = 0.0
+        self.retries = 0
+        self.cached = False
+        # the response of an identical request in flight was shared
+        self.coalesced = False
+        self.streamed = False
+        self.failed = False
+        self.cost = 0.0
+        self.start = time.perf_counter()
+
+
+class Histogram:
+    # cumulative buckets like a prometheus histogram
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total, result = 0, []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile
+        if self.count == 0:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+        return "+Inf"
+
+    def to_dict(self):
+        return {"buckets": [[bound, total] for bound, total in self.cumulative()], "sum": self.sum, "count": self.count}
+
+
+class UsageTotals:
+    latency_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+    token_buckets = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+    def __init__(self, histograms=False):
+        self.calls = 0
+        self.cached_calls = 0
+        self.coalesced_calls = 0
+        self.failed_calls = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = 0.0
+        self.cost = 0.0
+        self.latency_histogram = Histogram(self.latency_buckets) if histograms else None
+        self.prompt_histogram = Histogram(self.token_buckets) if histograms else None
+        self.completion_histogram = Histogram(self.token_buckets) if histograms else None
+
+    def add(self, record):
+        self.calls += 1
+        self.cached_calls += record.cached
+        self.coalesced_calls += record.coalesced
+        self.failed_calls += record.failed
+        self.retries += record.retries
+        self.prompt_tokens += record.prompt_tokens
+        self.completion_tokens += record.completion_tokens
+        self.latency += record.latency
+        self.cost += record.cost
+        if self.latency_histogram is not None:
+            self.latency_histogram.observe(record.latency)
+            self.prompt_histogram.observe(record.prompt_tokens)
+            self.completion_histogram.observe(record.completion_tokens)
+
+    def merge(self, other):
+        for name in ("calls", "cached_calls", "coalesced_calls", "failed_calls", "retries", "prompt_tokens", "completion_tokens", "latency", "cost"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self):
+        result = {
+            "calls": self.calls,
+            "cached_calls": self.cached_calls,
+            "coalesced_calls": self.coalesced_calls,
+            "failed_calls": self.failed_calls,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": round(self.latency, 3),
+            "cost": round(self.cost, 6),
+        }
+        if self.latency_histogram is not None:
+            result["latency_histogram"] = self.latency_histogram.to_dict()
+            result["prompt_tokens_histogram"] = self.prompt_histogram.to_dict()
+            result["completion_tokens_histogram"] = self.completion_histogram.to_dict()
+        return result
+
+
+class UsageTracker:
+    """
+    记录每次LLM调用的token数、耗时、重试次数，以及调用的角色、病人和阶段(见utils.call_context)。
+    汇总为按角色/阶段的直方图和按病人的费用账本，运行结束后写在save_path旁边，也可以导出为Prometheus textfile。
+    """
+    # USD per 1k prompt / completion tokens, the longest matching model name prefix wins, override with --llm_prices
+    default_prices = {
+        "gpt-4-1106-preview": (0.01, 0.03),
+        "gpt-4-turbo": (0.01, 0.03),
+        "gpt-4-32k": (0.06, 0.12),
+        "gpt-4": (0.03, 0.06),
+        "gpt-3.5-turbo-16k": (0.003, 0.004),
+        "gpt-3.5-turbo": (0.0015, 0.002),
+    }
+
+    def __init__(self):
+        self.prices = dict(self.default_prices)
+        self.ledger_path = None
+        self.prometheus_path = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.total = UsageTotals()
+        self.roles = defaultdict(lambda: UsageTotals(histograms=True))
+        self.stages = defaultdict(UsageTotals)
+        self.models = defaultdict(UsageTotals)
+        self.patients = defaultdict(lambda: defaultdict(UsageTotals))
+
+    def configure(self, save_path=None, ledger_path=None, prometheus_path=None, prices=None):
+        # the ledger goes next to save_path unless a path is given, "" disables it
+        if ledger_path is None and save_path:
+            ledger_path = os.path.splitext(save_path)[0] + ".usage.json"
+        self.ledger_path = ledger_path or None
+        self.prometheus_path = prometheus_path
+        # prices: ["gpt-4:0.03:0.06"], i.e. model:prompt:completion in USD per 1k tokens
+        self.prices = dict(self.default_prices)
+        for price in prices or []:
+            model, prompt_price, completion_price = price.rsplit(":", 2)
+            self.prices[model] = (float(prompt_price), float(completion_price))
+        self.reset()
+
+    def price(self, model):
+        model = model or ""
+        matches = [name for name in self.prices if model.startswith(name)]
+        if not matches:
+            return (0.0, 0.0)
+        return self.prices[max(matches, key=len)]
+
+    def start(self, engine):
+        context = get_call_context()
+        record = UsageRecord(
+            role=context.get("role"),
+            patient_id=context.get("patient_id"),
+            stage=context.get("stage"),
+            engine=type(engine).__name__,
+            model=getattr(engine, "model_name", None),
+            provider=engine.provider,
+        )
+        return record, _current_record.set(record)
+
+    def finish(self, record, token, prompt_tokens, response):
+        _current_record.reset(token)
+        record.latency = time.perf_counter() - record.start
+        record.failed = response is None
+        if record.prompt_tokens is None:
+            record.prompt_tokens = prompt_tokens
+        if record.completion_tokens is None:
+            # about one token per chinese character, like Engine.estimate_tokens
+            record.completion_tokens = len(response) if isinstance(response, str) else 0
+        if not record.cached and not record.coalesced:
+            prompt_price, completion_price = self.price(record.model)
+            record.cost = (record.prompt_tokens * prompt_price + record.completion_tokens * completion_price) / 1000
+        self.add(record)
+
+    def add_external(self, context, model, provider, prompt_tokens, completion_tokens, price_ratio=1.0, latency=0.0):
+        # calls that did not go through Engine.get_response, e.g. the results of a batch job
+        record = UsageRecord(
+            role=context.get("role"), patient_id=context.get("patient_id"), stage=context.get("stage"),
+            engine=None, model=model, provider=provider)
+        record.prompt_tokens = prompt_tokens
+        record.completion_tokens = completion_tokens
+        record.reported = True
+        record.latency = latency
+        prompt_price, completion_price = self.price(model)
+        record.cost = price_ratio * (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        self.add(record)
+
+    def add(self, record):
+        with self._lock:
+            self.total.add(record)
+            self.roles[str(record.role)].add(record)
+            self.stages[(str(record.role), record.stage or "")].add(record)
+            self.models[str(record.model)].add(record)
+            self.patients[str(record.patient_id)][str(record.role)].add(record)
+
+    def ledger(self):
+        with self._lock:
+            patients = {}
+            for patient_id, roles in self.patients.items():
+                total = UsageTotals()
+                for totals in roles.values():
+                    total.merge(totals)
+                patients[patient_id] = dict(total.to_dict(), roles={role: totals.to_dict() for role, totals in roles.items()})
+            return {
+                "total": self.total.to_dict(),
+                "roles": {role: totals.to_dict() for role, totals in self.roles.items()},
+                "stages": {"{}/{}".format(role, stage) if stage else role: totals.to_dict() for (role, stage), totals in self.stages.items()},
+                "models": {model: totals.to_dict() for model, totals in self.models.items()},
+                "patients": patients,
+            }
+
+    def prometheus(self):
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        lines = []
+        with self._lock:
+            counters = [
+                ("llm_calls_total", "LLM calls", "calls"),
+                ("llm_cached_calls_total", "LLM calls answered by the response cache", "cached_calls"),
+                ("llm_coalesced_calls_total", "LLM calls that shared the response of an identical request in flight", "coalesced_calls"),
+                ("llm_failed_calls_total", "LLM calls that failed after all retries", "failed_calls"),
+                ("llm_retries_total", "retried LLM requests", "retries"),
+                ("llm_prompt_tokens_total", "prompt tokens", "prompt_tokens"),
+                ("llm_completion_tokens_total", "completion tokens", "completion_tokens"),
+                ("llm_cost_usd_total", "estimated cost in USD", "cost"),
+            ]
+            for name, help, attribute in counters:
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} counter".format(name))
+                for (role, stage), totals in sorted(self.stages.items()):
+                    lines.append('{}{{role="{}",stage="{}"}} {}'.format(name, escape(role), escape(stage), getattr(totals, attribute)))
+            histograms = [
+                ("llm_latency_seconds", "wall latency of LLM calls", "latency_histogram"),
+                ("llm_prompt_tokens", "prompt tokens per LLM call", "prompt_histogram"),
+                ("llm_completion_tokens", "completion tokens per LLM call", "completion_histogram"),
+            ]
+            for name, help, attribute in histograms:
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} histogram".format(name))
+                for role, totals in sorted(self.roles.items()):
+                    histogram = getattr(totals, attribute)
+                    for bound, total in histogram.cumulative():
+                        lines.append('{}_bucket{{role="{}",le="{}"}} {}'.format(name, escape(role), bound, total))
+                    lines.append('{}_sum{{role="{}"}} {}'.format(name, escape(role), histogram.sum))
+                    lines.append('{}_count{{role="{}"}} {}'.format(name, escape(role), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        if self.ledger_path is not None and self.total.calls > 0:
+            with open(self.ledger_path, "w") as f:
+                json.dump(self.ledger(), f, ensure_ascii=False, indent=2)
+        if self.prometheus_path is not None:
+            # write and rename, the node exporter never reads a half written file
+            tmp_path = self.prometheus_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, self.prometheus_path)
+
+    def report(self):
+        with self._lock:
+            total = self.total
+            lines = ["LLM usage: {} calls ({} cached, {} coalesced, {} failed), {} prompt + {} completion tokens, ${:.4f}".format(
+                total.calls, total.cached_calls, total.coalesced_calls, total.failed_calls, total.prompt_tokens, total.completion_tokens, total.cost)]
+            for role, totals in sorted(self.roles.items()):
+                histogram = totals.latency_histogram
+                lines.append("  {}: {} calls, {} + {} tokens, {:.1f}s, p50 <= {}s, p95 <= {}s, ${:.4f}".format(
+                    role, totals.calls, totals.prompt_tokens, totals.completion_tokens, totals.latency,
+                    histogram.quantile(0.5), histogram.quantile(0.95), totals.cost))
+        if self.ledger_path is not None and total.calls > 0:
+            lines.append("  ledger: {}".format(self.ledger_path))
+        return "\n".join(lines)
+
+
+usage_tracker = UsageTracker()
@@ -1,37 +1,59 @@
-import requests
 import os
 import json
 from .base_engine import Engine
+from .http_session import http_sessions
+from .rate_limit import ProviderError
+from .token_manager import access_tokens
+from .usage import report_usage
 from utils.register import register_class
-import time
-import random
 
 
 @register_class(alias="Engine.WenXin")
 class WenXinEngine(Engine):
+    provider = "wenxin"
+    rate_limit_error_codes = (4, 18, 336501, 336502)
+    busy_error_codes = (1, 2, 336100)
+    token_error_codes = (110, 111)
+    cache_params = ("model_name", "temperature", "top_p", "penalty_score")
+
     def __init__(self, api_key=None, sercet_key=None, temperature=0.95, top_p=0.8, penalty_score=1.0, *args, **kwargs):
         self.api_key = api_key if api_key is not None else os.environ.get('WENXIN_API_KEY')
         self.secret_key = sercet_key if sercet_key is not None else os.environ.get('WENXIN_SECRET_KEY')
-        self.url = "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro?access_token=" + \
-            self.get_access_token()
+        self.url = "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro"
+        self.token_url = "https://aip.baidubce.com/oauth/2.0/token"
         self.temperature = temperature
         self.top_p = top_p
         self.penalty_score = penalty_score
         self.model_name = 'ERNIE-Bot4'
+        # all doctors share one keep-alive session and one access token
+        self.session = http_sessions.get(self.provider)
 
-    def get_access_token(self):
+    @property
+    def token_key(self):
+        return (self.token_url, self.api_key)
+
+    def fetch_access_token(self):
         """
         使用 AK/SK 生成鉴权签名（Access Token）
-        :return: access_token，或是 None(如果错误)
+        :return: (access_token, 有效期秒数)
         """
-        url = "https://aip.baidubce.com/oauth/2.0/token"
         params = {"grant_type": "client_credentials", "client_id": self.api_key, "client_secret": self.secret_key}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        response = self.session.post(self.token_url, params=params, timeout=http_sessions.timeout)
+        json_data = response.json()
+        if "access_token" not in json_data:
+            raise ProviderError("{}: {}".format(json_data.get("error"), json_data.get("error_description")), status_code=400)
+        return json_data["access_token"], json_data.get("expires_in", 30 * 24 * 3600)
+
+    def get_access_token(self):
+        return access_tokens.get(self.token_key, self.fetch_access_token)
+
+    def is_retryable(self, error):
+        # an expired token was dropped, the retry fetches a new one
+        if isinstance(error, ProviderError) and error.status_code == 401:
+            return True
+        return super(WenXinEngine, self).is_retryable(error)
 
-    def get_response(self, messages, system=None):
-        # print("get response from wenxin")
-        # print(messages)
-        # print(system)
+    def generate(self, messages, system=None):
         payload = json.dumps({
             "messages": messages,
             "temperature": self.temperature,
@@ -42,35 +64,20 @@ class WenXinEngine(Engine):
         headers = {
             'Content-Type': 'application/json'
         }
-        response = requests.request("POST", self.url, headers=headers, data=payload)
-        
+        access_token = self.get_access_token()
+        response = self.session.post(
+            self.url, params={"access_token": access_token}, headers=headers, data=payload, timeout=http_sessions.timeout)
+        response.raise_for_status()
         json_data = json.loads(response.text)
-        print(json_data)
-        json_data = json_data["result"]
-        return json_data
-    
-        i = 0
-        while i < 10:
-            try:
-                # print("get response from wenxin")
-                # print(messages)
-                # print(system)
-                payload = json.dumps({
-                    "messages": messages,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "penalty_score": self.penalty_score,
-                    "system": system
-                })
-                headers = {
-                    'Content-Type': 'application/json'
-                }
-                response = requests.request("POST", self.url, headers=headers, data=payload)
-                json_data = json.loads(response.text)["result"]
-                break
-            except:
-                sleep_time = random.randint(5, 10)
-                time.sleep(sleep_time)
-                i += 1
-            
-        return json_data
+        if "error_code" in json_data:
+            # 千帆在HTTP 200里返回错误码，限流和服务繁忙的错误码可以重试
+            error_code = json_data["error_code"]
+            if error_code in self.token_error_codes:
+                access_tokens.invalidate(self.token_key, access_token)
+                status_code = 401
+            else:
+                status_code = 429 if error_code in self.rate_limit_error_codes else 503 if error_code in self.busy_error_codes else 400
+            raise ProviderError("{}: {}".format(error_code, json_data.get("error_msg")), status_code=status_code)
+        usage = json_data.get("usage") or {}
+        report_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        return json_data["result"]
@@ -1,6 +1,7 @@
 import jsonlines
 import json
 import os
+import sys
 import openai
 from openai import OpenAI
 import re
@@ -8,6 +9,10 @@ from tqdm import tqdm
 import time
 import concurrent
 import random
+# the batch jobs live in src/engine, the evaluation scripts run from src/evaluate
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import usage_tracker
+from utils.call_context import call_context, get_call_context
 
 
 class Evaluator:
@@ -46,6 +51,11 @@ class Evaluator:
         self.delay_between_tasks = args.delay_between_tasks
         self.eval_save_filepath = args.eval_save_filepath
         self.reference_diagnosis_filepath = args.reference_diagnosis_filepath
+        self.openai_api_key = openai_api_key
+        self.openai_api_base = openai_api_base
+        self.batch_backend = getattr(args, "batch_backend", None)
+        self.batch_dir = getattr(args, "batch_dir", "../outputs/batch_jobs")
+        self.batch_poll_interval = getattr(args, "batch_poll_interval", 60.0)
 
         if openai_api_base is not None:
             self.client = OpenAI(
@@ -227,7 +237,65 @@ class Evaluator:
                 }
                 result = self.evaluate_one(result)
 
+    def batch_evaluate(self):
+        # all evaluations as one batch job, at batch pricing instead of through the thread pool
+        from engine import BatchJob, GPTEngine, build_batch_backend
+        processed = set()
+        if os.path.exists(self.eval_save_filepath):
+            with jsonlines.open(self.eval_save_filepath, "r") as fr:
+                for obj in fr:
+                    processed.add((obj["doctor_name"], obj["patient_id"]))
+
+        evaluate_inputs = {}
+        for doctor_name in self.doctor_names:
+            patient_id_to_doctor_diagnosis = self.doctor_name_to_diagnosis.get(doctor_name)
+            for patient_id in self.patient_ids:
+                doctor_diagnosis = patient_id_to_doctor_diagnosis.get(patient_id)
+                if (doctor_name, patient_id) in processed or doctor_diagnosis is None:
+                    continue
+                evaluate_inputs["{}|{}".format(doctor_name, patient_id)] = {
+                    "doctor_name": doctor_name,
+                    "patient_id": patient_id,
+                    "model_name": self.model_name,
+                    "reference_diagnosis": self.reference_diagnosis.get(patient_id),
+                    "doctor_diagnosis": doctor_diagnosis,
+                }
+
+        # the local stand-in answers the requests through the engine instead of a batch API
+        engine = GPTEngine(self.openai_api_key, self.openai_api_base, self.model_name, temperature=self.temperature, max_tokens=self.max_tokens) \
+            if self.batch_backend == "Batch.Local" else None
+        backend = build_batch_backend(self.batch_backend, self.batch_dir, engine=engine, client=self.client)
+        name = os.path.splitext(os.path.basename(self.eval_save_filepath))[0]
+        batch_job = BatchJob(backend, self.batch_dir, name, poll_interval=self.batch_poll_interval)
+        requests = [(custom_id, {
+            "model": self.model_name,
+            "messages": self.get_messages(self.build_statement(evaluate_args)),
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+        }) for custom_id, evaluate_args in evaluate_inputs.items()]
+        contexts = {custom_id: {"role": "Evaluator", "patient_id": evaluate_args["patient_id"]} for custom_id, evaluate_args in evaluate_inputs.items()}
+        responses = batch_job.run(requests, contexts)
+        for custom_id, evaluate_args in evaluate_inputs.items():
+            # failed requests stay unprocessed and are picked up by the next run
+            if responses.get(custom_id) is not None:
+                self.save_evaluation(evaluate_args, responses[custom_id])
+
     def evaluate_one(self, evaluate_args):
+        statement = self.build_statement(evaluate_args)
+        messages = self.get_messages(statement)
+        with call_context(role="Evaluator", patient_id=evaluate_args["patient_id"]):
+            response = self.get_response(messages)
+        self.save_evaluation(evaluate_args, response)
+
+    def save_evaluation(self, evaluate_args, response):
+        struct_result = self.parse_response(response)
+        evaluate_args.update(struct_result)
+        with jsonlines.open(self.eval_save_filepath, "a") as writer:
+            writer.write(evaluate_args)
+        writer.close()
+
+    @staticmethod
+    def build_statement(evaluate_args):
         reference_diagnosis, doctor_diagnosis = evaluate_args.get("reference_diagnosis"), evaluate_args.get("doctor_diagnosis")
 
         statement = "# 专家诊疗结果\n" + \
@@ -243,15 +311,8 @@ class Evaluator:
             "{}\n\n".format(reference_diagnosis.get("treatment")) + \
             "# 实习医生诊疗结果\n" + \
             "{}".format(doctor_diagnosis["diagnosis"])
-        
-        messages = self.get_messages(statement)
-        response = self.get_response(messages)
-        struct_result = self.parse_response(response)
-        evaluate_args.update(struct_result)
-        with jsonlines.open(self.eval_save_filepath, "a") as writer:
-            writer.write(evaluate_args)
-        writer.close()
-        
+        return statement
+
     @staticmethod
     def parse_response(response):
 
@@ -335,6 +396,7 @@ class Evaluator:
 
     def get_response(self, messages):
         model_name = self.model_name
+        start = time.perf_counter()
         i = 0
         while i < 3:
             try:
@@ -353,6 +415,10 @@ class Evaluator:
                 time.sleep(10)
             else:
                 i += 1
+        if response.usage is not None:
+            # the client is called directly, not through an Engine, so the usage is recorded here
+            usage_tracker.add_external(get_call_context(), model_name, "openai", response.usage.prompt_tokens, response.usage.completion_tokens,
+                                       latency=time.perf_counter() - start)
         return response.choices[0].message.content
 
 
@@ -370,12 +436,17 @@ def get_args():
     parser.add_argument("--delay_between_tasks", type=int, default=5, help="delay between tasks for parallel evaluation")
     parser.add_argument("--doctor_names", type=str, nargs="+", default=["GPT-4"], help="doctor names for evaluation")
     parser.add_argument("--parallel", default=False, action="store_true", help="parallel diagnosis")
+    parser.add_argument("--batch_backend", type=str, default=None, help="evaluate as one offline batch job with this backend, e.g. Batch.OpenAI or Batch.Local")
+    parser.add_argument("--batch_dir", type=str, default="../outputs/batch_jobs", help="directory of the batch job files")
+    parser.add_argument("--batch_poll_interval", type=float, default=60.0, help="seconds between polls of a batch job")
     args = parser.parse_args()
     return args
 
 
 if __name__ == "__main__":
     args = get_args()
+    # the ledger goes next to the evaluation results
+    usage_tracker.configure(save_path=args.eval_save_filepath)
     evaluator = Evaluator(args)
 
     if args.evaluation_platform == "collaborative_discussion":
@@ -385,9 +456,12 @@ if __name__ == "__main__":
     else:
         evaluator.build_onestep_platform()
 
-    if not args.parallel:
+    if args.batch_backend is not None:
+        evaluator.batch_evaluate()
+    elif not args.parallel:
         evaluator.evaluate()
     else:
         evaluator.parallel_evaluate()
 
-                
\ No newline at end of file
+    usage_tracker.save()
+    print(usage_tracker.report())
@@ -1,6 +1,7 @@
 import argparse
 import json
 import os
+import sys
 import re
 from tqdm import tqdm
 import time
@@ -13,6 +14,10 @@ from collections import defaultdict
 from prettytable import PrettyTable
 import concurrent
 import jsonlines
+# the batch jobs live in src/engine, the evaluation scripts run from src/evaluate
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import usage_tracker
+from utils.call_context import call_context, get_call_context
 
 
 class DBEvaluator:
@@ -29,6 +34,8 @@ class DBEvaluator:
         self.temperature = 0.0
         self.max_tokens = 2048
         self.model_name = args.model_name
+        self.openai_api_key = openai_api_key
+        self.openai_api_base = openai_api_base
         if openai_api_base is not None:
             self.client = OpenAI(
                 api_key=openai_api_key,
@@ -103,7 +110,9 @@ class DBEvaluator:
                 }
                 total_data.append(data)
         
-        if self.args.parallel:
+        if self.args.batch_backend is not None:
+            self.batch_match(total_data)
+        elif self.args.parallel:
             print("Parallel Parse Start")
             with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
                 # 使用 map 来简化提交任务和获取结果的过程
@@ -114,17 +123,57 @@ class DBEvaluator:
             for data in tqdm(total_data):
                 self.execute_match(data)
 
-    def execute_match(self, data):
-        reference_diagnosis = data["reference_diagnosis"]
+    def batch_match(self, total_data):
+        # the diagnoses are normalized in one offline batch job, the fuzzy matching runs locally afterwards
+        from engine import BatchJob, GPTEngine, build_batch_backend
+        inputs, requests, contexts = {}, [], {}
+        for data in total_data:
+            custom_id = "{}|{}".format(data["doctor_name"], data["patient_id"])
+            inputs[custom_id] = (data,) + self.extract_diagnoses(data)
+            for kind, diagnosis in zip(("reference", "doctor"), inputs[custom_id][1:]):
+                requests.append(("{}|{}".format(custom_id, kind), {
+                    "model": self.model_name,
+                    "messages": self.get_messages(diagnosis),
+                    "temperature": self.temperature,
+                    "max_tokens": self.max_tokens,
+                }))
+                contexts["{}|{}".format(custom_id, kind)] = {"role": "Evaluator", "patient_id": data["patient_id"], "stage": "icd_normalization"}
+
+        # the local stand-in answers the requests through the engine instead of a batch API
+        engine = GPTEngine(self.openai_api_key, self.openai_api_base, self.model_name, temperature=self.temperature, max_tokens=self.max_tokens) \
+            if self.args.batch_backend == "Batch.Local" else None
+        backend = build_batch_backend(self.args.batch_backend, self.args.batch_dir, engine=engine, client=self.client)
+        name = os.path.splitext(os.path.basename(self.eval_save_filepath))[0]
+        batch_job = BatchJob(backend, self.args.batch_dir, name, poll_interval=self.args.batch_poll_interval)
+        responses = batch_job.run(requests, contexts)
+        for custom_id, (data, reference_diagnosis, doctor_diagnosis) in inputs.items():
+            reference_response = responses.get("{}|reference".format(custom_id))
+            doctor_response = responses.get("{}|doctor".format(custom_id))
+            # failed requests stay unprocessed and are picked up by the next run
+            if reference_response is not None and doctor_response is not None:
+                self.save_match(data, reference_diagnosis, reference_response, doctor_diagnosis, doctor_response)
+
+    @staticmethod
+    def extract_diagnoses(data):
+        reference_diagnosis = data["reference_diagnosis"]['diagnosis'].strip()
         doctor_diagnosis = data["doctor_diagnosis"]
+        doctor_diagnosis = doctor_diagnosis['diagnosis'][doctor_diagnosis['diagnosis'].index('诊断结果')+4:doctor_diagnosis['diagnosis'].index('诊断依据')].strip("# \n")
+        return reference_diagnosis, doctor_diagnosis
 
-        reference_diagnosis = reference_diagnosis['diagnosis'].strip()
-        reference_response = self.get_response(self.get_messages(reference_diagnosis)).split('##')
+    def execute_match(self, data):
+        reference_diagnosis, doctor_diagnosis = self.extract_diagnoses(data)
+        # tagged like the batch requests, so both paths show up the same in the usage report
+        with call_context(role="Evaluator", patient_id=data["patient_id"], stage="icd_normalization"):
+            reference_response = self.get_response(self.get_messages(reference_diagnosis))
+            doctor_response = self.get_response(self.get_messages(doctor_diagnosis))
+        self.save_match(data, reference_diagnosis, reference_response, doctor_diagnosis, doctor_response)
+
+    def save_match(self, data, reference_diagnosis, reference_response, doctor_diagnosis, doctor_response):
+        reference_response = reference_response.split('##')
         reference_diagnosis_match = [process.extract(r, self.disease.keys(), limit=self.top_n) for r in reference_response]
         reference_diagnosis_match = [[(r[0], self.disease[r[0]], r[1]) for r in rr] for rr in reference_diagnosis_match]
 
-        doctor_diagnosis = doctor_diagnosis['diagnosis'][doctor_diagnosis['diagnosis'].index('诊断结果')+4:doctor_diagnosis['diagnosis'].index('诊断依据')].strip("# \n")
-        doctor_response = self.get_response(self.get_messages(doctor_diagnosis)).split('##')
+        doctor_response = doctor_response.split('##')
         doctor_diagnosis_match = [process.extract(r, self.disease.keys(), limit=self.top_n) for r in doctor_response]
         doctor_diagnosis_match = [[(d[0], self.disease[d[0]], d[1]) for d in dd] for dd in doctor_diagnosis_match]
         
@@ -288,6 +337,7 @@ class DBEvaluator:
 
     def get_response(self, messages):
         model_name = self.model_name
+        start = time.perf_counter()
         i = 0
         while i < 3:
             try:
@@ -306,6 +356,10 @@ class DBEvaluator:
                 time.sleep(10)
             else:
                 i += 1
+        if response.usage is not None:
+            # the client is called directly, not through an Engine, so the usage is recorded here
+            usage_tracker.add_external(get_call_context(), model_name, "openai", response.usage.prompt_tokens, response.usage.completion_tokens,
+                                       latency=time.perf_counter() - start)
         return response.choices[0].message.content
 
 
@@ -324,6 +378,9 @@ def get_args():
     parser.add_argument("--max_workers", type=int, default=5, help="max worker for parallel evaluation")
     parser.add_argument("--parallel", default=False, action="store_true", help="parallel diagnosis")
     parser.add_argument("--no_parse", default=False, action="store_true", help="Parse the diagnosis")
+    parser.add_argument("--batch_backend", type=str, default=None, help="normalize the diagnoses as one offline batch job with this backend, e.g. Batch.OpenAI or Batch.Local")
+    parser.add_argument("--batch_dir", type=str, default="../outputs/batch_jobs", help="directory of the batch job files")
+    parser.add_argument("--batch_poll_interval", type=float, default=60.0, help="seconds between polls of a batch job")
 
     args = parser.parse_args()
     return args
@@ -331,7 +388,11 @@ def get_args():
    
 if __name__ == "__main__":
     args = get_args()
+    # the ledger goes next to the evaluation results
+    usage_tracker.configure(save_path=args.eval_save_filepath)
     evaluator = DBEvaluator(args)
     if not args.no_parse:
         evaluator.parse_diagnosis()
-    evaluator.evaluate()
\ No newline at end of file
+    evaluator.evaluate()
+    usage_tracker.save()
+    print(usage_tracker.report())
\ No newline at end of file
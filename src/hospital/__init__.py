@@ -1,8 +1,20 @@
-from .consultation import Consultation
-from .collaborative_consultation import CollaborativeConsultation
+from utils.register import register_lazy_modules, lazy_getattr
+from .session import ConsultationSession, SessionManager
+from .transcript import Transcript, TranscriptView
+
+
+_class_to_module = register_lazy_modules(__name__, {
+    ".consultation": {"Consultation": "Scenario.Consultation"},
+    ".collaborative_consultation": {"CollaborativeConsultation": "Scenario.CollaborativeConsultation"},
+})
+__getattr__ = lazy_getattr(__name__, _class_to_module)
 
 
 __all__ = [
     "Consultation",
     "CollaborativeConsultation",
+    "ConsultationSession",
+    "SessionManager",
+    "Transcript",
+    "TranscriptView",
 ]
@@ -1,20 +1,28 @@
 import argparse
+import asyncio
 import os
 import json
 from typing import List
 import jsonlines
 from tqdm import tqdm
+import threading
 import time
-import random
-import concurrent
 import copy
+import functools
+import traceback
 from utils.register import registry, register_class
+from utils.call_context import patient_context, get_call_context
+from utils.fan_out import fan_out
+from utils.steps import Step, run_steps, arun_steps
+from .session import SessionManager
+from .patient_database import PatientDatabase
+from .scheduler import PatientCostModel
+from .deferred_summaries import DeferredSummaries
 
 
 @register_class(alias="Scenario.CollaborativeConsultation")
 class CollaborativeConsultation:
     def __init__(self, args):
-        patient_database = json.load(open(args.patient_database))
         self.args = args
 
         # Load Different Doctor Agents
@@ -33,31 +41,41 @@ class CollaborativeConsultation:
             self.doctors.append(doctor)
 
         # Load Different Patient Agents
-        self.patients = []
-        for patient_profile in patient_database:
-            patient = registry.get_class(args.patient)(
-                args,
-                patient_profile=patient_profile["profile"],
-                medical_records=patient_profile["medical_record"],
-                patient_id=patient_profile["id"],
-            )
-            self.patients.append(patient)
+        # patients are read and built when a worker picks them up
+        self.patients = PatientDatabase(
+            args.patient_database, registry.get_class(args.patient), args, shuffle_buffer=args.patient_shuffle_buffer,
+            schedule=args.patient_schedule, cost_model=PatientCostModel(args.schedule_history))
     
         self.reporter = registry.get_class(args.reporter)(args)
         self.host = registry.get_class(args.host)(args)
 
         self.discussion_mode = args.discussion_mode
+        # --sequential_discussion: doctors revise one after the other, each seeing the revisions before it in the round
+        self.sequential_discussion = args.sequential_discussion
         self.max_discussion_turn = args.max_discussion_turn
         self.max_conversation_turn = args.max_conversation_turn
         self.delay_between_tasks = args.delay_between_tasks
         self.max_workers = args.max_workers
+        self.max_concurrency = args.max_concurrency
         self.save_path = args.save_path
         self.ff_print = args.ff_print
+        # --batch_backend: the host's final summaries are deferred to one batch job
+        self.summaries = DeferredSummaries(
+            args, self.save_path, self.host.engine, self.fill_summary, self.max_workers) if args.batch_backend is not None else None
+        # the per-patient state of a discussion is released once it is saved
+        self.sessions = SessionManager(spill_dir=args.session_spill_dir, keep=args.keep_sessions)
+        for doctor in self.doctors:
+            self.sessions.on_close(doctor.close_session)
+        self.failed_patients = 0
+        self._failed_lock = threading.Lock()
         self.start_time = time.strftime('%Y-%m-%d %H:%M:%S')
 
     @staticmethod
     def add_parser_args(parser: argparse.ArgumentParser):
-        parser.add_argument("--patient_database", default="patients.json", type=str)
+        parser.add_argument("--patient_database", default="patients.json", type=str, help="a JSON list of patients or a JSONL file with one patient per line")
+        parser.add_argument("--patient_shuffle_buffer", default=1024, type=int, help="patients are shuffled or ordered within a window of this many records, 0 keeps the file order")
+        parser.add_argument("--patient_schedule", default="shuffle", choices=["shuffle", "longest_first"], help="order of the patients in a window, longest_first submits the patients estimated to take longest first")
+        parser.add_argument("--schedule_history", default=[], nargs="*", type=str, help="outputs of earlier runs (save_path jsonl) to estimate the cost of each patient for longest_first")
         parser.add_argument("--doctor_database", default="doctor.json", type=str)
         parser.add_argument("--number_of_doctors", default=2, type=int, help="number of doctors in the consultation collaboration")
         parser.add_argument("--max_discussion_turn", default=4, type=int, help="max discussion turn between doctors")
@@ -71,52 +89,120 @@ class CollaborativeConsultation:
         parser.add_argument("--host", default="Agent.Host.GPT", help="registry name of host agent")
         parser.add_argument("--ff_print", default=False, action="store_true", help="print dialog history")
         parser.add_argument("--parallel", default=False, action="store_true", help="parallel diagnosis")
+        parser.add_argument("--run_async", default=False, action="store_true", help="asyncio diagnosis on a single event loop")
+        parser.add_argument("--max_concurrency", default=256, type=int, help="max in-flight patient discussions for asyncio diagnosis")
         parser.add_argument("--discussion_mode", default="Parallel", choices=["Parallel", "Parallel_with_Critique"], help="discussion mode")
+        parser.add_argument("--sequential_discussion", default=False, action="store_true", help="revise the doctors' diagnoses one at a time instead of concurrently in every discussion round")
+        parser.add_argument("--batch_backend", default=None, type=str, help="registry name of a batch backend for the host's final summaries, e.g. Batch.OpenAI or Batch.Local")
+        parser.add_argument("--batch_dir", default="batch_jobs", type=str, help="directory of the batch job files")
+        parser.add_argument("--batch_poll_interval", default=30.0, type=float, help="seconds between polls of a batch job")
+        parser.add_argument("--session_spill_dir", default=None, type=str, help="write the agents' per-patient transcripts here when a session is released, for later use")
+        parser.add_argument("--keep_sessions", default=False, action="store_true", help="keep the agents' per-patient state in memory until the process exits")
 
 
     def run(self):
         self.remove_processed_patients()
         for patient in tqdm(self.patients):
             self._run(patient)
+        self.run_deferred_summaries()
     
     def parallel_run(self):
         self.remove_processed_patients()
         st = time.time()
         print("Parallel Run Start")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 使用 map 来简化提交任务和获取结果的过程
-            # executor.map(self._diagnosis, self.patients)
-            futures = [executor.submit(self._run, patient) for patient in self.patients]
-            # 使用 tqdm 来创建一个进度条
-            for _ in tqdm(concurrent.futures.as_completed(futures), total=len(self.patients)):
-                pass
+        # patients are submitted while they are read, a bounded number at a time
+        for future in tqdm(self.patients.thread_map(self._try_run, self.max_workers)):
+            future.result()
+        self.run_deferred_summaries()
+        print("duration: ", time.time() - st)
+        self.print_failures()
+        self.print_schedule_report()
+
+    def run_async(self):
+        self.remove_processed_patients()
+        st = time.time()
+        print("Async Run Start")
+        asyncio.run(self._arun_all())
+        self.run_deferred_summaries()
         print("duration: ", time.time() - st)
+        self.print_failures()
+        self.print_schedule_report()
+
+    def log_failure(self, record):
+        # the patient is not saved and is picked up again by the next run
+        with self._failed_lock:
+            self.failed_patients += 1
+        print("patient {} failed:\n{}".format(record.get("id"), traceback.format_exc()), end="")
+
+    def print_failures(self):
+        if self.failed_patients:
+            print("Failed Patient Number: ", self.failed_patients)
+
+    def _try_run(self, record):
+        # a record the patient cannot be built from fails like its consultation would
+        try:
+            self._run(self.patients.build(record))
+        except Exception:
+            self.log_failure(record)
+
+    async def _arun_all(self):
+        async def run(record):
+            try:
+                await self._arun(self.patients.build(record))
+            except Exception:
+                self.log_failure(record)
+
+        # at most max_concurrency patients are read and in flight at a time
+        progress = tqdm()
+        async for _ in self.patients.async_map(run, self.max_concurrency):
+            progress.update(1)
+        progress.close()
     
+    @patient_context
     def _run(self, patient):
+        with self.sessions.open(patient) as session:
+            self._discuss(patient, session)
+            self.sessions.close(session)
+
+    def _discuss(self, patient, session):
+        run_steps(self._discuss_steps(patient, session))
+
+    @patient_context
+    async def _arun(self, patient):
+        with self.sessions.open(patient) as session:
+            await self._adiscuss(patient, session)
+            self.sessions.close(session)
+
+    async def _adiscuss(self, patient, session):
+        await arun_steps(self._discuss_steps(patient, session))
+
+    def _discuss_steps(self, patient, session):
+        # the discussion of one patient, every agent call is yielded and run by _discuss or awaited by _adiscuss
         # host summarizes the symptom and examination from different doctors
         # and asks patient and reporter to verify and correct the symptom and examination
-        symptom_and_examination = self.host.summarize_symptom_and_examination(
-            self.doctors, patient, self.reporter)
+        symptom_and_examination = yield Step(
+            self.host.summarize_symptom_and_examination, self.host.asummarize_symptom_and_examination,
+            self.doctors, session, self.reporter)
         if self.ff_print:
             print("symptom_and_examination: {}".format(symptom_and_examination))
         # revise the diagnosis
         diagnosis_in_discussion = []
         diagnosis_in_turn = []
+        yield Step(self.revise_by_symptom_and_examination, self.arevise_by_symptom_and_examination, session, symptom_and_examination)
         for i, doctor in enumerate(self.doctors):
-            doctor.revise_diagnosis_by_symptom_and_examination(
-                patient, symptom_and_examination)
             diagnosis_in_turn.append({
                 "doctor_id": i,
                 "doctor_engine_name": doctor.engine.model_name,
-                "diagnosis": doctor.get_diagnosis_by_patient_id(patient.id)
+                "diagnosis": doctor.get_diagnosis(session)
             })
             if self.ff_print:
-                print(doctor.engine.model_name, doctor.get_diagnosis_by_patient_id(patient.id, "诊断结果"))
+                print(doctor.engine.model_name, doctor.get_diagnosis(session, "诊断结果"))
 
         if self.ff_print:
             print("-"*100)
         # doctor revise the diagnosis based on the discussion with other doctors
-        host_measurement = self.host.measure_agreement(self.doctors, patient, discussion_mode=self.discussion_mode)
+        host_measurement = yield Step(
+            self.host.measure_agreement, self.host.ameasure_agreement, self.doctors, session, discussion_mode=self.discussion_mode)
         diagnosis_in_discussion.append({
             "turn": 0,
             "diagnosis_in_turn": diagnosis_in_turn,
@@ -127,18 +213,16 @@ class CollaborativeConsultation:
                 if self.ff_print:
                     print(k, "host", host_measurement)
                 diagnosis_in_turn = []
+                yield Step(self.revise_by_others, self.arevise_by_others, session, host_measurement)
                 for i, doctor in enumerate(self.doctors):
-                    left_doctors = self.doctors[:i] + self.doctors[i+1:]
-                    doctor.revise_diagnosis_by_others(
-                        patient, left_doctors, host_measurement, discussion_mode=self.discussion_mode)
                     diagnosis_in_turn.append({
                         "doctor_id": i,
                         "doctor_engine_name": doctor.engine.model_name,
-                        "diagnosis": doctor.get_diagnosis_by_patient_id(patient.id)
+                        "diagnosis": doctor.get_diagnosis(session)
                     })
                     if self.ff_print:
-                        print(k, i, doctor.name, doctor.get_diagnosis_by_patient_id(patient.id, "诊断结果"))
-                host_measurement = self.host.measure_agreement(self.doctors, patient)
+                        print(k, i, doctor.name, doctor.get_diagnosis(session, "诊断结果"))
+                host_measurement = yield Step(self.host.measure_agreement, self.host.ameasure_agreement, self.doctors, session)
                 diagnosis_in_discussion.append({
                     "turn": k+1,
                     "diagnosis_in_turn": diagnosis_in_turn,
@@ -151,11 +235,87 @@ class CollaborativeConsultation:
                     break
         else:
             k = -1
-        
-        final_diagnosis = self.host.summarize_diagnosis(self.doctors, patient)
+
+        if self.summaries is not None:
+            self.defer_summary(session, k, symptom_and_examination)
+            return
+        final_diagnosis = yield Step(self.host.summarize_diagnosis, self.host.asummarize_diagnosis, self.doctors, session)
         if self.ff_print:
             print("host final diagnosis: {}".format(final_diagnosis))
             print("="*100)
+        diagnosis_info = self.build_diagnosis_info(patient, k, final_diagnosis, symptom_and_examination)
+        self.save_info(diagnosis_info)
+
+    def other_doctors(self, i):
+        return self.doctors[:i] + self.doctors[i+1:]
+
+    def revise_by_symptom_and_examination(self, session, symptom_and_examination):
+        if self.sequential_discussion:
+            for doctor in self.doctors:
+                doctor.revise_diagnosis_by_symptom_and_examination(session, symptom_and_examination)
+            return
+        self.revise_concurrently(session, [
+            doctor.build_revise_by_symptom_and_examination_messages(session, symptom_and_examination)
+            for doctor in self.doctors])
+
+    def revise_by_others(self, session, host_measurement):
+        if self.sequential_discussion:
+            for i, doctor in enumerate(self.doctors):
+                doctor.revise_diagnosis_by_others(
+                    session, self.other_doctors(i), host_measurement, discussion_mode=self.discussion_mode)
+            return
+        # every doctor revises against the diagnoses of the others before the round
+        self.revise_concurrently(session, [
+            doctor.build_revise_by_others_messages(session, self.other_doctors(i), host_measurement, self.discussion_mode)
+            for i, doctor in enumerate(self.doctors)])
+
+    def revise_concurrently(self, session, messages):
+        diagnoses = fan_out([functools.partial(doctor.revise_diagnosis, doctor_messages)
+                             for doctor, doctor_messages in zip(self.doctors, messages)])
+        # merged in the order of the doctors, whoever answers first
+        for doctor, diagnosis in zip(self.doctors, diagnoses):
+            doctor.update_diagnosis(session, diagnosis)
+
+    async def arevise_by_symptom_and_examination(self, session, symptom_and_examination):
+        if self.sequential_discussion:
+            for doctor in self.doctors:
+                await doctor.arevise_diagnosis_by_symptom_and_examination(session, symptom_and_examination)
+            return
+        await self.arevise_concurrently(session, [
+            doctor.build_revise_by_symptom_and_examination_messages(session, symptom_and_examination)
+            for doctor in self.doctors])
+
+    async def arevise_by_others(self, session, host_measurement):
+        if self.sequential_discussion:
+            for i, doctor in enumerate(self.doctors):
+                await doctor.arevise_diagnosis_by_others(
+                    session, self.other_doctors(i), host_measurement, discussion_mode=self.discussion_mode)
+            return
+        await self.arevise_concurrently(session, [
+            doctor.build_revise_by_others_messages(session, self.other_doctors(i), host_measurement, self.discussion_mode)
+            for i, doctor in enumerate(self.doctors)])
+
+    async def arevise_concurrently(self, session, messages):
+        diagnoses = await asyncio.gather(*[doctor.arevise_diagnosis(doctor_messages)
+                                           for doctor, doctor_messages in zip(self.doctors, messages)])
+        for doctor, diagnosis in zip(self.doctors, diagnoses):
+            doctor.update_diagnosis(session, diagnosis)
+
+    def defer_summary(self, session, k, symptom_and_examination):
+        # the discussion is over and the transcript fixed, the summary needs no more interaction
+        messages = self.host.build_summarize_diagnosis_messages(self.doctors, session)
+        context = dict(get_call_context(), role=self.host.role, stage="summarize_diagnosis")
+        self.summaries.defer(self.build_diagnosis_info(session.patient, k, None, symptom_and_examination), messages, context)
+
+    @staticmethod
+    def fill_summary(diagnosis_info, final_diagnosis):
+        diagnosis_info["diagnosis"] = final_diagnosis
+
+    def run_deferred_summaries(self):
+        if self.summaries is not None:
+            self.summaries.run()
+
+    def build_diagnosis_info(self, patient, k, final_diagnosis, symptom_and_examination):
         diagnosis_info = {
             "patient_id": patient.id, "final_turn": k+1, "diagnosis": final_diagnosis,
             "symptom_and_examination": symptom_and_examination,
@@ -166,7 +326,12 @@ class CollaborativeConsultation:
             "reporter": self.args.reporter, "reporter_engine_name": self.reporter.engine.model_name,
             "time": self.start_time,
         }
-        self.save_info(diagnosis_info)
+        return diagnosis_info
+
+    def print_schedule_report(self):
+        report = self.patients.report()
+        if report is not None:
+            print(report)
 
     def remove_processed_patients(self):
         processed_patient_ids = {}
@@ -176,14 +341,9 @@ class CollaborativeConsultation:
                     processed_patient_ids[obj["patient_id"]] = 1
             f.close()
 
-        patient_num = len(self.patients)
-        for i, patient in enumerate(self.patients[::-1]):
-            if processed_patient_ids.get(patient.id) is not None:
-                self.patients.pop((patient_num-(i+1)))
-        
-        random.shuffle(self.patients)
-        self.patients = self.patients
-        print("To-be-diagnosed Patient Number: ", len(self.patients))
+        # skipped while the database is read, without building their agents
+        self.patients.skip(processed_patient_ids)
+        print("Processed Patient Number: ", len(processed_patient_ids))
         
     def save_info(self, dialog_info):
         with jsonlines.open(self.save_path, "a") as f:
@@ -1,33 +1,34 @@
 import argparse
+import asyncio
 import os
 import json
 from typing import List
 import jsonlines
 from tqdm import tqdm
+import threading
 import time
-import concurrent
-import random
+import traceback
 from utils.register import register_class, registry
+from utils.call_context import patient_context, get_call_context
+from utils.steps import Step, run_steps, arun_steps
+from .session import SessionManager
+from .patient_database import PatientDatabase
+from .scheduler import PatientCostModel
+from .deferred_summaries import DeferredSummaries
 
 
 @register_class(alias="Scenario.Consultation")
 class Consultation:
     def __init__(self, args):
-        patient_database = json.load(open(args.patient_database))
         self.args = args
         self.doctor = registry.get_class(args.doctor)(
             args,
         )
         
-        self.patients = []
-        for patient_profile in patient_database:
-            patient = registry.get_class(args.patient)(
-                args,
-                patient_profile=patient_profile["profile"],
-                medical_records=patient_profile["medical_record"],
-                patient_id=patient_profile["id"],
-            )
-            self.patients.append(patient)
+        # patients are read and built when a worker picks them up
+        self.patients = PatientDatabase(
+            args.patient_database, registry.get_class(args.patient), args, shuffle_buffer=args.patient_shuffle_buffer,
+            schedule=args.patient_schedule, cost_model=PatientCostModel(args.schedule_history))
     
         self.reporter = registry.get_class(args.reporter)(args)
 
@@ -43,13 +44,25 @@ class Consultation:
         self.max_conversation_turn = args.max_conversation_turn
         self.delay_between_tasks = args.delay_between_tasks
         self.max_workers = args.max_workers
+        self.max_concurrency = args.max_concurrency
         self.save_path = args.save_path
         self.ff_print = args.ff_print
+        # the per-patient state of a dialog is released once the dialog is saved
+        self.sessions = SessionManager(spill_dir=args.session_spill_dir, keep=args.keep_sessions)
+        self.sessions.on_close(self.doctor.close_session)
+        # --batch_backend: the doctor's final summaries are deferred to one batch job
+        self.summaries = DeferredSummaries(
+            args, self.save_path, self.doctor.engine, self.fill_summary, self.max_workers) if args.batch_backend is not None else None
+        self.failed_patients = 0
+        self._failed_lock = threading.Lock()
         self.start_time = time.strftime('%Y-%m-%d %H:%M:%S')
 
     @staticmethod
     def add_parser_args(parser: argparse.ArgumentParser):
-        parser.add_argument("--patient_database", default="patients.json", type=str)
+        parser.add_argument("--patient_database", default="patients.json", type=str, help="a JSON list of patients or a JSONL file with one patient per line")
+        parser.add_argument("--patient_shuffle_buffer", default=1024, type=int, help="patients are shuffled or ordered within a window of this many records, 0 keeps the file order")
+        parser.add_argument("--patient_schedule", default="shuffle", choices=["shuffle", "longest_first"], help="order of the patients in a window, longest_first submits the patients estimated to take longest first")
+        parser.add_argument("--schedule_history", default=[], nargs="*", type=str, help="outputs of earlier runs (save_path jsonl) to estimate the cost of each patient for longest_first")
         parser.add_argument("--patient", default="Agent.Patient.GPT", help="registry name of patient agent")
         parser.add_argument("--doctor", default="Agent.Doctor.GPT", help="registry name of doctor agent")
         parser.add_argument("--reporter", default="Agent.Reporter.GPT", help="registry name of reporter agent")
@@ -60,6 +73,18 @@ class Consultation:
         parser.add_argument("--save_path", default="dialog_history.jsonl", help="save path for dialog history")
         parser.add_argument("--ff_print", default=False, action="store_true", help="print dialog history")
         parser.add_argument("--parallel", default=False, action="store_true", help="parallel diagnosis")
+        parser.add_argument("--run_async", default=False, action="store_true", help="asyncio diagnosis on a single event loop")
+        parser.add_argument("--max_concurrency", default=256, type=int, help="max in-flight patient dialogs for asyncio diagnosis")
+        parser.add_argument("--batch_backend", default=None, type=str, help="registry name of a batch backend for the doctor's final summaries, e.g. Batch.OpenAI or Batch.Local")
+        parser.add_argument("--batch_dir", default="batch_jobs", type=str, help="directory of the batch job files")
+        parser.add_argument("--batch_poll_interval", default=30.0, type=float, help="seconds between polls of a batch job")
+        parser.add_argument("--session_spill_dir", default=None, type=str, help="write the agents' per-patient transcripts here when a session is released, for later use")
+        parser.add_argument("--keep_sessions", default=False, action="store_true", help="keep the agents' per-patient state in memory until the process exits")
+
+    def print_schedule_report(self):
+        report = self.patients.report()
+        if report is not None:
+            print(report)
 
     def remove_processed_patients(self):
         processed_patient_ids = {}
@@ -69,13 +94,9 @@ class Consultation:
                     processed_patient_ids[obj["patient_id"]] = 1
             f.close()
 
-        patient_num = len(self.patients)
-        for i, patient in enumerate(self.patients[::-1]):
-            if processed_patient_ids.get(patient.id) is not None:
-                self.patients.pop((patient_num-(i+1)))
-            
-        random.shuffle(self.patients)
-        print("To-be-diagnosed Patient Number: ", len(self.patients))
+        # skipped while the database is read, without building their agents
+        self.patients.skip(processed_patient_ids)
+        print("Processed Patient Number: ", len(processed_patient_ids))
 
     def run(self):
         self.remove_processed_patients()
@@ -84,6 +105,7 @@ class Consultation:
             self._diagnosis(patient)
             # patient.forget()
             # self.doctor.forget()
+        self.run_deferred_summaries()
         # print("duration: ", time.time() - st)
 
     def parallel_run(self):
@@ -91,62 +113,142 @@ class Consultation:
 
         st = time.time()
         print("Parallel Diagnosis Start")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 使用 map 来简化提交任务和获取结果的过程
-            # executor.map(self._diagnosis, self.patients)
-            futures = [executor.submit(self._diagnosis, patient) for patient in self.patients]
-            # 使用 tqdm 来创建一个进度条
-            for _ in tqdm(concurrent.futures.as_completed(futures), total=len(self.patients)):
-                pass
+        # patients are submitted while they are read, a bounded number at a time
+        for future in tqdm(self.patients.thread_map(self._try_diagnosis, self.max_workers)):
+            future.result()
+        self.run_deferred_summaries()
 
         print("duration: ", time.time() - st)
+        self.print_failures()
+        self.print_schedule_report()
+
+    def run_async(self):
+        self.remove_processed_patients()
+
+        st = time.time()
+        print("Async Diagnosis Start")
+        asyncio.run(self._adiagnosis_all())
+        self.run_deferred_summaries()
+        print("duration: ", time.time() - st)
+        self.print_failures()
+        self.print_schedule_report()
+
+    def log_failure(self, record):
+        # the patient is not saved and is picked up again by the next run
+        with self._failed_lock:
+            self.failed_patients += 1
+        print("patient {} failed:\n{}".format(record.get("id"), traceback.format_exc()), end="")
+
+    def print_failures(self):
+        if self.failed_patients:
+            print("Failed Patient Number: ", self.failed_patients)
+
+    def _try_diagnosis(self, record):
+        # a record the patient cannot be built from fails like its consultation would
+        try:
+            self._diagnosis(self.patients.build(record))
+        except Exception:
+            self.log_failure(record)
+
+    async def _adiagnosis_all(self):
+        async def diagnosis(record):
+            try:
+                await self._adiagnosis(self.patients.build(record))
+            except Exception:
+                self.log_failure(record)
+
+        # at most max_concurrency patients are read and in flight at a time
+        progress = tqdm()
+        async for _ in self.patients.async_map(diagnosis, self.max_concurrency):
+            progress.update(1)
+        progress.close()
         
+    @patient_context
     def _diagnosis(self, patient):
+        # the doctor and patient agents keep nothing of the dialog, it lives in the session
+        with self.sessions.open(patient) as session:
+            self._dialog(patient, session)
+            self.sessions.close(session)
+
+    def _dialog(self, patient, session):
+        run_steps(self._dialog_steps(patient, session))
+
+    @patient_context
+    async def _adiagnosis(self, patient):
+        with self.sessions.open(patient) as session:
+            await self._adialog(patient, session)
+            self.sessions.close(session)
+
+    async def _adialog(self, patient, session):
+        await arun_steps(self._dialog_steps(patient, session))
+
+    def _dialog_steps(self, patient, session):
+        # the dialog of one patient, every agent call is yielded and run by _dialog or awaited by _adialog
         dialog_history = [{"turn": 0, "role": "Doctor", "content": self.doctor.doctor_greet}]
-        self.doctor.memorize(("assistant", self.doctor.doctor_greet), patient.id)
+        session.say(self.doctor, self.doctor.doctor_greet)
         if self.ff_print:
             print("############### Dialog ###############")
-            print("--------------------------------------")
-            print(dialog_history[-1]["turn"], dialog_history[-1]["role"])
-            print(dialog_history[-1]["content"])
+            self.print_dialog_turn(dialog_history[-1])
         for turn in range(self.max_conversation_turn):
-            patient_response = patient.speak(dialog_history[-1]["role"], dialog_history[-1]["content"])
+            patient_response = yield Step(patient.speak, patient.aspeak, dialog_history[-1]["role"], dialog_history[-1]["content"], session)
             dialog_history.append({"turn": turn+1, "role": "Patient", "content": patient_response})
             if self.ff_print:
-                print("--------------------------------------")
-                print(dialog_history[-1]["turn"], dialog_history[-1]["role"])
-                print(dialog_history[-1]["content"])
+                self.print_dialog_turn(dialog_history[-1])
             if "<结束>" in patient_response: break
             speak_to, patient_response = patient.parse_role_content(patient_response)
 
             if speak_to == "医生":
                 # doctor_response = input()
-                doctor_response = self.doctor.speak(patient_response, patient.id)
+                doctor_response = yield Step(self.doctor.speak, self.doctor.aspeak, patient_response, session)
                 dialog_history.append({"turn": turn+1, "role": "Doctor", "content": doctor_response})
             elif speak_to == "检查员":
-                reporter_response = self.reporter.speak(patient.medical_records, patient_response)
+                reporter_response = yield Step(
+                    self.reporter.speak, self.reporter.aspeak, patient.medical_records, patient_response, exam_index=patient.exam_index)
                 dialog_history.append({"turn": turn+1, "role": "Reporter", "content": reporter_response})
-                doctor_response = self.doctor.speak(reporter_response, patient.id)
+                doctor_response = yield Step(self.doctor.speak, self.doctor.aspeak, reporter_response, session)
                 dialog_history.append({"turn": turn+1, "role": "Doctor", "content": doctor_response})
             else:
-                raise "Wrong!"
+                raise ValueError("patient {} spoke to an unknown role: {}".format(patient.id, speak_to))
             if self.ff_print:
                 if speak_to == "检查员":
-                    print("--------------------------------------")
-                    print(dialog_history[-2]["turn"], dialog_history[-2]["role"])
-                    print(dialog_history[-2]["content"])
-                print("--------------------------------------")
-                print(dialog_history[-1]["turn"], dialog_history[-1]["role"])
-                print(dialog_history[-1]["content"])
-        
-        doctor_response = self.doctor.speak(self.medical_director_summary_query, patient.id)
+                    self.print_dialog_turn(dialog_history[-2])
+                self.print_dialog_turn(dialog_history[-1])
+
+        if self.summaries is not None:
+            self.defer_summary(patient, session, dialog_history, turn)
+            return
+        doctor_response = yield Step(self.doctor.speak, self.doctor.aspeak, self.medical_director_summary_query, session)
         dialog_history.append({"turn": turn+1, "role": "Doctor", "content": doctor_response})
         if self.ff_print:
-            print("--------------------------------------")
-            print(dialog_history[-1]["turn"], dialog_history[-1]["role"])
-            print(dialog_history[-1]["content"])
+            self.print_dialog_turn(dialog_history[-1])
             # self.evaluate(patient_profile, doctor_response)
 
+        dialog_info = self.build_dialog_info(patient, dialog_history)
+        self.save_dialog_info(dialog_info)
+
+    def defer_summary(self, patient, session, dialog_history, turn):
+        # the dialog is over and the transcript fixed, the summary needs no more interaction
+        messages = self.doctor.build_messages(self.medical_director_summary_query, session)
+        # tagged like the interactive doctor.speak, which has no stage
+        context = dict(get_call_context(), role=self.doctor.role)
+        dialog_history.append({"turn": turn+1, "role": "Doctor", "content": None})
+        self.summaries.defer(self.build_dialog_info(patient, dialog_history), messages, context)
+
+    @staticmethod
+    def fill_summary(dialog_info, doctor_response):
+        dialog_info["dialog_history"][-1]["content"] = doctor_response
+
+    def run_deferred_summaries(self):
+        if self.summaries is not None:
+            self.summaries.run()
+
+    @staticmethod
+    def print_dialog_turn(dialog_turn):
+        print("--------------------------------------")
+        print(dialog_turn["turn"], dialog_turn["role"])
+        print(dialog_turn["content"])
+
+    def build_dialog_info(self, patient, dialog_history):
         dialog_info = {
             "patient_id": patient.id,
             "doctor": self.args.doctor,
@@ -158,7 +260,7 @@ class Consultation:
             "dialog_history": dialog_history,
             "time": self.start_time,
         }
-        self.save_dialog_info(dialog_info)
+        return dialog_info
     
     def save_dialog_info(self, dialog_info):
         with jsonlines.open(self.save_path, "a") as f:
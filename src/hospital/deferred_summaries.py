@@ -0,0 +1,114 @@
+import concurrent.futures
+import contextvars
+import os
+import threading
+import jsonlines
+from utils.call_context import call_context
+from engine import BatchJob, build_batch_backend
+
+
+class DeferredSummaries:
+    """
+    --batch_backend: 对话已经结束、不再需要交互的最终总结推迟到一个批处理任务。
+    病人的会诊结束时结果立即写入save_path(标记summary_pending，续跑时跳过该病人)，总结的请求写入<save_path>.pending.jsonl；
+    运行结束时所有待总结的请求(包括之前中断的运行留下的)作为一个任务提交，结果填回save_path。
+    批处理中失败的请求在线程池中重新交互请求，仍然失败的保持pending，由下次运行继续。
+    fill(info, summary): 把总结写进保存的结果中。
+    """
+    def __init__(self, args, save_path, engine, fill, max_workers):
+        self.backend = args.batch_backend
+        self.batch_dir = args.batch_dir
+        self.poll_interval = args.batch_poll_interval
+        self.save_path = save_path
+        self.pending_path = os.path.splitext(save_path)[0] + ".pending.jsonl"
+        self.engine = engine
+        self.fill = fill
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self.deferred = 0
+        self.from_batch = 0
+        self.retried = 0
+        self.failed = 0
+
+    def defer(self, info, messages, context):
+        # the request before the result, a result marked pending always has its request
+        with self._lock:
+            with jsonlines.open(self.pending_path, "a") as f:
+                f.write({"patient_id": info["patient_id"], "messages": messages, "context": context})
+            with jsonlines.open(self.save_path, "a") as f:
+                f.write(dict(info, summary_pending=True))
+            self.deferred += 1
+
+    def load_pending(self):
+        # patient id -> request, for the results still marked pending
+        if not os.path.exists(self.pending_path) or not os.path.exists(self.save_path):
+            return {}
+        with jsonlines.open(self.save_path, "r") as f:
+            pending_ids = {str(info["patient_id"]) for info in f if info.get("summary_pending")}
+        requests = {}
+        with jsonlines.open(self.pending_path, "r") as f:
+            for request in f:
+                if str(request["patient_id"]) in pending_ids:
+                    requests[str(request["patient_id"])] = request
+        return requests
+
+    def summarize(self, request):
+        with call_context(**request["context"]):
+            try:
+                return self.engine.get_response(request["messages"])
+            except Exception as e:
+                print("patient {}: summary failed: {!r}".format(request["patient_id"], e))
+                return None
+
+    def run(self):
+        requests = self.load_pending()
+        if not requests:
+            return
+        backend = build_batch_backend(self.backend, self.batch_dir, engine=self.engine)
+        name = os.path.splitext(os.path.basename(self.save_path))[0] + ".summaries"
+        batch_job = BatchJob(backend, self.batch_dir, name, poll_interval=self.poll_interval)
+        responses = batch_job.run(
+            [(patient_id, self.engine.batch_request_body(request["messages"])) for patient_id, request in requests.items()],
+            {patient_id: request["context"] for patient_id, request in requests.items()})
+        summaries = {patient_id: response for patient_id, response in responses.items() if response is not None}
+        self.from_batch += len(summaries)
+
+        # failed in the batch job, asked interactively like the other calls of the run, max_workers at a time
+        failed = [request for patient_id, request in requests.items() if patient_id not in summaries]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(contextvars.copy_context().run, self.summarize, request): str(request["patient_id"])
+                       for request in failed}
+            for future in concurrent.futures.as_completed(futures):
+                if future.result() is not None:
+                    summaries[futures[future]] = future.result()
+                    self.retried += 1
+                else:
+                    self.failed += 1
+
+        self.fill_in(summaries, requests)
+        print(self.report())
+
+    def fill_in(self, summaries, requests):
+        with jsonlines.open(self.save_path, "r") as f:
+            infos = list(f)
+        for info in infos:
+            summary = summaries.get(str(info["patient_id"]))
+            if info.get("summary_pending") and summary is not None:
+                self.fill(info, summary)
+                del info["summary_pending"]
+        # written aside and renamed, an interrupted fill keeps the results as they were
+        with jsonlines.open(self.save_path + ".tmp", "w") as f:
+            f.write_all(infos)
+        os.replace(self.save_path + ".tmp", self.save_path)
+
+        left = [request for patient_id, request in requests.items() if patient_id not in summaries]
+        if left:
+            with jsonlines.open(self.pending_path + ".tmp", "w") as f:
+                f.write_all(left)
+            os.replace(self.pending_path + ".tmp", self.pending_path)
+        else:
+            os.remove(self.pending_path)
+
+    def report(self):
+        return "Deferred summaries: {} deferred in this run, {} from the batch job, {} failed in the batch and summarized interactively, {} still pending{}".format(
+            self.deferred, self.from_batch, self.retried, self.failed, " ({})".format(self.pending_path) if self.failed else "")
@@ -0,0 +1,189 @@
+import asyncio
+import concurrent.futures
+import json
+import random
+from .scheduler import MakespanTracker, PatientCostModel
+
+
+def iter_json_array(f, chunk_size=1 << 16):
+    # the items of a JSON array read chunk by chunk, at most one item and one chunk in memory
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def more():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer, pos = buffer[pos:] + chunk, 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            more()
+
+    skip(" \t\r\n")
+    if buffer[pos:pos + 1] != "[":
+        raise ValueError("{} is not a JSON array".format(getattr(f, "name", "patient database")))
+    pos += 1
+    while True:
+        skip(" \t\r\n,")
+        if pos >= len(buffer) or buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # the item goes on in the next chunk
+            more()
+            continue
+        pos = end
+        yield item
+
+
+class PatientDatabase:
+    """
+    按需读取的病人数据库：.json(病人列表)增量解析，.jsonl每行一个病人，不会一次载入整个文件。
+    Patient(系统提示、Engine)在worker取到该病人时才构造，已处理过的病人(skip)在读取时直接跳过，
+    启动时间和常驻内存与数据库的大小无关。
+    shuffle_buffer: 在这么多条记录的窗口内打乱顺序，0表示按文件顺序。
+    schedule: "shuffle"，或"longest_first"：窗口内按cost_model估计的开销从大到小提交，减少最后只剩几个长对话在跑的时间。
+    """
+    def __init__(self, path, patient_class, args, shuffle_buffer=0, seed=None, schedule="shuffle", cost_model=None):
+        self.path = path
+        self.patient_class = patient_class
+        self.args = args
+        self.shuffle_buffer = shuffle_buffer
+        self.random = random.Random(seed)
+        self.skip_ids = set()
+        self.skipped = 0
+        self.schedule = schedule
+        self.cost_model = cost_model if cost_model is not None else PatientCostModel()
+        self.makespan = MakespanTracker(schedule)
+        # patient id -> estimated cost of the ordered records not submitted yet
+        self.costs = {}
+
+    def skip(self, patient_ids):
+        self.skip_ids = set(patient_ids)
+
+    def _records(self):
+        with open(self.path, "r") as f:
+            if self.path.endswith(".jsonl"):
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                yield from iter_json_array(f)
+
+    def _shuffled(self, records):
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            i = self.random.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = record
+        self.random.shuffle(buffer)
+        yield from buffer
+
+    def _longest_first(self, records):
+        # the whole database when it fits in the window, otherwise one window after the other
+        buffer = []
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= max(self.shuffle_buffer, 1):
+                yield from self._by_cost(buffer)
+                buffer = []
+        yield from self._by_cost(buffer)
+
+    def _by_cost(self, records):
+        self.cost_model.observe(records)
+        costs = [self.cost_model.estimate(record) for record in records]
+        for i in sorted(range(len(records)), key=lambda i: -costs[i]):
+            self.costs[records[i]["id"]] = costs[i]
+            yield records[i]
+
+    def _unskipped(self, records):
+        for record in records:
+            if record["id"] in self.skip_ids:
+                self.skipped += 1
+                continue
+            yield record
+
+    def records(self):
+        self.skipped = 0
+        # skipped before the window, the processed patients take no place in it
+        records = self._unskipped(self._records())
+        if self.schedule == "longest_first":
+            records = self._longest_first(records)
+        elif self.shuffle_buffer > 1:
+            records = self._shuffled(records)
+        yield from records
+
+    def cost(self, record):
+        # estimated when the window was ordered, or now for the other schedules
+        cost = self.costs.pop(record["id"], None)
+        if cost is None:
+            self.cost_model.observe([record])
+            cost = self.cost_model.estimate(record)
+        return cost
+
+    def build(self, record):
+        return self.patient_class(
+            self.args,
+            patient_profile=record["profile"],
+            medical_records=record["medical_record"],
+            patient_id=record["id"],
+        )
+
+    def __iter__(self):
+        for record in self.records():
+            yield self.build(record)
+
+    def report(self):
+        report = self.makespan.report()
+        if report is None:
+            return None
+        return "{}\n  {}".format(report, self.cost_model.report())
+
+    def thread_map(self, fn, max_workers):
+        """
+        在线程池中对每个病人的记录调用fn(record)，边读边提交，最多2 * max_workers个病人在排队或进行中。
+        Patient由fn通过build(record)构造，病历有误的病人与会诊失败的病人一样由fn处理。
+        :return: 按完成顺序产生的futures
+        """
+        window = 2 * max_workers
+        self.makespan.start(max_workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = set()
+            for record in self.records():
+                if len(pending) >= window:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    yield from done
+                run = self.makespan.timed(fn, self.cost(record))
+                pending.add(executor.submit(run, record))
+            yield from concurrent.futures.as_completed(pending)
+
+    async def async_map(self, fn, max_concurrency):
+        """
+        在事件循环上对每个病人的记录运行fn(record)，最多max_concurrency个同时进行，Patient同样由fn构造。
+        :return: 按完成顺序产生的tasks
+        """
+        pending = set()
+        self.makespan.start(max_concurrency)
+        for record in self.records():
+            if len(pending) >= max_concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task
+            run = self.makespan.atimed(fn, self.cost(record))
+            pending.add(asyncio.ensure_future(run(record)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task
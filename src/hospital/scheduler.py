@@ -0,0 +1,141 @@
+import heapq
+import json
+import random
+import threading
+import time
+
+import jsonlines
+
+
+class PatientCostModel:
+    """
+    估计每个病人一次会诊的开销，用于最长优先(longest_first)调度：
+    历史输出(--schedule_history，Consultation的dialog_history或CollaborativeConsultation的final_turn)里有的病人
+    用历史的轮数，没有的病人按病历的长度(字符数)乘以已读到的历史病人的 轮数/长度 换算；没有任何历史时直接用病历长度。
+    """
+    def __init__(self, history_paths=()):
+        costs = {}
+        for path in history_paths or []:
+            with jsonlines.open(path, "r") as f:
+                for obj in f:
+                    cost = self.history_cost(obj)
+                    if cost is not None:
+                        costs.setdefault(obj["patient_id"], []).append(cost)
+        self.history = {patient_id: sum(values) / len(values) for patient_id, values in costs.items()}
+        # history cost and record size of the records read so far that have a history
+        self.history_sum = 0.0
+        self.size_sum = 0
+        self.from_history = 0
+        self.from_size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def history_cost(obj):
+        if "dialog_history" in obj:
+            # one LLM call per turn of the dialog
+            return len(obj["dialog_history"])
+        if obj.get("final_turn") is not None:
+            # the revisions and agreement of every discussion round
+            return obj["final_turn"] + 1
+        return None
+
+    @staticmethod
+    def record_size(record):
+        return len(record.get("profile") or "") + len(json.dumps(record.get("medical_record") or {}, ensure_ascii=False))
+
+    def observe(self, records):
+        # fit the history cost per record size on the records with a history
+        with self._lock:
+            for record in records:
+                if record["id"] in self.history:
+                    self.history_sum += self.history[record["id"]]
+                    self.size_sum += self.record_size(record)
+
+    def estimate(self, record):
+        with self._lock:
+            if record["id"] in self.history:
+                self.from_history += 1
+                return self.history[record["id"]]
+            self.from_size += 1
+            size = self.record_size(record)
+            if self.size_sum:
+                return size * self.history_sum / self.size_sum
+            # no record with a history read yet
+            return sum(self.history.values()) / len(self.history) if self.history else size
+
+    def report(self):
+        return "{} patients estimated from history, {} from record size".format(self.from_history, self.from_size)
+
+
+class MakespanTracker:
+    """
+    记录每个病人的估计开销和实际的开始、结束时间，运行结束后比较预测和实际的makespan：
+    预测值按提交的顺序在同样多的worker上做list scheduling模拟，开销按本次运行的 总耗时/总估计开销 换算成秒，
+    同时给出随机顺序下的预测值和下界 max(最长的病人, 总开销/worker数)。
+    """
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.workers = None
+        self.costs = []
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def start(self, workers):
+        with self._lock:
+            self.workers = workers
+            self.costs, self.spans = [], []
+
+    def timed(self, fn, cost):
+        # fn wrapped to record when the patient starts and ends
+        with self._lock:
+            self.costs.append(cost)
+
+        def run(*args, **kwargs):
+            st = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.spans.append((cost, st, time.perf_counter()))
+        return run
+
+    def atimed(self, fn, cost):
+        with self._lock:
+            self.costs.append(cost)
+
+        async def run(*args, **kwargs):
+            st = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.spans.append((cost, st, time.perf_counter()))
+        return run
+
+    @staticmethod
+    def simulate(durations, workers):
+        # every patient starts on the first worker to be free, in the given order
+        free = [0.0] * min(workers, len(durations))
+        for duration in durations:
+            heapq.heappush(free, heapq.heappop(free) + duration)
+        return max(free, default=0.0)
+
+    def report(self):
+        with self._lock:
+            if not self.spans or self.workers is None:
+                return None
+            actual = max(end for _, _, end in self.spans) - min(st for _, st, _ in self.spans)
+            total_cost = sum(cost for cost, _, _ in self.spans)
+            busy = sum(end - st for _, st, end in self.spans)
+            seconds_per_cost = busy / total_cost if total_cost else 0.0
+            durations = [cost * seconds_per_cost for cost in self.costs[:len(self.spans)]]
+            predicted = self.simulate(durations, self.workers)
+            shuffled = list(durations)
+            rng = random.Random(0)
+            random_order = []
+            for _ in range(20):
+                rng.shuffle(shuffled)
+                random_order.append(self.simulate(shuffled, self.workers))
+            lower_bound = max(max(durations), sum(durations) / self.workers)
+            return "Schedule: {}, {} patients on {} workers, makespan {:.1f}s predicted ({:.1f}s in random order, lower bound {:.1f}s), {:.1f}s actual".format(
+                self.schedule, len(self.spans), self.workers, predicted, sum(random_order) / len(random_order), lower_bound, actual)
@@ -0,0 +1,161 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+from .transcript import Transcript, TranscriptView
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # no resource module on windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class ConsultationSession:
+    """
+    一个病人的一次会诊：Agent为该病人保存的可变状态(对话记录、诊断)都在session里，由Scenario显式传给Agent，
+    Agent本身不再保存这些状态，可以被任意多个线程、asyncio task共享。
+    对话只记录一份(transcript)，每个Agent通过view(agent)读取自己视角的messages。
+    结果保存之后由SessionManager.close释放；会诊失败退出时同样释放。
+    """
+    def __init__(self, patient):
+        self.patient = patient
+        self.patient_id = patient.id
+        self.transcript = Transcript()
+        # agent key -> view / diagnosis of the agent in this consultation
+        self._views = {}
+        self._diagnosis = {}
+        self.closed = False
+
+    @staticmethod
+    def agent_key(agent):
+        name = getattr(agent, "name", None)
+        return agent.role if name is None else "{}.{}".format(agent.role, name)
+
+    def view(self, agent):
+        key = self.agent_key(agent)
+        if key not in self._views:
+            self._views[key] = TranscriptView(self.transcript, agent, key)
+        return self._views[key]
+
+    def say(self, agent, content):
+        self.transcript.say(self.agent_key(agent), agent.role, content)
+
+    def hear(self, agent, role, content):
+        self.transcript.hear(self.agent_key(agent), role, content, view=self._views.get(self.agent_key(agent)))
+
+    def diagnosis(self, agent):
+        key = self.agent_key(agent)
+        if key not in self._diagnosis:
+            self._diagnosis[key] = agent.initial_diagnosis(self.patient_id)
+        return self._diagnosis[key]
+
+    def state(self):
+        return {"transcript": self.transcript.state(), "diagnosis": self._diagnosis}
+
+    def restore(self, state):
+        self.transcript.restore(state["transcript"])
+        self._views = {}
+        self._diagnosis = {key: dict(diagnosis) for key, diagnosis in state["diagnosis"].items()}
+
+    def size(self):
+        # the transcript text, counted as it is said instead of serializing the state
+        return self.transcript.content_bytes
+
+
+class SessionManager:
+    """
+    会诊session的生命周期：Scenario为每个病人open一个session，save_dialog_info/save_info成功后close，
+    close之后session不再被引用，常驻内存不再随处理过的对话总量增长。
+    on_close(hook): close时调用hook(session)，如Agent释放Engine中为该会诊保留的状态(本地模型的KV cache)。
+    spill_dir: close时先把session的状态写成<spill_dir>/<patient_id>.json，之后可用load()取回。
+    """
+    def __init__(self, spill_dir=None, keep=False):
+        self.spill_dir = spill_dir
+        # --keep_sessions: closed sessions stay referenced until the process exits
+        self.keep = keep
+        self.kept = []
+        self.close_hooks = []
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        self._live = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+        self.failed = 0
+        self.peak_live = 0
+        self.released_bytes = 0
+        self.spilled = 0
+        self.start_rss_mb = None
+
+    @contextlib.contextmanager
+    def open(self, patient):
+        session = ConsultationSession(patient)
+        with self._lock:
+            if self.start_rss_mb is None:
+                self.start_rss_mb = peak_rss_mb()
+            self._live[id(session)] = session
+            self.opened += 1
+            self.peak_live = max(self.peak_live, len(self._live))
+        try:
+            yield session
+        finally:
+            if not session.closed:
+                self.close(session, saved=False)
+
+    def on_close(self, hook):
+        self.close_hooks.append(hook)
+
+    def spill_path(self, patient_id):
+        return os.path.join(self.spill_dir, "{}.json".format(patient_id))
+
+    def close(self, session, saved=True):
+        if session.closed:
+            return
+        session.closed = True
+        for hook in self.close_hooks:
+            hook(session)
+        if self.spill_dir:
+            with open(self.spill_path(session.patient_id), "w") as f:
+                json.dump(dict(session.state(), patient_id=session.patient_id, saved=saved), f, ensure_ascii=False)
+        with self._lock:
+            self._live.pop(id(session), None)
+            if self.keep:
+                self.kept.append(session)
+            self.closed += saved
+            self.failed += not saved
+            self.released_bytes += 0 if self.keep else session.size()
+            self.spilled += bool(self.spill_dir)
+
+    def load(self, patient):
+        # a closed session of the patient with the state it was spilled with, None if there is none
+        if not self.spill_dir or not os.path.exists(self.spill_path(patient.id)):
+            return None
+        with open(self.spill_path(patient.id), "r") as f:
+            state = json.load(f)
+        session = ConsultationSession(patient)
+        session.restore(state)
+        session.closed = True
+        return session
+
+    def report(self):
+        with self._lock:
+            finished = self.closed + self.failed
+            lines = ["Sessions: {} opened, {} closed after saving, {} failed, {} live, peak {} live".format(
+                self.opened, self.closed, self.failed, len(self._live), self.peak_live)]
+            if finished:
+                per_1k = 1000 / finished
+                lines.append("  transcript text released: {:.1f} KB per 1k patients{}".format(
+                    self.released_bytes / 1024 * per_1k,
+                    ", {} spilled to {}".format(self.spilled, self.spill_dir) if self.spill_dir else ""))
+                rss = peak_rss_mb()
+                if rss is not None and self.start_rss_mb is not None:
+                    lines.append("  peak RSS {:.1f} MB, grown by {:.1f} MB since the first session ({:.1f} MB per 1k patients)".format(
+                        rss, rss - self.start_rss_mb, (rss - self.start_rss_mb) * per_1k))
+        return "\n".join(lines)
@@ -0,0 +1,104 @@
+import threading
+
+
+class Utterance:
+    """
+    对话记录中的一句话：说话的Agent(speaker/role)、内容，以及听到这句话的Agent(audience)。
+    同一句话只记录一次，说话人和听众各自按自己的视角(assistant/user)读取它。
+    """
+    __slots__ = ("speaker", "role", "content", "audience")
+
+    def __init__(self, speaker, role, content, audience=()):
+        self.speaker = speaker
+        self.role = role
+        self.content = content
+        # a tuple, most utterances have one listener
+        self.audience = tuple(audience)
+
+    def to_list(self):
+        return [self.speaker, self.role, self.content, list(self.audience)]
+
+
+class TranscriptView:
+    """
+    一个Agent看到的对话：initial_memories加上它说过和听到的话，按Agent的provider格式(agent.format_message)转换。
+    转换结果缓存在view里，每次只转换上次之后新增的记录，不再每轮重建整个messages。
+    """
+    def __init__(self, transcript, agent, key):
+        self.transcript = transcript
+        self.agent = agent
+        self.key = key
+        self._messages = [agent.format_message(role, content) for role, content in agent.initial_memories()]
+        self._cursor = 0
+        # the dialog has not started until the agent hears something
+        self._heard = False
+
+    def _extend(self):
+        entries = self.transcript.entries
+        while self._cursor < len(entries):
+            utterance = entries[self._cursor]
+            self._cursor += 1
+            memory = self.agent.recall(utterance, self.key)
+            if memory is None:
+                continue
+            if memory[0] == "assistant" and not self._heard and self.agent.drop_leading_assistant:
+                # e.g. the greeting, for providers whose dialog must start with the user
+                continue
+            self._heard = self._heard or memory[0] == "user"
+            self._messages.append(self.agent.format_message(*memory))
+
+    def messages(self):
+        # a new list of the cached messages, the caller may change the list but not the messages in it
+        self._extend()
+        return list(self._messages)
+
+    def seen(self, index):
+        return index < self._cursor
+
+    def __len__(self):
+        self._extend()
+        return len(self._messages)
+
+
+class Transcript:
+    """
+    一次会诊的对话记录，只追加不修改(除了给最后一句话添加听众)，Doctor、Patient等通过各自的TranscriptView读取。
+    """
+    def __init__(self):
+        self.entries = []
+        # utf-8 bytes of the contents, kept up to date for the session stats
+        self.content_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_size(content):
+        return len(content.encode("utf-8")) if isinstance(content, str) else 0
+
+    def say(self, speaker, role, content):
+        with self._lock:
+            self.entries.append(Utterance(speaker, role, content))
+            self.content_bytes += self.content_size(content)
+
+    def hear(self, listener, role, content, view=None):
+        # the listener hears the latest utterance if it is the same, otherwise a new one from someone unnamed
+        with self._lock:
+            index = len(self.entries) - 1
+            if index >= 0 and (view is None or not view.seen(index)):
+                utterance = self.entries[index]
+                if utterance.role == role and utterance.content == content and listener not in utterance.audience:
+                    utterance.audience += (listener,)
+                    return
+            self.entries.append(Utterance(None, role, content, audience=[listener]))
+            self.content_bytes += self.content_size(content)
+
+    def state(self):
+        with self._lock:
+            return [utterance.to_list() for utterance in self.entries]
+
+    def restore(self, state):
+        with self._lock:
+            self.entries = [Utterance(*entry) for entry in state]
+            self.content_bytes = sum(self.content_size(utterance.content) for utterance in self.entries)
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,6 +1,8 @@
 from utils.register import registry
 import engine
+from engine import Engine, engine_pool, response_cache, rate_limiters, usage_tracker, hedging, single_flight, concurrency_governor, context_windows
 import agents
+from agents import exam_lookups, agreement_prechecks
 import hospital
 import utils
 from utils.options import get_parser
@@ -8,8 +10,24 @@ from utils.options import get_parser
 
 if __name__ == '__main__':
     args = get_parser()
+    Engine.setup(args)
     scenario = registry.get_class(args.scenario)(args)
-    if not args.parallel:
+    if args.run_async:
+        scenario.run_async()
+    elif not args.parallel:
         scenario.run()
     else:
         scenario.parallel_run()
+    print(engine_pool.report())
+    print(response_cache.report())
+    print(rate_limiters.report())
+    print(hedging.report())
+    print(single_flight.report())
+    print(concurrency_governor.report())
+    print(context_windows.report())
+    print(exam_lookups.report())
+    print(agreement_prechecks.report())
+    if hasattr(scenario, "sessions"):
+        print(scenario.sessions.report())
+    usage_tracker.save()
+    print(usage_tracker.report())
@@ -0,0 +1,74 @@
+"""
+在CPU上用一个小模型验证本地模型的动态batching：
+  serial  - 之前的行为，并发线程在模型上排队，一次生成一条
+  batched - 并发请求经过BatchScheduler合并成batch生成
+贪心解码下两种方式的输出应当一致。
+
+Usage (from src/):
+    python scripts/benchmark_batching.py --model hf-internal-testing/tiny-random-LlamaForCausalLM --requests 16
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.batching import BatchScheduler
+
+
+PROMPTS = [
+    "医生您好，我最近总是咳嗽，",
+    "我这两天发烧到三十八度五，还有点头痛，",
+    "最近胃口不好，吃完饭就胃胀，",
+    "我的膝盖上楼梯的时候会疼，",
+]
+
+
+def run(requests, workers, submit):
+    st = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outputs = list(executor.map(submit, requests))
+    return outputs, time.perf_counter() - st
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM", type=str)
+    parser.add_argument("--requests", default=16, type=int, help="number of concurrent requests")
+    parser.add_argument("--workers", default=8, type=int, help="threads issuing requests, like Consultation.parallel_run")
+    parser.add_argument("--max_batch_size", default=8, type=int)
+    parser.add_argument("--max_wait_ms", default=10.0, type=float)
+    parser.add_argument("--max_new_tokens", default=32, type=int)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32)
+    model.eval()
+    generation_kwargs = {"max_new_tokens": args.max_new_tokens, "do_sample": False}
+    # prompts of different lengths, so that batches need padding
+    requests = [tokenizer.encode(PROMPTS[i % len(PROMPTS)] * (1 + i % 3)) for i in range(args.requests)]
+
+    # serial: one generate at a time, concurrent callers wait on the model like they did on model.chat
+    serial = BatchScheduler(model, tokenizer, max_batch_size=1, max_wait_ms=0, **generation_kwargs)
+    model_lock = threading.Lock()
+
+    def serial_submit(input_ids):
+        with model_lock:
+            return serial.generate_batch([input_ids])[0]
+
+    batcher = BatchScheduler(model, tokenizer, args.max_batch_size, args.max_wait_ms, **generation_kwargs)
+    # warm up
+    serial.generate_batch([requests[0]])
+
+    serial_outputs, serial_time = run(requests, args.workers, serial_submit)
+    batched_outputs, batched_time = run(requests, args.workers, batcher.submit)
+
+    matches = sum(a == b for a, b in zip(serial_outputs, batched_outputs))
+    print("serial  {:8.1f} ms  {:6.1f} req/s".format(serial_time * 1000, args.requests / serial_time))
+    print("batched {:8.1f} ms  {:6.1f} req/s".format(batched_time * 1000, args.requests / batched_time))
+    print(batcher.report())
+    print("identical outputs: {}/{}".format(matches, args.requests))
@@ -0,0 +1,87 @@
+"""
+对比Scenario读取病人数据库的开销(在新的解释器中测量到第一个病人可以开始问诊为止的时间和内存峰值)：
+  eager - 之前的行为，json.load整个数据库并为每个病人构造Patient
+  lazy  - PatientDatabase，边读边构造，只构造第一个病人
+病人数据由脚本生成(.json和.jsonl)，不调用模型。
+
+Usage (from src/):
+    python scripts/benchmark_patient_database.py --patients 1000 10000 50000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json
+import resource
+import sys
+import time
+sys.argv = ["run.py", "--patient_database", {path!r}, "--patient_openai_api_key", "sk-benchmark"]
+from utils.options import get_parser
+from utils.register import registry
+import engine
+import agents
+import hospital
+from hospital.patient_database import PatientDatabase
+args = get_parser()
+patient_class = registry.get_class(args.patient)
+start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+st = time.perf_counter()
+if {eager}:
+    patients = [
+        patient_class(args, patient_profile=record["profile"], medical_records=record["medical_record"], patient_id=record["id"])
+        for record in json.load(open(args.patient_database))]
+    first = patients[0]
+else:
+    first = next(iter(PatientDatabase(args.patient_database, patient_class, args, shuffle_buffer=args.patient_shuffle_buffer)))
+print(time.perf_counter() - st)
+print((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 1024)
+"""
+
+
+def write_patients(work_dir, number):
+    patients = [{
+        "id": i,
+        "profile": "病人{}，男，40岁。".format(i),
+        "medical_record": {
+            "现病史": "咳嗽三天，伴有发热，最高体温38.5度。" * 8,
+            "既往史": "否认高血压、糖尿病病史。" * 4,
+            "查体": "体温37.5度，咽部充血。" * 4,
+            "辅助检查": "血常规：白细胞计数12.1×10^9/L。" * 4,
+        },
+    } for i in range(number)]
+    paths = [os.path.join(work_dir, "patients_{}.json".format(number)), os.path.join(work_dir, "patients_{}.jsonl".format(number))]
+    with open(paths[0], "w") as f:
+        json.dump(patients, f, ensure_ascii=False, indent=4)
+    with open(paths[1], "w") as f:
+        for patient in patients:
+            f.write(json.dumps(patient, ensure_ascii=False) + "\n")
+    return paths
+
+
+def measure(path, eager):
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(path=path, eager=eager)],
+        cwd=SRC_DIR, capture_output=True, text=True, check=True
+    ).stdout.split("\n")
+    return float(output[0]) * 1000, float(output[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", default=[1000, 10000, 50000], nargs="+", type=int)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark_patient_database_")
+    print("{:>8} {:>6} {:>12} {:>10}".format("patients", "mode", "first ms", "+RSS MB"))
+    for number in args.patients:
+        json_path, jsonl_path = write_patients(work_dir, number)
+        for mode, path, eager in [("eager", json_path, True), ("json", json_path, False), ("jsonl", jsonl_path, False)]:
+            duration, rss = measure(path, eager)
+            print("{:>8} {:>6} {:>12.1f} {:>10.1f}".format(number, mode, duration, rss))
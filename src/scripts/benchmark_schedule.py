@@ -0,0 +1,64 @@
+"""
+对比两种病人提交顺序的makespan(不调用模型，每个病人按其对话轮数sleep)：
+  shuffle       - 窗口内随机打乱(之前的行为)
+  longest_first - 按历史输出估计的开销从大到小提交
+病人和历史输出由脚本生成：多数对话6轮左右，少数长对话接近上限，部分病人没有历史、只能按病历长度估计。
+
+Usage (from src/):
+    python scripts/benchmark_schedule.py --patients 200 --workers 8 --turn_ms 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hospital.patient_database import PatientDatabase
+from hospital.scheduler import PatientCostModel
+
+
+def write_patients(work_dir, number, history_ratio, seed):
+    rng = random.Random(seed)
+    turns = {}
+    with open(os.path.join(work_dir, "patients.jsonl"), "w") as f:
+        for i in range(number):
+            turns[i] = rng.choice([21] * 1 + [14] * 2 + [7] * 12 + [5] * 5)
+            # longer dialogs usually come with longer records
+            record = {"id": i, "profile": "病人{}".format(i), "medical_record": {"现病史": "咳嗽。" * (turns[i] * 10 + rng.randrange(40))}}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    with open(os.path.join(work_dir, "history.jsonl"), "w") as f:
+        for i in range(number):
+            if rng.random() < history_ratio:
+                dialog_history = [{"turn": turn, "role": "Doctor", "content": ""} for turn in range(turns[i])]
+                f.write(json.dumps({"patient_id": i, "dialog_history": dialog_history}, ensure_ascii=False) + "\n")
+    return turns
+
+
+def measure(work_dir, schedule, turns, workers, turn_ms):
+    patients = PatientDatabase(
+        os.path.join(work_dir, "patients.jsonl"), None, None, shuffle_buffer=1024, seed=0,
+        schedule=schedule, cost_model=PatientCostModel([os.path.join(work_dir, "history.jsonl")]))
+    st = time.perf_counter()
+    for future in patients.thread_map(lambda record: time.sleep(turns[record["id"]] * turn_ms / 1000), workers):
+        future.result()
+    return time.perf_counter() - st, patients.report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", default=200, type=int)
+    parser.add_argument("--workers", default=8, type=int)
+    parser.add_argument("--turn_ms", default=5.0, type=float, help="sleep per turn of a dialog")
+    parser.add_argument("--history_ratio", default=0.8, type=float, help="share of the patients with a historical output")
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark_schedule_")
+    turns = write_patients(work_dir, args.patients, args.history_ratio, args.seed)
+    for schedule in ["shuffle", "longest_first"]:
+        duration, report = measure(work_dir, schedule, turns, args.workers, args.turn_ms)
+        print("{:>14} {:>8.3f}s".format(schedule, duration))
+        print(report)
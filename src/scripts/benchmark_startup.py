@@ -0,0 +1,61 @@
+"""
+对比run.py启动时的导入开销：
+  lazy  - 现在的行为，只导入registry，Engine/Agent模块在get_class时才导入
+  eager - 之前的行为，启动时导入所有Engine/Agent/Scenario模块
+
+Usage (from src/):
+    python scripts/benchmark_startup.py --repeat 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import importlib
+import time
+st = time.perf_counter()
+import engine
+import agents
+import hospital
+import utils
+from utils.register import registry
+missing = []
+if {eager}:
+    for module_path in registry.lazy_modules():
+        try:
+            importlib.import_module(module_path)
+        except ImportError as e:
+            missing.append("{{}} ({{}})".format(module_path, e.name))
+print(time.perf_counter() - st)
+print(";".join(missing))
+"""
+
+
+def measure(eager, repeat):
+    durations, missing = [], ""
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD.format(eager=eager)],
+            cwd=SRC_DIR, capture_output=True, text=True, check=True
+        ).stdout.split("\n")
+        durations.append(float(output[0]) * 1000)
+        missing = output[1]
+    return durations, missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", default=5, type=int, help="fresh interpreters per mode")
+    args = parser.parse_args()
+
+    for mode, eager in [("eager", True), ("lazy", False)]:
+        durations, missing = measure(eager, args.repeat)
+        print("{:<6} median {:8.1f} ms  min {:8.1f} ms  max {:8.1f} ms".format(
+            mode, statistics.median(durations), min(durations), max(durations)))
+        if missing:
+            print("       not installed, skipped: {}".format(missing.replace(";", ", ")))
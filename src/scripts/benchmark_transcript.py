@@ -0,0 +1,112 @@
+"""
+对比每轮对话构造prompt的两种方式(不调用模型，只测构造messages的开销)：
+  rebuild    - 之前的行为，Doctor和Patient各存一份记忆，每次speak都把全部记忆重新转换成messages
+  transcript - 一次会诊只记录一份transcript，Doctor和Patient的view只转换新增的记录
+输出每个对话的耗时、新建的message数和它们占用的字节数(built KB)，以及对话结束时仍被引用的内存(live KB，tracemalloc)。
+
+Usage (from src/):
+    python scripts/benchmark_transcript.py --turns 10 20 40 80 --dialogs 200
+"""
+import argparse
+import os
+import sys
+import time
+from sys import getsizeof
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from agents.base_agent import Agent
+from agents.doctor import Doctor
+from agents.patient import Patient
+from hospital.session import ConsultationSession
+
+
+class Stub:
+    id = 0
+
+
+def build_agents():
+    doctor = Doctor()
+    # the patient's prompt and engine are not needed to build its messages
+    patient = Patient.__new__(Patient)
+    Agent.__init__(patient, None)
+    patient.system_message = "你是一个病人。" * 40
+    return doctor, patient
+
+
+def size(messages):
+    return getsizeof(messages) + sum(getsizeof(message) for message in messages)
+
+
+def rebuild_dialog(doctor, patient, turns, line):
+    built, built_bytes = 0, 0
+    doctor_memories = [("system", doctor.system_message), ("assistant", doctor.doctor_greet)]
+    patient_memories = [("system", patient.system_message)]
+    doctor_response = doctor.doctor_greet
+    for turn in range(turns):
+        messages = [{"role": memory[0], "content": memory[1]} for memory in patient_memories]
+        messages.append({"role": "user", "content": f"<Doctor> {doctor_response}"})
+        built, built_bytes = built + len(messages), built_bytes + size(messages)
+        patient_response = "<对医生讲> {} {}".format(turn, line)
+        patient_memories += [("user", f"<Doctor> {doctor_response}"), ("assistant", patient_response)]
+
+        content = patient_response[len("<对医生讲> "):]
+        messages = [{"role": memory[0], "content": memory[1]} for memory in doctor_memories]
+        messages.append({"role": "user", "content": content})
+        built, built_bytes = built + len(messages), built_bytes + size(messages)
+        doctor_response = "{} {}".format(turn, line)
+        doctor_memories += [("user", content), ("assistant", doctor_response)]
+    return built, built_bytes, (doctor_memories, patient_memories)
+
+
+def transcript_dialog(doctor, patient, turns, line):
+    session = ConsultationSession(Stub())
+    session.say(doctor, doctor.doctor_greet)
+    doctor_response = doctor.doctor_greet
+    # the lists handed to the engine are new, the messages in them are not
+    lists_bytes = 0
+    for turn in range(turns):
+        lists_bytes += getsizeof(patient.build_messages("Doctor", doctor_response, session))
+        patient_response = "<对医生讲> {} {}".format(turn, line)
+        session.say(patient, patient_response)
+
+        lists_bytes += getsizeof(doctor.build_messages(patient_response[len("<对医生讲> "):], session))
+        doctor_response = "{} {}".format(turn, line)
+        session.say(doctor, doctor_response)
+    views = [session.view(doctor).messages(), session.view(patient).messages()]
+    built = sum(len(messages) for messages in views)
+    built_bytes = lists_bytes + sum(size(messages) - getsizeof(messages) for messages in views)
+    return built, built_bytes, session
+
+
+def measure(dialog, doctor, patient, turns, dialogs, line):
+    tracemalloc.start()
+    st = time.perf_counter()
+    built, built_bytes = 0, 0
+    kept = []
+    for _ in range(dialogs):
+        n, n_bytes, state = dialog(doctor, patient, turns, line)
+        built, built_bytes = built + n, built_bytes + n_bytes
+        # like the live sessions of a run, every dialog stays in memory until the end
+        kept.append(state)
+    duration = time.perf_counter() - st
+    live, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration / dialogs * 1000, built / dialogs, built_bytes / dialogs / 1024, live / dialogs / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", default=[10, 20, 40, 80], nargs="+", type=int)
+    parser.add_argument("--dialogs", default=200, type=int)
+    parser.add_argument("--line_length", default=60, type=int, help="characters of every utterance")
+    args = parser.parse_args()
+
+    doctor, patient = build_agents()
+    line = "咳" * args.line_length
+    print("{:>6} | {:>10} {:>9} {:>9} {:>8} | {:>10} {:>9} {:>9} {:>8}".format(
+        "turns", "rebuild ms", "messages", "built KB", "live KB", "transcript", "messages", "built KB", "live KB"))
+    for turns in args.turns:
+        old = measure(rebuild_dialog, doctor, patient, turns, args.dialogs, line)
+        new = measure(transcript_dialog, doctor, patient, turns, args.dialogs, line)
+        print("{:>6} | {:>10.3f} {:>9.0f} {:>9.1f} {:>8.1f} | {:>10.3f} {:>9.0f} {:>9.1f} {:>8.1f}".format(turns, *old, *new))
@@ -0,0 +1,53 @@
+"""
+从历史对话(dialog_history.jsonl)中检查员的回复里整理检查项目名(形如"- 白细胞计数: 12.1×10^9/L"的项目)，
+写成ReporterV2本地抽取器的词典文件(每行一个检查名)，去掉已经在内置词典中的词。
+运行时用 --reporter_exam_terms <输出文件> 加载。
+
+Usage (from src/):
+    python scripts/build_exam_terms.py --dialog_history ../outputs/dialog_history.jsonl --output exam_terms.txt
+"""
+import argparse
+import collections
+import os
+import re
+import sys
+
+import jsonlines
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from agents.exam_index import ExamTermExtractor
+
+
+ITEM = re.compile(r"^\s*-\s*([^:：\n]{2,20})[:：]", re.M)
+
+
+def reporter_items(paths):
+    for path in paths:
+        with jsonlines.open(path, "r") as f:
+            for dialog_info in f:
+                for turn in dialog_info.get("dialog_history", []):
+                    if turn["role"] == "Reporter" and turn["content"]:
+                        yield from ITEM.findall(turn["content"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dialog_history", nargs="+", required=True, help="dialog history jsonl files")
+    parser.add_argument("--output", default="exam_terms.txt")
+    parser.add_argument("--min_count", default=2, type=int, help="keep items named in at least this many reporter replies")
+    args = parser.parse_args()
+
+    known = set(ExamTermExtractor.exam_terms)
+    counts = collections.Counter()
+    for item in reporter_items(args.dialog_history):
+        term = ExamTermExtractor.normalize(item.strip())
+        # generic replies such as "- xxx: 无异常" name nothing
+        if term in known or term in ["xxx", "检查项目"] or term.isdigit():
+            continue
+        counts[term] += 1
+
+    terms = [term for term, count in counts.most_common() if count >= args.min_count]
+    with open(args.output, "w") as f:
+        for term in terms:
+            f.write(term + "\n")
+    print("{} exam terms from {} reporter items written to {}".format(len(terms), sum(counts.values()), args.output))
@@ -0,0 +1,170 @@
+"""
+并发压力测试：一个共享的Doctor同时为大量病人问诊(线程池和asyncio)，检查各病人的对话状态没有互相串扰。
+用进程内的Engine.Echo代替LLM：回复由prompt确定，带有病人的编号和轮次，
+只要某个prompt里混入了其他病人的内容，或者一个Agent的历史回复缺失、乱序，就记为一次违例。
+
+Usage (from src/):
+    python scripts/stress_sessions.py --patients 2000 --workers 256 --max_concurrency 2048
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import jsonlines
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.register import registry, register_class
+from utils.call_context import get_call_context
+from utils.options import get_parser
+from engine import Engine
+import agents
+import hospital
+
+
+MARKER = re.compile(r"编号(\d+)")
+
+
+@register_class(alias="Engine.Echo")
+class EchoEngine(Engine):
+    provider = "echo"
+    greet = "您好，有哪里不舒服？"
+
+    def __init__(self, latency_ms=0.0, seed=0):
+        self.model_name = "echo"
+        self.latency_ms = latency_ms
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.violations = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def add_parser_args(parser):
+        parser.add_argument("--echo_latency_ms", default=2.0, type=float, help="max random latency of an echoed call")
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(latency_ms=args.echo_latency_ms)
+
+    def violation(self, message):
+        with self._lock:
+            self.violations.append(message)
+
+    def reply(self, messages):
+        with self._lock:
+            self.calls += 1
+        role = get_call_context().get("role")
+        patient_ids = {int(patient_id) for message in messages for patient_id in MARKER.findall(message["content"])}
+        if len(patient_ids) != 1:
+            self.violation("{} prompt mentions patients {}".format(role, sorted(patient_ids)))
+        patient_id = min(patient_ids) if patient_ids else -1
+        replies = [message["content"] for message in messages if message["role"] == "assistant"]
+        if role == "Patient":
+            expected = [self.patient_reply(patient_id, k) for k in range(1, len(replies) + 1)]
+            if replies != expected:
+                self.violation("patient {} history out of order: {}".format(patient_id, replies))
+            return self.patient_reply(patient_id, len(replies) + 1)
+        if role == "Doctor":
+            expected = [self.greet] + [self.doctor_reply(patient_id, k) for k in range(1, len(replies))]
+            if replies != expected:
+                self.violation("doctor history of patient {} out of order: {}".format(patient_id, replies))
+            if "诊断结果" in messages[-1]["content"]:
+                return "#诊断结果#\n编号{} 感冒\n\n#诊断依据#\n(1) 咳嗽\n\n#治疗方案#\n(1) 休息".format(patient_id)
+            return self.doctor_reply(patient_id, len(replies))
+        return "#检查项目#\n- 编号{} 血常规: 正常".format(patient_id)
+
+    @staticmethod
+    def patient_reply(patient_id, k):
+        # the second answer goes to the reporter, to exercise that path too
+        if k == 2:
+            return "<对检查员讲> 编号{} 我需要做血常规检查，能否告诉我结果？".format(patient_id)
+        return "<对医生讲> 编号{} 第{}次回答".format(patient_id, k)
+
+    @staticmethod
+    def doctor_reply(patient_id, k):
+        return "编号{} 第{}个问题".format(patient_id, k)
+
+    def generate(self, messages):
+        time.sleep(self.random.random() * self.latency_ms / 1000)
+        return self.reply(messages)
+
+    async def agenerate(self, messages):
+        await asyncio.sleep(self.random.random() * self.latency_ms / 1000)
+        return self.reply(messages)
+
+
+def write_patients(path, number):
+    patients = [{
+        "id": i,
+        "profile": "病人编号{}，男，40岁。".format(i),
+        "medical_record": {
+            "现病史": "编号{}咳嗽三天。".format(i),
+            "查体": "编号{}体温37.5度。".format(i),
+            "辅助检查": "编号{}血常规正常。".format(i),
+        },
+    } for i in range(number)]
+    with open(path, "w") as f:
+        json.dump(patients, f, ensure_ascii=False)
+
+
+def check_dialogs(save_path, number):
+    violations = []
+    with jsonlines.open(save_path, "r") as fr:
+        dialogs = list(fr)
+    if len(dialogs) != number:
+        violations.append("{} dialogs saved for {} patients".format(len(dialogs), number))
+    for dialog in dialogs:
+        for turn in dialog["dialog_history"]:
+            patient_ids = {int(patient_id) for patient_id in MARKER.findall(turn["content"])}
+            if patient_ids - {dialog["patient_id"]}:
+                violations.append("dialog of patient {} mentions {}".format(dialog["patient_id"], sorted(patient_ids)))
+    return violations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", default=2000, type=int)
+    parser.add_argument("--turns", default=6, type=int, help="max conversation turns of a dialog")
+    parser.add_argument("--workers", default=256, type=int, help="threads sharing the doctor in parallel_run")
+    parser.add_argument("--max_concurrency", default=2048, type=int, help="dialogs in flight on the event loop in run_async")
+    parser.add_argument("--latency_ms", default=2.0, type=float)
+    args, _ = parser.parse_known_args()
+
+    work_dir = tempfile.mkdtemp(prefix="stress_sessions_")
+    patient_database = os.path.join(work_dir, "patients.json")
+    write_patients(patient_database, args.patients)
+
+    failed = False
+    for mode in ["--parallel", "--run_async"]:
+        save_path = os.path.join(work_dir, "dialogs{}.jsonl".format(mode.replace("-", "_")))
+        sys.argv = [sys.argv[0],
+            "--scenario", "Scenario.Consultation", "--engine_override", "Engine.Echo",
+            "--patient_database", patient_database, "--save_path", save_path,
+            "--max_conversation_turn", str(args.turns), "--max_workers", str(args.workers),
+            "--max_concurrency", str(args.max_concurrency), "--echo_latency_ms", str(args.latency_ms),
+            "--usage_ledger_path", "", mode]
+        scenario_args = get_parser()
+        Engine.setup(scenario_args)
+        scenario = registry.get_class(scenario_args.scenario)(scenario_args)
+        # the override engine is shared by both runs
+        engine = scenario.doctor.engine.engine
+        engine.calls, engine.violations = 0, []
+        st = time.perf_counter()
+        if scenario_args.run_async:
+            scenario.run_async()
+        else:
+            scenario.parallel_run()
+        duration = time.perf_counter() - st
+        violations = engine.violations + check_dialogs(save_path, args.patients)
+        print("{}: {} patients, {} calls in {:.1f}s ({:.0f} calls/s), {} violations".format(
+            mode, args.patients, engine.calls, duration, engine.calls / duration, len(violations)))
+        print(scenario.sessions.report())
+        for violation in violations[:10]:
+            print("  " + violation)
+        failed = failed or bool(violations)
+    sys.exit(1 if failed else 0)
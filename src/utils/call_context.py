@@ -0,0 +1,60 @@
+import contextvars
+import functools
+import inspect
+
+
+# 当前LLM调用的上下文：哪个角色(role)、为哪个病人(patient_id)、在哪个阶段(stage)
+# contextvars在线程池的每个任务、asyncio的每个task以及asyncio.to_thread中各自独立
+_call_context = contextvars.ContextVar("call_context", default={})
+
+
+def get_call_context():
+    return _call_context.get()
+
+
+class call_context:
+    """
+    with call_context(role="Doctor"): ...
+    也可以作为同步或async方法的装饰器：@call_context(stage="agreement")
+    """
+    def __init__(self, **fields):
+        self.fields = fields
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_call_context.set(dict(_call_context.get(), **self.fields)))
+        return self
+
+    def __exit__(self, *exc_info):
+        _call_context.reset(self._tokens.pop())
+
+    def __call__(self, function):
+        fields = self.fields
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with call_context(**fields):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with call_context(**fields):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def patient_context(method):
+    # for scenario methods taking the patient as first argument: every LLM call inside is tagged with patient.id
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, patient, *args, **kwargs):
+            with call_context(patient_id=patient.id):
+                return await method(self, patient, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, patient, *args, **kwargs):
+        with call_context(patient_id=patient.id):
+            return method(self, patient, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,33 @@
+import concurrent.futures
+import contextvars
+import threading
+
+
+_executor = None
+_lock = threading.Lock()
+
+
+def executor():
+    # shared by all patients, the tasks are single LLM calls that never fan out again
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=256, thread_name_prefix="fan_out")
+        return _executor
+
+
+def fan_out(calls):
+    """
+    同时执行互不依赖的calls(无参数的callable)，第一个在当前线程执行，其余在共享的线程池中执行，
+    每个call带着当前的call_context。
+    :return: 按calls的顺序排列的结果，任何一个出错都会在所有call结束后抛出
+    """
+    calls = list(calls)
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    futures = [executor().submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    try:
+        first = calls[0]()
+    finally:
+        concurrent.futures.wait(futures)
+    return [first] + [future.result() for future in futures]
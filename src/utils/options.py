@@ -25,7 +25,15 @@ def get_parser():
             description="scenario configuration",
         )
     registry.get_class(args.scenario).add_parser_args(scenario_group)
+
+    engine_group = parser.add_argument_group(
+            title="Engine",
+            description="options shared by all engines",
+        )
+    registry.get_class("Engine.Base").add_parser_args(engine_group)
     args, _ = parser.parse_known_args()
+    if args.engine_override is not None:
+        registry.get_class(args.engine_override).add_parser_args(engine_group)
 
     # Add args of patient to parser.
     if hasattr(args, "patient"):
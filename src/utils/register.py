@@ -1,15 +1,26 @@
+import importlib
 
 
 class Registry:
     def __init__(self):
         self._registry = {}
+        self._lazy_registry = {}
 
     def register(self, alias, class_reference):
         self._registry[alias] = class_reference
 
+    def register_lazy(self, alias, module_path):
+        # 只记录别名对应的模块，第一次get_class时才导入该模块
+        self._lazy_registry[alias] = module_path
+
     def get_class(self, alias):
+        if alias not in self._registry and alias in self._lazy_registry:
+            importlib.import_module(self._lazy_registry[alias])
         return self._registry.get(alias)
 
+    def lazy_modules(self):
+        return sorted(set(self._lazy_registry.values()))
+
 
 # 使用装饰器来注册类，并且可以指定别名
 registry = Registry()
@@ -25,3 +36,25 @@ def register_class(alias=None):
     return decorator
 
 
+def register_lazy_modules(package, lazy_modules):
+    """
+    为package注册延迟导入的模块。
+    :param lazy_modules: {相对模块名: {类名: 注册别名}}
+    :return: 供package的__getattr__使用的 {类名: 模块路径}
+    """
+    class_to_module = {}
+    for module_name, classes in lazy_modules.items():
+        module_path = package + module_name
+        for class_name, alias in classes.items():
+            registry.register_lazy(alias, module_path)
+            class_to_module[class_name] = module_path
+    return class_to_module
+
+
+def lazy_getattr(package, class_to_module):
+    # PEP 562: `from package import SomeClass` keeps working without eager imports
+    def __getattr__(name):
+        if name in class_to_module:
+            return getattr(importlib.import_module(class_to_module[name]), name)
+        raise AttributeError("module {!r} has no attribute {!r}".format(package, name))
+    return __getattr__
@@ -0,0 +1,36 @@
+class Step:
+    """
+    会诊流程中的一次Agent调用：同步执行时调用function，asyncio中await afunction，参数相同。
+    流程写成产生Step的generator，由run_steps或arun_steps驱动，同步和async共用一份流程。
+    """
+    __slots__ = ("function", "afunction", "args", "kwargs")
+
+    def __init__(self, function, afunction, *args, **kwargs):
+        self.function = function
+        self.afunction = afunction
+        self.args = args
+        self.kwargs = kwargs
+
+
+def run_steps(steps):
+    """
+    :param steps: a generator yielding Steps, each is sent back the result of its call
+    :return: the return value of the generator
+    """
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result = step.function(*step.args, **step.kwargs)
+
+
+async def arun_steps(steps):
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result = await step.afunction(*step.args, **step.kwargs)